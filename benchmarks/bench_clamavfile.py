@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+
+# Throughput and memory benchmarks of clamavfile with a regression gate
+#
+# Generates a signed synthetic CVD and cdiff (see synthetic.py), runs
+# every case in a fresh interpreter so the peak RSS belongs to the case
+# alone, and writes the results as JSON. Each case is run once to warm
+# up, then every sample repeats it for at least --min-seconds and the
+# best of --repeat samples counts. With --baseline the results are
+# compared to an earlier run and the exit status is 1 when a case lost
+# more than --threshold of its throughput or grew its peak RSS by more
+# than --rss-threshold. --update writes the run as the new baseline.
+#
+#   python3 benchmarks/bench_clamavfile.py [--size 64M] [--baseline FILE [--update]]
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import tempfile
+import concurrent.futures
+import multiprocessing
+from typing import Dict, Tuple, Callable, Any
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import synthetic  # noqa: E402
+from cav.clamavdns import clamavdns  # noqa: E402
+from cav.clamavfile import clamavfile  # noqa: E402
+
+DNSRECORD = '0.103.2:60:26150:1618219740:1:63:49191:333'
+MB = 1024 * 1024
+# Shortest sample, short cases are repeated until they take this long
+MINSECONDS = 0.5
+
+
+def _header(cvd: str, cdiff: str, workdir: str) -> Tuple[float, str]:
+    for _ in range(100):
+        clamavfile(cvd)
+        clamavfile(cdiff)
+    return 200, 'files/s'
+
+
+def _verifycvd(cvd: str, cdiff: str, workdir: str) -> Tuple[float, str]:
+    clamobject = clamavfile(cvd)
+    assert clamobject.verifysignature()
+    return clamobject.filesize / MB, 'MB/s'
+
+
+def _verifycdiff(cvd: str, cdiff: str, workdir: str) -> Tuple[float, str]:
+    for _ in range(20):
+        assert clamavfile(cdiff).verifysignature()
+    return 20, 'files/s'
+
+
+def _savetofile(cvd: str, cdiff: str, workdir: str) -> Tuple[float, str]:
+    clamobject = clamavfile(cvd)
+    clamobject.savetofile(os.path.join(workdir, 'daily.tar.gz'))
+    os.unlink(os.path.join(workdir, 'daily.tar.gz'))
+    return clamobject.filesize / MB, 'MB/s'
+
+
+def _extract(cvd: str, cdiff: str, workdir: str) -> Tuple[float, str]:
+    clamobject = clamavfile(cvd)
+    names = clamobject.extractall(workdir)
+    for name in names:
+        os.unlink(os.path.join(workdir, name))
+    return clamobject.filesize / MB, 'MB/s'
+
+
+def _dnsparse(cvd: str, cdiff: str, workdir: str) -> Tuple[float, str]:
+    for _ in range(100000):
+        clamavdns().parsetext(DNSRECORD)
+    return 100000, 'records/s'
+
+
+CASES: Dict[str, Callable[[str, str, str], Tuple[float, str]]] = {
+    'header': _header,
+    'verify-cvd': _verifycvd,
+    'verify-cdiff': _verifycdiff,
+    'savetofile': _savetofile,
+    'extract': _extract,
+    'dns-parse': _dnsparse,
+}
+
+
+def runcase(name: str, cvd: str, cdiff: str, repeat: int,
+            minseconds: float = MINSECONDS) -> Dict[str, Any]:
+    """
+        Best of repeat samples of one case after a warmup run, run in a
+        child process. A sample runs the case until minseconds passed
+    """
+    best = None
+    with synthetic.testkeys(), tempfile.TemporaryDirectory(dir=os.path.dirname(cvd)) as workdir:
+        CASES[name](cvd, cdiff, workdir)
+        for _ in range(repeat):
+            total, seconds = 0.0, 0.0
+            started = time.perf_counter()
+            while seconds < minseconds:
+                amount, unit = CASES[name](cvd, cdiff, workdir)
+                total += amount
+                seconds = time.perf_counter() - started
+            if best is None or total / seconds > best[0]:
+                best = (total / seconds, seconds)
+
+    return {'throughput': best[0], 'unit': unit, 'seconds': best[1],
+            'peakrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any],
+            threshold: float, rssthreshold: float) -> Dict[str, str]:
+    'Returns the regressed cases with a reason'
+    regressions: Dict[str, str] = dict()
+    for name, result in results['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        if result['throughput'] < before['throughput'] * (1 - threshold):
+            regressions[name] = 'throughput {:.1f} < {:.1f} {}'.format(
+                result['throughput'], before['throughput'], result['unit'])
+        elif result['peakrss'] > before['peakrss'] * (1 + rssthreshold):
+            regressions[name] = 'peak RSS {} > {} kB'.format(result['peakrss'], before['peakrss'])
+
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark clamavfile')
+    parser.add_argument('--size', default='64M', help='approximate CVD size, 1M to 1G')
+    parser.add_argument('--signatures', type=int, default=None)
+    parser.add_argument('--directory', default=None, help='where the synthetic files go')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-seconds', type=float, default=MINSECONDS,
+                        help='shortest sample, short cases are repeated')
+    parser.add_argument('--cases', default=','.join(CASES))
+    parser.add_argument('--output', default=None, help='write the results as JSON')
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--update', action='store_true', help='save the run as baseline')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--rss-threshold', type=float, default=0.2)
+    arguments = parser.parse_args()
+
+    size = synthetic.parsesize(arguments.size)
+    results: Dict[str, Any] = {
+        'meta': {'size': size, 'signatures': arguments.signatures,
+                 'python': platform.python_version(), 'machine': platform.machine()},
+        'results': dict()}
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory(dir=arguments.directory) as directory:
+        cvd, cdiff = synthetic.generate(directory, size, arguments.signatures)
+        for name in arguments.cases.split(','):
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+                result = executor.submit(runcase, name, cvd, cdiff, arguments.repeat,
+                                         arguments.min_seconds).result()
+            results['results'][name] = result
+            print('{:<14} {:>12.1f} {:<10} {:>10} kB peak RSS'.format(
+                name, result['throughput'], result['unit'], result['peakrss']))
+
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if arguments.baseline is None:
+        return 0
+    if arguments.update or not os.path.exists(arguments.baseline):
+        with open(arguments.baseline, 'w') as output:
+            json.dump(results, output, indent=2)
+        return 0
+    with open(arguments.baseline) as baselinefile:
+        baseline = json.load(baselinefile)
+    if baseline['meta']['size'] != size or baseline['meta']['signatures'] != arguments.signatures:
+        print('Baseline was run with other --size or --signatures', file=sys.stderr)
+        return 2
+    regressions = compare(results, baseline, arguments.threshold, arguments.rss_threshold)
+    for name, reason in sorted(regressions.items()):
+        print('REGRESSION {}: {}'.format(name, reason), file=sys.stderr)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+# Micro-benchmark of ClamAV signature checks
+#
+# Compares the character by character decoder and byte list PSS code
+# that clamavfile used before clamavkeys with the clamavkeys verifier.
+# The file hashing is left out, both sides get the same digest.
+#
+#   python3 benchmarks/bench_signature.py [--number N]
+
+import os
+import sys
+import timeit
+import hashlib
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cav import clamavkeys  # noqa: E402
+
+TESTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests')
+
+CVDSIGNATURE = '4Jp9JtGJY6nUk8JHDQQpQeBwlfXqskvhXL+vesDNqAeWCmjbudU+Hy/Nj4/BH2vl70c/R5B/VYY+eqqCQo6o7VGLqLJr/E+19gejqMp/iRcuHrtnLw6V/x3UjO3/qYVSlcJvAjtMI7FK32wjB+Sp8kaS/ZbfaFQp6trRQhisjqf'
+CVDMD5 = bytes.fromhex('92baacd59fd26e6bcf03077add78d209')
+
+
+def legacydecode(signaturestring: str, e: int, n: int) -> str:
+    chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789+/'
+    added = 0
+    for counter, onechar in enumerate(signaturestring):
+        decoded = -1
+        for i in range(0, 64):
+            if chars[i] == onechar:
+                decoded = i
+                break
+        added = decoded * pow(2, 6 * counter) + added
+
+    return format(pow(added, e, n), '02x')
+
+
+def legacymd5(signature: str, digest: bytes) -> bool:
+    key = clamavkeys.CLAMAVKEY
+    return legacydecode(signature, key.e, key.n).zfill(32) == digest.hex()
+
+
+def legacypss(signature: str, digest: bytes) -> bool:
+    key = clamavkeys.CLAMAVPSSKEY
+    decrypted = legacydecode(signature, key.e, key.n).zfill(512)
+    hexlist = [decrypted[i:i + 2] for i in range(0, len(decrypted), 2)]
+    decryptedbytes = bytearray()
+    for i in range(0, len(hexlist)):
+        decryptedbytes.append(int(hexlist[i], 16))
+    mask = bytearray()
+    for i in range(0, 223):
+        mask.append(decryptedbytes[i])
+    digest2 = bytearray()
+    for i in range(223, 255):
+        digest2.append(decryptedbytes[i])
+    datastr = str()
+    for num in range(0, 7):
+        datastr += hashlib.sha256(bytes(digest2) + b'\x00\x00\x00' + bytes([num])).hexdigest()
+    datalist = [datastr[i:i + 2] for i in range(0, len(datastr), 2)]
+    xordata = bytearray()
+    for i in range(0, 223):
+        xordata.append(int(datalist[i], 16) ^ mask[i])
+    xordata[0] &= 0x7f
+    salt = 0
+    for i in range(0, 223):
+        if xordata[i] == 0x01:
+            salt = i + 1
+            break
+    final = bytearray(8)
+    final.extend(digest)
+    for i in range(salt, salt + 32):
+        final.append(xordata[i])
+    digest2str = ''.join(format(x, '02x') for x in digest2)
+
+    return hashlib.sha256(final).hexdigest() == digest2str
+
+
+def measure(function, number: int) -> float:
+    'Best of five, microseconds per call'
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=200)
+    arguments = parser.parse_args()
+
+    with open(os.path.join(TESTS, 'daily-25784.cdiff'), 'rb') as cdiff:
+        data = cdiff.read()
+    pssdigest = hashlib.sha256(data[:-343]).digest()
+    psssignature = data[-342:].decode('ascii')
+    assert legacymd5(CVDSIGNATURE, CVDMD5) and legacypss(psssignature, pssdigest)
+
+    cases = [
+        ('decode signature string', lambda: legacydecode(CVDSIGNATURE, 1, 2 ** 1100),
+         lambda: clamavkeys.decodesignature(CVDSIGNATURE)),
+        ('CVD MD5 RSA check', lambda: legacymd5(CVDSIGNATURE, CVDMD5),
+         lambda: clamavkeys.CLAMAVKEY.verify(CVDSIGNATURE, CVDMD5)),
+        ('cdiff RSA-PSS check', lambda: legacypss(psssignature, pssdigest),
+         lambda: clamavkeys.CLAMAVPSSKEY.verify(psssignature, pssdigest)),
+    ]
+    print('{:<26} {:>12} {:>12} {:>8}'.format('', 'legacy us', 'keys us', 'speedup'))
+    for name, legacy, current in cases:
+        before = measure(legacy, arguments.number)
+        after = measure(current, arguments.number)
+        print('{:<26} {:>12.1f} {:>12.1f} {:>7.1f}x'.format(name, before, after,
+                                                         before / after))
+
+
+if __name__ == '__main__':
+    main()
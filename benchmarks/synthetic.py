@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+
+# Synthetic signed ClamAV files for benchmarks
+#
+# Builds a CVD of about --size bytes with --signatures hash signatures
+# spread over .hdb, .hsb and .ndb members, and a cdiff that deletes and
+# adds --changes lines, both signed with the test keys from
+# tests/test_clamavkeys.py. The keys are registered while the files are
+# verified, see testkeys().
+#
+#   python3 benchmarks/synthetic.py DIRECTORY [--size 64M] [--signatures N]
+
+import os
+import sys
+import zlib
+import random
+import argparse
+import tempfile
+import contextlib
+from typing import List, Tuple, Optional, Iterator
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+from cav import clamavkeys  # noqa: E402
+from cav.clamavfile import clamavfile  # noqa: E402
+from cav.clamavbuilder import clamavbuilder  # noqa: E402
+from test_clamavkeys import privatekey  # noqa: E402
+
+KEYNAME = 'benchmark'
+PSSKEYNAME = 'benchmark-pss'
+DBNAME = 'daily'
+VERSION = 1000
+# Member name, share of the signatures and line format. Hash lines are
+# hash:size:name, .ndb lines name:target:offset:hexsignature
+MEMBERS = [('daily.hdb', 0.6, b'%s:%d:Bench.Md5-%d'),
+           ('daily.hsb', 0.3, b'%s:%d:Bench.Sha256-%d'),
+           ('daily.ndb', 0.1, b'Bench.Ndb-%d:0:*:%s%s')]
+# Sample of lines used to estimate the compression ratio
+SAMPLELINES = 20000
+
+
+def parsesize(text: str) -> int:
+    'Byte count with an optional K, M or G suffix'
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if text[-1:].upper() in units:
+        return int(float(text[:-1]) * units[text[-1:].upper()])
+
+    return int(text)
+
+
+def keys() -> Tuple[clamavkeys.clamavkey, clamavkeys.clamavkey]:
+    return privatekey(clamavkeys.MD5, KEYNAME), privatekey(clamavkeys.PSS, PSSKEYNAME)
+
+
+@contextlib.contextmanager
+def testkeys() -> Iterator[None]:
+    'Register the signing keys so the generated files verify'
+    for key in keys():
+        clamavkeys.registerkey(key)
+    try:
+        yield
+    finally:
+        clamavkeys.unregisterkey(KEYNAME)
+        clamavkeys.unregisterkey(PSSKEYNAME)
+
+
+def _line(generator: random.Random, member: int, number: int, padding: int) -> bytes:
+    name, _, template = MEMBERS[member]
+    # Random hex padding compresses like the rest of the line
+    pad = generator.randbytes((padding + 1) // 2).hex().encode()[:padding]
+    if name == 'daily.ndb':
+        return template % (number, generator.randbytes(16).hex().encode(), pad)
+    digest = generator.randbytes(32 if name == 'daily.hsb' else 16).hex().encode()
+
+    return template % (digest, generator.randrange(1, 10 ** 7), number) + pad
+
+
+def _compression(signatures: int, seed: int) -> Tuple[float, float]:
+    'Average line length and compressed bytes per line byte'
+    generator = random.Random(seed)
+    sample = b'\n'.join(_line(generator, number % len(MEMBERS), number, 0)
+                        for number in range(min(SAMPLELINES, max(signatures, 100))))
+
+    return len(sample) / min(SAMPLELINES, max(signatures, 100)), \
+        len(zlib.compress(sample, 9)) / len(sample)
+
+
+def writedatabase(directory: str, size: int, signatures: Optional[int] = None,
+                  seed: int = 1) -> List[bytes]:
+    """
+        Write the members of a database whose CVD is about size bytes.
+        Without signatures the count follows from size and the natural
+        line length, with it lines are padded to reach size. Returns the
+        first line of each member for building a cdiff
+    """
+    linelength, ratio = _compression(signatures or 0, seed)
+    rawsize = int(size / ratio)
+    if signatures is None:
+        signatures = max(1, int(rawsize / (linelength + 1)))
+    padding = max(0, int(rawsize / signatures - linelength - 1))
+    generator = random.Random(seed)
+    firstlines: List[bytes] = list()
+    number = 0
+    for member, (name, share, _) in enumerate(MEMBERS):
+        count = int(signatures * share) if member < len(MEMBERS) - 1 else signatures - number
+        with open(os.path.join(directory, name), 'wb') as dbfile:
+            batch: List[bytes] = list()
+            for _ in range(count):
+                batch.append(_line(generator, member, number, padding))
+                number += 1
+                if len(batch) == 10000:
+                    dbfile.write(b'\n'.join(batch) + b'\n')
+                    batch = list()
+            if batch:
+                dbfile.write(b'\n'.join(batch) + b'\n')
+        with open(os.path.join(directory, name), 'rb') as dbfile:
+            firstlines.append(dbfile.readline().rstrip(b'\n'))
+
+    return firstlines
+
+
+def cdiffscript(firstlines: List[bytes], changes: int, seed: int = 2) -> Iterator[bytes]:
+    'Delete the first line of each member and add changes lines'
+    generator = random.Random(seed)
+    for member, (name, _, _) in enumerate(MEMBERS):
+        yield b'OPEN %s\n' % name.encode()
+        yield b'DEL 1 %s\n' % firstlines[member][:64]
+        for number in range(changes // len(MEMBERS)):
+            yield b'ADD %s\n' % _line(generator, member, 10 ** 9 + number, 0)
+        yield b'CLOSE\n'
+
+
+def generate(directory: str, size: int, signatures: Optional[int] = None,
+             changes: int = 1000, seed: int = 1) -> Tuple[str, str]:
+    """
+        Build DIRECTORY/daily.cvd and DIRECTORY/daily-VERSION+1.cdiff.
+        Returns their paths
+    """
+    key, psskey = keys()
+    builder = clamavbuilder(key, psskey)
+    cvd = os.path.join(directory, DBNAME + '.cvd')
+    cdiff = os.path.join(directory, '{}-{}.cdiff'.format(DBNAME, VERSION + 1))
+    with tempfile.TemporaryDirectory(dir=directory) as source:
+        firstlines = writedatabase(source, size, signatures, seed)
+        builder.buildcvd(source, cvd, VERSION, DBNAME, timestamp=1600000000)
+    builder.writecdiff(cdiffscript(firstlines, changes), cdiff, VERSION + 1)
+
+    return cvd, cdiff
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Build signed synthetic ClamAV files')
+    parser.add_argument('directory')
+    parser.add_argument('--size', default='64M', help='approximate CVD size, 1M to 1G')
+    parser.add_argument('--signatures', type=int, default=None)
+    parser.add_argument('--changes', type=int, default=1000, help='lines added by the cdiff')
+    parser.add_argument('--seed', type=int, default=1)
+    arguments = parser.parse_args()
+
+    cvd, cdiff = generate(arguments.directory, parsesize(arguments.size),
+                          arguments.signatures, arguments.changes, arguments.seed)
+    with testkeys():
+        for path in (cvd, cdiff):
+            clamobject = clamavfile(path)
+            print('{} {} bytes, {} signatures, verified {}'.format(
+                path, clamobject.filesize, clamobject.signatures(), clamobject.verifysignature()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,390 @@
+#!/usr/bin/python3
+
+# Build and sign ClamAV CVD and cdiff files
+# Copyright 2021 Thomas Karlsson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import os
+import gzip
+import time
+import hashlib
+import tarfile
+import tempfile
+from typing import List, Dict, Tuple, Union, Optional, Iterator, Any, BinaryIO
+from .clamavfile import clamavfile, mkstempfor, CHUNKSIZE
+from .clamavkeys import clamavkey, MD5, PSS
+from .clamavcdiff import compactscripts, scriptlines, loadchain, linecount
+
+# Longest DEL/XCHG match string, enough to identify a signature line
+MATCHLENGTH = 32
+
+
+class _hashingreader:
+    'Pass reads through while hashing them and counting lines'
+    def __init__(self, fileobject: BinaryIO):
+        self.fileobject = fileobject
+        self.sha256 = hashlib.sha256()
+        self.lines = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobject.read(size)
+        self.sha256.update(data)
+        self.lines += data.count(b'\n')
+
+        return data
+
+
+class _hashingwriter:
+    'Pass writes through while hashing them'
+    def __init__(self, fileobject: BinaryIO, hashobject: Any):
+        self.fileobject = fileobject
+        self.hashobject = hashobject
+
+    def write(self, data: bytes) -> int:
+        self.hashobject.update(data)
+
+        return self.fileobject.write(data)
+
+    def flush(self) -> None:
+        self.fileobject.flush()
+
+
+def _tarinfo(name: str, size: int, mtime: int) -> tarfile.TarInfo:
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = size
+    tarinfo.mtime = mtime
+    tarinfo.mode = 0o644
+    tarinfo.uname = tarinfo.gname = 'root'
+
+    return tarinfo
+
+
+def _lines(path: str) -> Iterator[bytes]:
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as dbfile:
+        yield from dbfile
+
+
+def _matchstring(line: bytes, token: bool = False) -> bytes:
+    'Start of line used to check DEL and XCHG, XCHG needs a single token'
+    line = line.rstrip(b'\r\n')
+    if token:
+        line = line.split(b' ', 1)[0]
+
+    return line[:MATCHLENGTH]
+
+
+class _unmatchable(Exception):
+    'A line that has to be deleted or exchanged has no match string'
+
+
+class _lookahead:
+    'Line iterator that can take one line back'
+    def __init__(self, lines: Iterator[bytes]):
+        self.lines = lines
+        self.pushed: List[bytes] = list()
+
+    def next(self) -> Optional[bytes]:
+        if self.pushed:
+            return self.pushed.pop()
+
+        return next(self.lines, None)
+
+    def pushback(self, line: Optional[bytes]) -> None:
+        if line is not None:
+            self.pushed.append(line)
+
+
+def _diffcommands(oldpath: str, newpath: str) -> Iterator[bytes]:
+    """
+        Script lines turning oldpath into newpath in one pass over both.
+        cdiff can only delete, exchange in place and append, so old lines
+        are matched to new lines in order, a single differing line where
+        the next lines agree again becomes XCHG and the rest of the new
+        file after the last match is added. DEL carries the whole line
+        when it starts with a space, _unmatchable is raised when a blank
+        line or a space-leading line in an XCHG has to be matched. ADD
+        needs a signature, blank lines of newpath are left out
+    """
+    old = _lines(oldpath)
+    new = _lookahead(line for line in _lines(newpath) if line.rstrip(b'\r\n'))
+    oldline = next(old, None)
+    newline = new.next()
+    lineno = 1
+    while oldline is not None:
+        if newline is not None and oldline == newline:
+            oldline, newline = next(old, None), new.next()
+            lineno += 1
+            continue
+        nextold = next(old, None)
+        if newline is not None and nextold is not None:
+            nextnew = new.next()
+            if nextold == nextnew:
+                match = _matchstring(oldline, True)
+                if not match:
+                    raise _unmatchable()
+                yield b'XCHG %d %s %s\n' % (lineno, match, newline.rstrip(b'\r\n'))
+                oldline, newline = next(old, None), new.next()
+                lineno += 2
+                continue
+            new.pushback(nextnew)
+        match = _matchstring(oldline)
+        if match.startswith(b' '):
+            match = oldline.rstrip(b'\r\n')
+        if not match:
+            raise _unmatchable()
+        yield b'DEL %d %s\n' % (lineno, match)
+        oldline = nextold
+        lineno += 1
+    while newline is not None:
+        yield b'ADD ' + newline.rstrip(b'\r\n') + b'\n'
+        newline = new.next()
+
+
+def _matchable(oldpath: str, newpath: str) -> bool:
+    'True when every DEL and XCHG of the diff has a match string'
+    if all(_matchstring(line, True) for line in _lines(oldpath)):
+        return True
+    try:
+        for _ in _diffcommands(oldpath, newpath):
+            pass
+    except _unmatchable:
+        return False
+
+    return True
+
+
+def _difffile(db: str, oldpath: str, newpath: str) -> Iterator[bytes]:
+    if not _matchable(oldpath, newpath):
+        # Replace the whole file, OPEN of a missing file only appends
+        yield b'UNLINK ' + db.encode('utf-8') + b'\n'
+        oldpath = os.devnull
+    opened = False
+    for command in _diffcommands(oldpath, newpath):
+        if not opened:
+            yield b'OPEN ' + db.encode('utf-8') + b'\n'
+            opened = True
+        yield command
+    if opened:
+        yield b'CLOSE\n'
+
+
+def _samefile(oldpath: str, newpath: str) -> bool:
+    if os.path.getsize(oldpath) != os.path.getsize(newpath):
+        return False
+    with open(oldpath, 'rb') as oldfile, open(newpath, 'rb') as newfile:
+        for chunk in iter(lambda: oldfile.read(CHUNKSIZE), b''):
+            if chunk != newfile.read(len(chunk)):
+                return False
+
+    return True
+
+
+def diffscript(olddirectory: str, newdirectory: str) -> Iterator[bytes]:
+    """
+        Yields the lines of a cdiff script that turns the files in
+        olddirectory into the files in newdirectory
+    """
+    oldnames = set(os.listdir(olddirectory))
+    newnames = sorted(os.listdir(newdirectory))
+    for name in newnames:
+        oldpath = os.path.join(olddirectory, name)
+        newpath = os.path.join(newdirectory, name)
+        if not os.path.isfile(newpath):
+            continue
+        if name in oldnames and _samefile(oldpath, newpath):
+            continue
+        yield from _difffile(name, oldpath, newpath)
+    for name in sorted(oldnames - set(newnames)):
+        if os.path.isfile(os.path.join(olddirectory, name)):
+            yield b'UNLINK ' + name.encode('utf-8') + b'\n'
+
+
+class clamavbuilder:
+    """
+    Package signature files into signed CVD files and cdiffs.
+
+    key signs the MD5 in CVD headers, psskey signs cdiffs and the DSIG
+    line of the generated .info file. The archive is streamed through
+    gzip to the destination while the member hashes and the MD5 of the
+    compressed body are computed, nothing is buffered in memory.
+    """
+    def __init__(self, key: clamavkey, psskey: Optional[clamavkey] = None,
+                 builder: str = 'cav', functionalitylevel: int = 0,
+                 compresslevel: int = 9):
+        if key.kind != MD5 or (psskey is not None and psskey.kind != PSS):
+            raise ValueError('key must be an MD5 key and psskey a PSS key')
+        self.key = key
+        self.psskey = psskey
+        self.builder = builder
+        self.functionalitylevel = functionalitylevel
+        self.compresslevel = compresslevel
+
+    def _infoheader(self, timestamp: int, version: int, signatures: int,
+                    md5: str = 'X', signature: str = 'X') -> str:
+        date = time.strftime('%d %b %Y %H-%M %z', time.localtime(timestamp))
+
+        return ':'.join(['ClamAV-VDB', date, str(version), str(signatures),
+                         str(self.functionalitylevel), md5, signature,
+                         self.builder, str(timestamp)])
+
+    def buildcvd(self, directory: str, destination: str, version: int,
+                 dbname: Optional[str] = None,
+                 timestamp: Optional[int] = None) -> clamavfile:
+        """
+            Build destination from the files in directory. dbname (default
+            the destination name without extension) names the generated
+            dbname.info member, which is written last since it lists the
+            hashes of the other members
+        """
+        if dbname is None:
+            dbname = os.path.splitext(os.path.basename(destination))[0]
+        if timestamp is None:
+            timestamp = int(time.time())
+        infoname = dbname + '.info'
+        names = sorted(name for name in os.listdir(directory)
+                       if name != infoname and
+                       os.path.isfile(os.path.join(directory, name)))
+        md5object = hashlib.md5()
+        infolines: List[Tuple[str, int, str]] = list()
+        signatures = 0
+        tempfd, temppath = mkstempfor(destination)
+        try:
+            with os.fdopen(tempfd, 'w+b') as output:
+                output.write(b' ' * 512)
+                body = _hashingwriter(output, md5object)
+                with gzip.GzipFile(fileobj=body, mode='wb', mtime=0,
+                                   compresslevel=self.compresslevel) as gzipfile, \
+                        tarfile.open(fileobj=gzipfile, mode='w|', format=tarfile.USTAR_FORMAT) as tar:
+                    for name in names:
+                        path = os.path.join(directory, name)
+                        with open(path, 'rb') as dbfile:
+                            size = os.fstat(dbfile.fileno()).st_size
+                            reader = _hashingreader(dbfile)
+                            tar.addfile(_tarinfo(name, size, timestamp), reader)
+                        if name != 'COPYING':
+                            signatures += reader.lines
+                        infolines.append((name, size, reader.sha256.hexdigest()))
+                    info = self._info(timestamp, version, signatures, infolines)
+                    tar.addfile(_tarinfo(infoname, len(info), timestamp),
+                                io.BytesIO(info))
+                md5 = md5object.hexdigest()
+                header = self._infoheader(timestamp, version, signatures, md5,
+                                          self.key.sign(md5object.digest()))
+                if len(header) > 512:
+                    raise ValueError('Header longer than 512 bytes')
+                output.seek(0)
+                output.write(header.encode('utf-8').ljust(512, b' '))
+            os.replace(temppath, destination)
+        except BaseException:
+            os.unlink(temppath)
+            raise
+
+        return clamavfile(destination)
+
+    def tocvd(self, source: Union[str, clamavfile], destination: str,
+              recompress: bool = False) -> clamavfile:
+        """
+            Turn a CLD, or a CVD signed by someone else, into a CVD signed
+            with key in one streaming pass. A gzipped body is copied as it
+            is unless recompress, a plain tar is compressed at
+            compresslevel
+        """
+        if isinstance(source, str):
+            source = clamavfile(source)
+        if recompress or not source.compressed:
+            compresslevel = self.compresslevel
+        else:
+            compresslevel = -1
+
+        return source.convert(destination, compresslevel, self.key.sign)
+
+    def _info(self, timestamp: int, version: int, signatures: int,
+              infolines: List[Tuple[str, int, str]]) -> bytes:
+        """
+            The .info member, signed with a DSIG line over the SHA-256 of
+            the lines before it when there is a PSS key
+        """
+        lines = [self._infoheader(timestamp, version, signatures)]
+        lines += ['{}:{}:{}'.format(name, size, digest)
+                  for name, size, digest in infolines]
+        info = ('\n'.join(lines) + '\n').encode('utf-8')
+        if self.psskey is not None:
+            dsig = self.psskey.sign(hashlib.sha256(info).digest())
+            info += b'DSIG:' + dsig.encode('ascii') + b'\n'
+
+        return info
+
+    def buildcdiff(self, olddirectory: str, newdirectory: str,
+                   destination: str, version: int) -> clamavfile:
+        """
+            Diff two extracted databases into a cdiff signed with psskey
+        """
+        return self.writecdiff(diffscript(olddirectory, newdirectory),
+                               destination, version)
+
+    def compactcdiffs(self, cdiffs: List[Union[str, clamavfile]], destination: str,
+                      base: Union[str, Dict[str, int], None] = None,
+                      verify: bool = True) -> clamavfile:
+        """
+            Merge a chain of consecutive cdiffs into one cdiff with the
+            version of the last. base is the extracted database the chain
+            applies to, or a dictionary of its file names and line counts,
+            see compactscripts
+        """
+        clamobjects = loadchain(cdiffs, verify)
+        if not clamobjects:
+            raise ValueError('No cdiffs to merge')
+        if isinstance(base, str):
+            base = {name: linecount(os.path.join(base, name)) for name in os.listdir(base)
+                    if os.path.isfile(os.path.join(base, name))}
+        script = compactscripts((scriptlines(clamobject) for clamobject in clamobjects), base)
+
+        return self.writecdiff(script, destination, clamobjects[-1].version())
+
+    def writecdiff(self, script: Iterator[bytes], destination: str,
+                   version: int) -> clamavfile:
+        """
+            Compress and sign script lines into the cdiff destination
+        """
+        if self.psskey is None:
+            raise ValueError('Signing a cdiff needs a PSS key')
+        directory = os.path.dirname(os.path.abspath(destination))
+        with tempfile.TemporaryFile(dir=directory) as compressed:
+            length = 0
+            with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0,
+                               compresslevel=self.compresslevel) as gzipfile:
+                for line in script:
+                    gzipfile.write(line)
+                    length += len(line)
+            compressed.seek(0)
+            sha256object = hashlib.sha256()
+            tempfd, temppath = mkstempfor(destination)
+            try:
+                with os.fdopen(tempfd, 'wb') as output:
+                    writer = _hashingwriter(output, sha256object)
+                    writer.write(b'ClamAV-Diff:%d:%d:' % (version, length))
+                    for chunk in iter(lambda: compressed.read(CHUNKSIZE), b''):
+                        writer.write(chunk)
+                    output.write(b':' + self.psskey.sign(sha256object.digest()).encode('ascii'))
+                os.replace(temppath, destination)
+            except BaseException:
+                os.unlink(temppath)
+                raise
+
+        return clamavfile(destination)
+
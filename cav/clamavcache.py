@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+
+# Persistent cache of ClamAV signature verification results
+# Copyright 2021 Thomas Karlsson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import sqlite3
+from typing import Optional, Tuple
+from . import clamavmetrics
+from .clamavfile import clamavfile
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS verdicts (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    signature TEXT NOT NULL,
+    path TEXT NOT NULL,
+    ok INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    verified REAL NOT NULL,
+    PRIMARY KEY (device, inode)
+)
+'''
+
+
+class clamavcache:
+    """
+    Verification results stored in SQLite, keyed by device and inode and
+    only valid while size, mtime and header signature are unchanged.
+
+    The database runs in WAL mode so any number of processes can read
+    while one writes, which is what verify_many workers do.
+    """
+    def __init__(self, cachefile: str = 'clamav.cache'):
+        self.cachefile = cachefile
+        self.hits = 0
+        self.misses = 0
+        self._connection = sqlite3.connect(cachefile, timeout=30,
+                                           isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(SCHEMA)
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def lookup(self, fileinfo: os.stat_result,
+               signature: Optional[str] = None) -> Optional[Tuple[bool, str]]:
+        """
+            Returns (ok, digest) for the file described by fileinfo, or
+            None when it is not cached. A stale entry for the same inode is
+            removed
+        """
+        row = self._connection.execute(
+            'SELECT size, mtime_ns, signature, ok, digest FROM verdicts '
+            'WHERE device = ? AND inode = ?',
+            (fileinfo.st_dev, fileinfo.st_ino)).fetchone()
+        metrics = clamavmetrics.active()
+        if row is None:
+            self.misses += 1
+            if metrics is not None:
+                metrics.count('cache_misses')
+            return None
+        size, mtime_ns, cachedsignature, ok, digest = row
+        if size != fileinfo.st_size or mtime_ns != fileinfo.st_mtime_ns or \
+                (signature is not None and signature != cachedsignature):
+            self.invalidate(fileinfo)
+            self.misses += 1
+            if metrics is not None:
+                metrics.count('cache_misses')
+            return None
+        self.hits += 1
+        if metrics is not None:
+            metrics.count('cache_hits')
+
+        return bool(ok), digest
+
+    def store(self, path: str, fileinfo: os.stat_result, signature: str,
+              ok: bool, digest: str) -> None:
+        self._connection.execute(
+            'INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (fileinfo.st_dev, fileinfo.st_ino, fileinfo.st_size,
+             fileinfo.st_mtime_ns, signature, os.path.abspath(path), int(ok), digest,
+             time.time()))
+
+    def invalidate(self, fileinfo: os.stat_result) -> None:
+        self._connection.execute(
+            'DELETE FROM verdicts WHERE device = ? AND inode = ?',
+            (fileinfo.st_dev, fileinfo.st_ino))
+
+    def verify(self, path: str) -> bool:
+        """
+            Verify path, which costs reading the header and a lookup when
+            the file is unchanged since it was last verified
+        """
+        return clamavfile(path).verifysignature(cache=self)
+
+    def prune(self) -> int:
+        """
+            Remove entries for files that are gone or have changed.
+            Returns the number of removed entries
+        """
+        removed = 0
+        rows = self._connection.execute(
+            'SELECT device, inode, size, mtime_ns, path FROM verdicts').fetchall()
+        for device, inode, size, mtime_ns, path in rows:
+            try:
+                fileinfo = os.stat(path)
+                if (fileinfo.st_dev, fileinfo.st_ino, fileinfo.st_size,
+                        fileinfo.st_mtime_ns) == (device, inode, size, mtime_ns):
+                    continue
+            except OSError:
+                pass
+            self._connection.execute(
+                'DELETE FROM verdicts WHERE device = ? AND inode = ?',
+                (device, inode))
+            removed += 1
+
+        return removed
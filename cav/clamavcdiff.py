@@ -0,0 +1,500 @@
+#!/usr/bin/python3
+
+# Apply ClamAV-Diff files to an extracted database
+# Copyright 2021 Thomas Karlsson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import zlib
+import bisect
+import hashlib
+from typing import List, Dict, Set, Tuple, Union, Optional, Iterable, Iterator, Any
+from .clamavfile import clamavfile, mkstempfor, CHUNKSIZE
+
+
+class cdifferror(ValueError):
+    'A cdiff script that is malformed or does not match the database'
+
+
+class cdiffedit:
+    """
+    The commands between OPEN and CLOSE for one database file. Line
+    numbers refer to the file as it was when OPEN was executed, DEL and
+    XCHG only apply when the line starts with the given string and ADD
+    lines are appended at CLOSE.
+    """
+    def __init__(self, db: str):
+        self.db = db
+        self.dels: Dict[int, bytes] = dict()
+        self.xchgs: Dict[int, Tuple[bytes, bytes]] = dict()
+        self.adds: List[bytes] = list()
+
+    def lastline(self) -> int:
+        return max(list(self.dels) + list(self.xchgs) + [0])
+
+    def apply(self, lines: Iterable[bytes]) -> Iterator[bytes]:
+        """
+            Stream lines through the edit
+        """
+        lineno = 0
+        for line in lines:
+            lineno += 1
+            if lineno in self.dels:
+                if not line.startswith(self.dels[lineno]):
+                    raise cdifferror("{}: can't apply DEL at line {}".format(self.db, lineno))
+                continue
+            if lineno in self.xchgs:
+                old, new = self.xchgs[lineno]
+                if not line.startswith(old):
+                    raise cdifferror("{}: can't apply XCHG at line {}".format(self.db, lineno))
+                yield new + b'\n'
+                continue
+            yield line
+        if lineno < self.lastline():
+            raise cdifferror('{}: not all DEL/XCHG have been executed'.format(self.db))
+        for add in self.adds:
+            yield add + b'\n'
+
+
+class cdiffmove:
+    'MOVE src_db dst_db start_line start_str end_line end_str'
+    def __init__(self, src: str, dst: str, start: int, startstr: bytes,
+                 end: int, endstr: bytes):
+        self.src = src
+        self.dst = dst
+        self.start = start
+        self.startstr = startstr
+        self.end = end
+        self.endstr = endstr
+
+
+class cdiffunlink:
+    'UNLINK db_name'
+    def __init__(self, db: str):
+        self.db = db
+
+
+Operation = Union[cdiffedit, cdiffmove, cdiffunlink]
+
+
+def _dbname(name: bytes) -> str:
+    dbname = name.decode('utf-8')
+    if not dbname or '/' in dbname or '\\' in dbname or dbname in ('.', '..'):
+        raise cdifferror('Illegal database name {!r}'.format(dbname))
+
+    return dbname
+
+
+def _lineno(token: bytes) -> int:
+    if not token.isdigit() or int(token) == 0:
+        raise cdifferror('Illegal line number {!r}'.format(token))
+
+    return int(token)
+
+
+def parsescript(lines: Iterable[bytes]) -> List[Operation]:
+    """
+        Parse the lines of a cdiff script into a list of operations
+    """
+    operations: List[Operation] = list()
+    edit = None
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip(b'\r\n')
+        if not line:
+            continue
+        command, _, arguments = line.partition(b' ')
+        if command == b'OPEN':
+            if edit is not None:
+                raise cdifferror('line {}: OPEN while {} is open'.format(number, edit.db))
+            edit = cdiffedit(_dbname(arguments))
+        elif command in (b'ADD', b'DEL', b'XCHG'):
+            if edit is None:
+                raise cdifferror('line {}: {} without OPEN'.format(number, command.decode()))
+            if command == b'ADD':
+                edit.adds.append(arguments)
+            elif command == b'DEL':
+                lineno, _, prefix = arguments.partition(b' ')
+                edit.dels[_lineno(lineno)] = prefix
+            else:
+                lineno, _, rest = arguments.partition(b' ')
+                old, _, new = rest.partition(b' ')
+                edit.xchgs[_lineno(lineno)] = (old, new)
+        elif command == b'CLOSE':
+            if edit is None:
+                raise cdifferror('line {}: CLOSE without OPEN'.format(number))
+            operations.append(edit)
+            edit = None
+        elif command in (b'MOVE', b'UNLINK'):
+            if edit is not None:
+                raise cdifferror('line {}: {} while {} is open'.format(number, command.decode(), edit.db))
+            tokens = arguments.split(b' ')
+            if command == b'UNLINK' and len(tokens) == 1:
+                operations.append(cdiffunlink(_dbname(tokens[0])))
+            elif command == b'MOVE' and len(tokens) == 6:
+                operations.append(cdiffmove(_dbname(tokens[0]), _dbname(tokens[1]),
+                                            _lineno(tokens[2]), tokens[3],
+                                            _lineno(tokens[4]), tokens[5]))
+            else:
+                raise cdifferror('line {}: wrong number of arguments'.format(number))
+        else:
+            raise cdifferror('line {}: unknown command {!r}'.format(number, command))
+    if edit is not None:
+        raise cdifferror('Script ended while {} is open'.format(edit.db))
+
+    return operations
+
+
+def scriptlines(clamobject: clamavfile) -> Iterator[bytes]:
+    """
+        Yields the lines of the gzipped script in a ClamAV-Diff file
+    """
+    if clamobject.magicheader != 'ClamAV-Diff':
+        raise cdifferror('{} is not a ClamAV-Diff file'.format(clamobject.filename))
+    inflater = zlib.decompressobj(47)
+    pending = b''
+    with clamobject.openraw() as clamfile:
+        clamfile.seek(clamobject.headersize())
+        remaining = clamobject.datasize()
+        while remaining > 0 and not inflater.eof:
+            chunk = clamfile.read(min(CHUNKSIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            lines = (pending + inflater.decompress(chunk)).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + b'\n'
+    if pending:
+        yield pending
+
+
+def linecount(filename: str) -> int:
+    'Number of lines as iterated by cdiff, a last line without newline counts'
+    count = 0
+    last = b'\n'
+    with open(filename, 'rb') as dbfile:
+        for chunk in iter(lambda: dbfile.read(CHUNKSIZE), b''):
+            count += chunk.count(b'\n')
+            last = chunk[-1:]
+
+    return count + (last != b'\n')
+
+
+def loadchain(cdiffs: List[Union[str, clamavfile]],
+              verify: bool = True) -> List[clamavfile]:
+    """
+        Returns cdiffs as clamavfile objects in version order, raises
+        cdifferror for gaps in the versions and, with verify, for invalid
+        signatures
+    """
+    clamobjects = [cdiff if isinstance(cdiff, clamavfile) else clamavfile(cdiff)
+                   for cdiff in cdiffs]
+    clamobjects.sort(key=lambda clamobject: clamobject.version())
+    for previous, clamobject in zip(clamobjects, clamobjects[1:]):
+        if clamobject.version() != previous.version() + 1:
+            raise cdifferror('Missing cdiff between version {} and {}'.format(
+                previous.version(), clamobject.version()))
+    if verify:
+        for clamobject in clamobjects:
+            if not clamobject.verifysignature():
+                raise cdifferror('{} has an invalid signature'.format(clamobject.filename))
+
+    return clamobjects
+
+
+class _composite:
+    """
+    Consecutive edits of one file merged into a single edit of the file
+    as it was before the first of them. Later DEL and XCHG commands are
+    mapped back through the earlier ones: a DEL of an added line drops
+    the ADD, an XCHG of an added or exchanged line rewrites it in place
+    and a DEL of an exchanged line becomes a DEL of the original line.
+    count is the number of lines of the file before the first edit and
+    is only needed when a command refers to a line after an ADD.
+    """
+    def __init__(self, db: str, count: Optional[int]):
+        self.db = db
+        self.count = count
+        self.dels: Dict[int, bytes] = dict()
+        self.xchgs: Dict[int, Tuple[bytes, bytes]] = dict()
+        self.adds: List[bytes] = list()
+        self._deleted: List[int] = list()
+
+    def length(self) -> Optional[int]:
+        'Number of lines after the edit, None if count is unknown'
+        if self.count is None:
+            return None
+
+        return self.count - len(self.dels) + len(self.adds)
+
+    def _locate(self, lineno: int) -> Tuple[bool, int]:
+        """
+            Map a line of the edited file to (True, original line number)
+            or (False, index in adds)
+        """
+        if self.count is not None and self.count - len(self.dels) < lineno or self.adds:
+            if self.count is None:
+                raise cdifferror('{}: line count needed to merge edits after ADD'.format(self.db))
+            index = lineno - (self.count - len(self.dels)) - 1
+            if index >= len(self.adds):
+                raise cdifferror('{}: line {} past end of file'.format(self.db, lineno))
+            if index >= 0:
+                return False, index
+        # Smallest original line with lineno lines not deleted up to it
+        original = lineno
+        while True:
+            shifted = lineno + bisect.bisect_right(self._deleted, original)
+            if shifted == original:
+                return True, original
+            original = shifted
+
+    def merge(self, edit: cdiffedit) -> None:
+        """
+            Apply edit on top of the merged edits
+        """
+        targets = [(lineno, self._locate(lineno))
+                   for lineno in sorted(set(edit.dels) | set(edit.xchgs))]
+        dropped: Set[int] = set()
+        for lineno, (original, where) in targets:
+            deleting = lineno in edit.dels
+            prefix = edit.dels[lineno] if deleting else edit.xchgs[lineno][0]
+            if original:
+                current = self.xchgs[where][1] if where in self.xchgs else None
+            else:
+                current = self.adds[where]
+            if current is not None and not current.startswith(prefix):
+                raise cdifferror("{}: can't merge {} at line {}".format(
+                    self.db, 'DEL' if deleting else 'XCHG', lineno))
+            if not original:
+                if deleting:
+                    dropped.add(where)
+                else:
+                    self.adds[where] = edit.xchgs[lineno][1]
+            elif deleting:
+                self.dels[where] = self.xchgs.pop(where)[0] if where in self.xchgs else prefix
+            elif where in self.xchgs:
+                self.xchgs[where] = (self.xchgs[where][0], edit.xchgs[lineno][1])
+            else:
+                self.xchgs[where] = edit.xchgs[lineno]
+        self.adds = [add for index, add in enumerate(self.adds) if index not in dropped]
+        self.adds += edit.adds
+        self._deleted = sorted(self.dels)
+
+    def empty(self) -> bool:
+        return not (self.dels or self.xchgs or self.adds)
+
+    def script(self) -> Iterator[bytes]:
+        if self.empty():
+            return
+        yield b'OPEN ' + self.db.encode('utf-8') + b'\n'
+        for lineno in sorted(set(self.dels) | set(self.xchgs)):
+            if lineno in self.dels:
+                yield b'DEL %d %s\n' % (lineno, self.dels[lineno])
+            else:
+                yield b'XCHG %d %s %s\n' % ((lineno,) + self.xchgs[lineno])
+        for add in self.adds:
+            yield b'ADD ' + add + b'\n'
+        yield b'CLOSE\n'
+
+
+def compactscripts(scripts: Iterable[Iterable[bytes]],
+                   basecounts: Optional[Dict[str, int]] = None) -> Iterator[bytes]:
+    """
+        Yields the lines of one cdiff script with the same effect as
+        applying scripts in order. Edits of a file are merged until a
+        MOVE or UNLINK of it, edits of files that are unlinked later are
+        dropped. basecounts maps every file of the database the scripts
+        apply to to its line count, without it merging edits after an
+        ADD to the same file raises cdifferror
+    """
+    counts: Dict[str, Optional[int]] = dict(basecounts or dict())
+    absent: Set[str] = set()
+    pending: Dict[str, _composite] = dict()
+
+    def exists(db: str) -> bool:
+        return db not in absent and (basecounts is None or db in counts)
+
+    def flush(db: str) -> Iterator[bytes]:
+        composite = pending.pop(db, None)
+        if composite is None or composite.empty():
+            return
+        yield from composite.script()
+        counts[db] = composite.length()
+        absent.discard(db)
+
+    for script in scripts:
+        for operation in parsescript(script):
+            if isinstance(operation, cdiffedit):
+                if operation.db not in pending:
+                    count = counts.get(operation.db) if exists(operation.db) else 0
+                    pending[operation.db] = _composite(operation.db, count)
+                pending[operation.db].merge(operation)
+            elif isinstance(operation, cdiffmove):
+                yield from flush(operation.src)
+                yield from flush(operation.dst)
+                yield b'MOVE %s %s %d %s %d %s\n' % (
+                    operation.src.encode('utf-8'), operation.dst.encode('utf-8'),
+                    operation.start, operation.startstr, operation.end, operation.endstr)
+                moved = operation.end - operation.start + 1
+                srccount = counts.get(operation.src)
+                dstcount = counts.get(operation.dst) if exists(operation.dst) else 0
+                counts[operation.src] = None if srccount is None else srccount - moved
+                counts[operation.dst] = None if dstcount is None else dstcount + moved
+                absent.discard(operation.dst)
+            else:
+                pending.pop(operation.db, None)
+                if exists(operation.db):
+                    yield b'UNLINK ' + operation.db.encode('utf-8') + b'\n'
+                absent.add(operation.db)
+                counts[operation.db] = 0
+    for db in list(pending):
+        yield from flush(db)
+
+
+def infohash(filename: str, expected: str) -> str:
+    """
+        Hash a file the way the .info line expects it, SHA-256 for 64
+        character hashes and MD5 otherwise
+    """
+    hashobject = hashlib.sha256() if len(expected) == 64 else hashlib.md5()
+    with open(filename, 'rb') as dbfile:
+        for chunk in iter(lambda: dbfile.read(CHUNKSIZE), b''):
+            hashobject.update(chunk)
+
+    return hashobject.hexdigest()
+
+
+class clamavcdiff:
+    """
+    Apply a chain of ClamAV-Diff files to an extracted database directory.
+
+    The edits of consecutive cdiffs to the same file are chained as
+    generators, so every file is read and written once per chain however
+    many cdiffs touch it, and only the edit commands are kept in memory.
+    """
+    def __init__(self, directory: str):
+        if not os.path.isdir(directory):
+            raise NotADirectoryError(directory)
+        self.directory = directory
+        self._pending: Dict[str, List[cdiffedit]] = dict()
+
+    def _path(self, db: str) -> str:
+        return os.path.join(self.directory, db)
+
+    def _flush(self, db: str) -> None:
+        edits = self._pending.pop(db, None)
+        if not edits:
+            return
+        path = self._path(db)
+        tempfd, temppath = mkstempfor(path)
+        try:
+            with os.fdopen(tempfd, 'wb') as output:
+                if os.path.exists(path):
+                    with open(path, 'rb') as dbfile:
+                        self._write(output, edits, dbfile)
+                else:
+                    self._write(output, edits, iter(()))
+            os.replace(temppath, path)
+        except BaseException:
+            os.unlink(temppath)
+            raise
+
+    def _write(self, output: Any, edits: List[cdiffedit],
+               lines: Iterable[bytes]) -> None:
+        for edit in edits:
+            lines = edit.apply(lines)
+        output.writelines(lines)
+
+    def _move(self, move: cdiffmove) -> None:
+        'Move the lines to the end of dst, both files change or neither'
+        self._flush(move.src)
+        self._flush(move.dst)
+        srcfd, srcpath = mkstempfor(self._path(move.src))
+        dstfd, dstpath = mkstempfor(self._path(move.dst))
+        try:
+            with open(self._path(move.src), 'rb') as srcfile, \
+                    os.fdopen(srcfd, 'wb') as output, os.fdopen(dstfd, 'wb') as dstfile:
+                if os.path.exists(self._path(move.dst)):
+                    with open(self._path(move.dst), 'rb') as existing:
+                        for chunk in iter(lambda: existing.read(CHUNKSIZE), b''):
+                            dstfile.write(chunk)
+                lineno = 0
+                for line in srcfile:
+                    lineno += 1
+                    if lineno == move.start and not line.startswith(move.startstr):
+                        raise cdifferror("{}: can't apply MOVE at line {}".format(move.src, lineno))
+                    if lineno == move.end and not line.startswith(move.endstr):
+                        raise cdifferror("{}: can't apply MOVE at line {}".format(move.src, lineno))
+                    if move.start <= lineno <= move.end:
+                        dstfile.write(line)
+                    else:
+                        output.write(line)
+                if lineno < move.end:
+                    raise cdifferror('{}: MOVE past end of file'.format(move.src))
+            os.replace(dstpath, self._path(move.dst))
+            os.replace(srcpath, self._path(move.src))
+        except BaseException:
+            for path in (srcpath, dstpath):
+                if os.path.exists(path):
+                    os.unlink(path)
+            raise
+
+    def applyscripts(self, scripts: Iterable[Iterable[bytes]]) -> None:
+        """
+            Apply cdiff scripts, given as iterables of lines, in order
+        """
+        for script in scripts:
+            for operation in parsescript(script):
+                if isinstance(operation, cdiffedit):
+                    self._pending.setdefault(operation.db, list()).append(operation)
+                elif isinstance(operation, cdiffmove):
+                    self._move(operation)
+                else:
+                    pending = self._pending.pop(operation.db, None)
+                    if os.path.exists(self._path(operation.db)):
+                        os.unlink(self._path(operation.db))
+                    elif pending is None:
+                        raise cdifferror("{}: can't UNLINK a missing file".format(operation.db))
+        for db in list(self._pending):
+            self._flush(db)
+
+    def apply(self, cdiffs: List[Union[str, clamavfile]],
+              verify: bool = True) -> None:
+        """
+            Apply ClamAV-Diff files in version order. With verify every
+            cdiff must have a valid signature and the versions must follow
+            each other without gaps
+        """
+        clamobjects = loadchain(cdiffs, verify)
+        self.applyscripts(scriptlines(clamobject) for clamobject in clamobjects)
+
+    def verifyinfo(self, infoname: str) -> List[str]:
+        """
+            Check every file listed in the .info file infoname against its
+            size and hash. Returns the names that are missing or differ
+        """
+        failed: List[str] = list()
+        with open(self._path(infoname), 'r', encoding='utf-8') as infofile:
+            for number, line in enumerate(infofile):
+                fields = line.rstrip('\r\n').split(':')
+                if number == 0 or fields[0] == 'DSIG' or len(fields) != 3:
+                    continue
+                name, size, expected = fields
+                path = self._path(name)
+                if not os.path.exists(path) or os.path.getsize(path) != int(size) \
+                        or infohash(path, expected) != expected.lower():
+                    failed.append(name)
+
+        return failed
@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+
+# Resumable signature verification of growing ClamAV files
+# Copyright 2021 Thomas Karlsson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import ctypes
+import ctypes.util
+import hashlib
+import tempfile
+from typing import List, Dict, Tuple, Optional, Any
+from .clamavfile import clamavfile, CHUNKSIZE
+
+CHECKPOINTINTERVAL = 16 * 1024 * 1024
+# Checkpoints kept in the sidecar, older ones are dropped
+KEEP = 4
+# Bytes at the start of the file and before a checkpoint that must be
+# unchanged to resume from it
+CHECKLENGTH = 4096
+# The cdiff signature is somewhere in the last HOLDBACK bytes, so a
+# cdiff without one is only hashed up to there
+HOLDBACK = 350
+# Room for MD5_CTX and SHA256_CTX on any ABI, only the struct is saved
+CTXSIZE = 256
+FORMAT = 2
+
+# Function prefix, digest size and the size of the OpenSSL struct
+_DIGESTS = {'md5': ('MD5', 16, 92), 'sha256': ('SHA256', 32, 112)}
+
+
+def _loadlibcrypto() -> Optional[Any]:
+    """
+        hashlib objects can be copied but not saved, so hash with
+        OpenSSL's MD5_CTX and SHA256_CTX whose state is plain memory
+    """
+    libname = ctypes.util.find_library('crypto')
+    if libname is None:
+        return None
+    try:
+        libcrypto = ctypes.CDLL(libname)
+        libcrypto.OpenSSL_version_num.restype = ctypes.c_ulong
+        for name, _, _ in _DIGESTS.values():
+            getattr(libcrypto, name + '_Init').argtypes = [ctypes.c_void_p]
+            getattr(libcrypto, name + '_Update').argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                                                             ctypes.c_size_t]
+            getattr(libcrypto, name + '_Final').argtypes = [ctypes.c_char_p, ctypes.c_void_p]
+    except (OSError, AttributeError):
+        return None
+
+    return libcrypto
+
+
+_libcrypto = _loadlibcrypto()
+# Saved states only fit the OpenSSL build, struct layout and byte order
+# they came from
+LIBRARY = '{}-{:x}-{}-{}-{}'.format(
+    ctypes.util.find_library('crypto'),
+    _libcrypto.OpenSSL_version_num() if _libcrypto is not None else 0,
+    '-'.join(str(structsize) for _, _, structsize in _DIGESTS.values()),
+    sys.byteorder, ctypes.sizeof(ctypes.c_void_p))
+
+
+class statehash:
+    """
+    MD5 or SHA-256 whose state can be saved with state() and continued
+    with statehash(kind, state)
+    """
+    def __init__(self, kind: str, state: Optional[bytes] = None):
+        if _libcrypto is None:
+            raise RuntimeError('Saving hash state needs libcrypto')
+        self.kind = kind
+        name, self.digestsize, self.structsize = _DIGESTS[kind]
+        self._update = getattr(_libcrypto, name + '_Update')
+        self._final = getattr(_libcrypto, name + '_Final')
+        self._ctx = ctypes.create_string_buffer(CTXSIZE)
+        if state is None:
+            getattr(_libcrypto, name + '_Init')(self._ctx)
+        else:
+            if len(state) != self.structsize:
+                raise ValueError('Saved {} state has the wrong size'.format(kind))
+            ctypes.memmove(self._ctx, state, self.structsize)
+
+    def update(self, data: bytes) -> None:
+        self._update(self._ctx, data, len(data))
+
+    def state(self) -> bytes:
+        return self._ctx.raw[:self.structsize]
+
+    def digest(self) -> bytes:
+        'Digest of the data so far, the state can still be updated'
+        ctx = ctypes.create_string_buffer(self._ctx.raw, CTXSIZE)
+        output = ctypes.create_string_buffer(self.digestsize)
+        self._final(output, ctx)
+
+        return output.raw
+
+
+def _selftest() -> bool:
+    """
+        Save and continue each digest once and compare it with hashlib,
+        the struct sizes are assumed and nothing else checks them
+    """
+    data = bytes(range(256)) * 7
+    for kind, (_, _, structsize) in _DIGESTS.items():
+        first = statehash(kind)
+        first.update(data[:1000])
+        if first._ctx.raw[structsize:].strip(b'\x00'):
+            # OpenSSL wrote past the struct
+            return False
+        second = statehash(kind, first.state())
+        second.update(data[1000:])
+        if second.digest() != hashlib.new(kind, data).digest():
+            return False
+
+    return True
+
+
+if _libcrypto is not None and not _selftest():
+    # Verify every file from the start instead
+    _libcrypto = None
+
+
+def available() -> bool:
+    return _libcrypto is not None
+
+
+def _fileidentity(fileinfo: os.stat_result) -> Dict[str, int]:
+    return {'dev': fileinfo.st_dev, 'ino': fileinfo.st_ino, 'size': fileinfo.st_size,
+            'mtime': fileinfo.st_mtime_ns}
+
+
+class clamavcheckpoint:
+    """
+    Verify a ClamAV file that is still being downloaded or appended to
+    without hashing it from the start every time.
+
+    Every interval bytes the hash state and offset are saved to the
+    sidecar checkpointfile (default filename + '.ckpt') together with the
+    device, inode, size and mtime of the file. The next verify continues
+    from the last checkpoint only when the file is the same inode and has
+    grown since, or is unchanged, and its first CHECKLENGTH bytes and the
+    CHECKLENGTH bytes before the checkpoint still match. Anything else is
+    hashed from the start. The bytes that were hashed before are trusted,
+    so the file must only be appended to while it is checkpointed.
+    verify returns True as soon as the complete file has a valid
+    signature. Without libcrypto every verify hashes the whole file like
+    verifysignature.
+    """
+    def __init__(self, filename: str, checkpointfile: Optional[str] = None,
+                 interval: int = CHECKPOINTINTERVAL):
+        self.filename = filename
+        self.checkpointfile = checkpointfile or filename + '.ckpt'
+        self.interval = interval
+        self.resumable = available()
+        self.resumedfrom = 0
+        self.hashed = 0
+        self.complete = False
+
+    def _load(self, kind: str, fileinfo: os.stat_result) -> List[Dict[str, Any]]:
+        try:
+            with open(self.checkpointfile) as sidecar:
+                saved = json.load(sidecar)
+        except (OSError, ValueError):
+            return list()
+        if not isinstance(saved, dict) or saved.get('format') != FORMAT or \
+                saved.get('library') != LIBRARY or saved.get('kind') != kind:
+            return list()
+        if saved.get('file') != _fileidentity(fileinfo):
+            previous = saved.get('file')
+            # Appended to: same inode and larger, _check compares the
+            # start and the bytes before the checkpoint
+            if not isinstance(previous, dict) or previous.get('dev') != fileinfo.st_dev or \
+                    previous.get('ino') != fileinfo.st_ino or \
+                    not isinstance(previous.get('size'), int) or \
+                    fileinfo.st_size <= previous['size']:
+                return list()
+            checkpoints = saved.get('checkpoints', list())
+            return [checkpoint for checkpoint in checkpoints
+                    if checkpoint.get('offset', 0) <= previous['size']]
+
+        return saved.get('checkpoints', list())
+
+    def _save(self, kind: str, fileinfo: os.stat_result,
+              checkpoints: List[Dict[str, Any]]) -> None:
+        directory = os.path.dirname(os.path.abspath(self.checkpointfile))
+        tempfd, temppath = tempfile.mkstemp(dir=directory, prefix='.ckpt')
+        try:
+            with os.fdopen(tempfd, 'w') as output:
+                json.dump({'format': FORMAT, 'library': LIBRARY, 'kind': kind,
+                           'file': _fileidentity(fileinfo),
+                           'checkpoints': checkpoints[-KEEP:]}, output)
+            os.replace(temppath, self.checkpointfile)
+        except BaseException:
+            os.unlink(temppath)
+            raise
+
+    @staticmethod
+    def _check(clamfile: Any, offset: int) -> str:
+        'SHA-256 of the first and the last CHECKLENGTH bytes before offset'
+        head = min(CHECKLENGTH, offset)
+        clamfile.seek(0)
+        hashobject = hashlib.sha256(clamfile.read(head))
+        start = max(head, offset - CHECKLENGTH)
+        clamfile.seek(start)
+        hashobject.update(clamfile.read(offset - start))
+
+        return hashobject.hexdigest()
+
+    def _region(self, clamobject: clamavfile) -> Tuple[str, int, int]:
+        """
+            Returns (hash kind, first byte, end of the bytes that can be
+            hashed now) and sets complete when end is the end of the
+            signed data
+        """
+        if clamobject.magicheader == 'ClamAV-VDB':
+            self.complete = clamobject.filesize > clamobject.headersize()
+            return 'md5', clamobject.headersize(), clamobject.filesize
+        self.complete = clamobject.signature() != ''
+        if self.complete:
+            return 'sha256', 0, clamobject.filesize - clamobject.footersize()
+
+        return 'sha256', 0, max(0, clamobject.filesize - HOLDBACK)
+
+    def verify(self) -> bool:
+        """
+            Hash what was added since the last call and check the
+            signature when the file is complete
+        """
+        clamobject = clamavfile(self.filename)
+        if not self.resumable or clamobject.magicheader not in ('ClamAV-VDB', 'ClamAV-Diff') or \
+                clamobject.iscld():
+            self.hashed = clamobject.filesize
+            return clamobject.verifysignature()
+        kind, start, end = self._region(clamobject)
+        fileinfo = clamobject.fileinfo
+        checkpoints = self._load(kind, fileinfo)
+        with open(self.filename, 'rb') as clamfile:
+            hashobject = None
+            while checkpoints:
+                checkpoint = checkpoints[-1]
+                try:
+                    if start < checkpoint['offset'] <= end and \
+                            self._check(clamfile, checkpoint['offset']) == checkpoint['check']:
+                        hashobject = statehash(kind, bytes.fromhex(checkpoint['state']))
+                        break
+                except (KeyError, TypeError, ValueError):
+                    pass
+                checkpoints.pop()
+            if hashobject is None:
+                hashobject = statehash(kind)
+                position = start
+            else:
+                position = checkpoint['offset']
+            self.resumedfrom = position
+            self.hashed = end - position
+            clamfile.seek(position)
+            nextcheckpoint = position + self.interval
+            while position < end:
+                chunk = clamfile.read(min(CHUNKSIZE, end - position, nextcheckpoint - position))
+                if not chunk:
+                    break
+                hashobject.update(chunk)
+                position += len(chunk)
+                if position == nextcheckpoint or position == end:
+                    checkpoints.append({'offset': position, 'state': hashobject.state().hex(),
+                                        'check': self._check(clamfile, position)})
+                    clamfile.seek(position)
+                    nextcheckpoint = position + self.interval
+                    self._save(kind, fileinfo, checkpoints)
+        if not self.complete:
+            return False
+
+        return clamobject._checkdigest(hashobject.digest())
+
+    def remove(self) -> None:
+        'Delete the sidecar, for when the file is verified or gone'
+        try:
+            os.unlink(self.checkpointfile)
+        except FileNotFoundError:
+            pass
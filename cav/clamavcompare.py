@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+
+# Compare the signatures of two ClamAV databases within a memory limit
+# Copyright 2021 Thomas Karlsson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import heapq
+import hashlib
+import tempfile
+from typing import List, Dict, Tuple, Optional, Iterator, Iterable, Any
+from .clamavfile import clamavfile, CHUNKSIZE
+
+ADDED = '+'
+REMOVED = '-'
+DEFAULTMEMORY = 64 * 1024 * 1024
+# Approximate cost of a bytes object and its list slot besides the data
+LINEOVERHEAD = 41
+# and of its slot in a set
+SETOVERHEAD = 32
+
+
+class memberchange:
+    'Lines added to and removed from one tar member'
+    def __init__(self, name: str):
+        self.name = name
+        self.added = 0
+        self.removed = 0
+        self.oldlines = 0
+        self.newlines = 0
+        self.identical = False
+
+    def __repr__(self) -> str:
+        return '{}: +{} -{}'.format(self.name, self.added, self.removed)
+
+
+class _lines:
+    'Lines of one tar member, in memory until spilled to sorted runs'
+    def __init__(self, name: str):
+        self.name = name
+        self.buffer: List[bytes] = list()
+        self.cost = 0
+        self.count = 0
+        self.runs: List[str] = list()
+        self.digest = hashlib.md5()
+
+    def spill(self, directory: str) -> int:
+        'Write the buffer as a sorted run, returns the memory released'
+        self.buffer.sort()
+        runfd, runpath = tempfile.mkstemp(dir=directory, suffix='.run')
+        with os.fdopen(runfd, 'wb', buffering=CHUNKSIZE) as run:
+            for line in self.buffer:
+                run.write(line + b'\n')
+        self.runs.append(runpath)
+        released = self.cost
+        self.buffer = list()
+        self.cost = 0
+
+        return released
+
+    def sortedlines(self) -> Iterator[bytes]:
+        self.buffer.sort()
+        if not self.runs:
+            return iter(self.buffer)
+        return heapq.merge(self.buffer, *(_readrun(runpath) for runpath in self.runs))
+
+
+def _readrun(runpath: str) -> Iterator[bytes]:
+    with open(runpath, 'rb', buffering=CHUNKSIZE) as run:
+        for line in run:
+            yield line[:-1]
+
+
+class clamavcompare:
+    """
+    Streaming comparison of the members of two ClamAV-VDB files, for
+    example two versions of daily.cvd. Both files are decompressed once.
+    Lines are kept in memory up to about memory bytes, past that the
+    largest member is sorted and spilled to a run file in directory and
+    the runs are merged when the members are joined.
+
+    Members with the same MD5 in both files are not sorted at all, and
+    members that fit in memory twice only have the differing lines
+    sorted.
+    """
+    def __init__(self, old: clamavfile, new: clamavfile,
+                 memory: int = DEFAULTMEMORY, directory: Optional[str] = None):
+        self.old = old
+        self.new = new
+        self.memory = memory
+        self.directory = directory
+        self.members: Dict[str, memberchange] = dict()
+        self.spills = 0
+        self._used = 0
+
+    def _read(self, clamobject: clamavfile, sides: List[Dict[str, _lines]],
+              tempdir: str) -> Dict[str, _lines]:
+        'Read every member of clamobject into _lines'
+        members: Dict[str, _lines] = dict()
+        sides.append(members)
+        for tarinfo, stream in clamobject.iteratemembers():
+            lines = members[tarinfo.name] = _lines(tarinfo.name)
+            tail = b''
+            for chunk in iter(lambda: stream.read(CHUNKSIZE), b''):
+                lines.digest.update(chunk)
+                chunk = chunk.split(b'\n')
+                chunk[0] = tail + chunk[0]
+                tail = chunk.pop()
+                self._add(lines, chunk, sides, tempdir)
+            if tail:
+                self._add(lines, [tail], sides, tempdir)
+
+        return members
+
+    def _add(self, lines: _lines, chunk: List[bytes],
+             sides: List[Dict[str, _lines]], tempdir: str) -> None:
+        cost = sum(map(len, chunk)) + LINEOVERHEAD * len(chunk)
+        lines.buffer += chunk
+        lines.cost += cost
+        lines.count += len(chunk)
+        self._used += cost
+        while self._used > self.memory:
+            largest = max((member for side in sides for member in side.values()),
+                          key=lambda member: member.cost)
+            if not largest.cost:
+                break
+            self._used -= largest.spill(tempdir)
+            self.spills += 1
+
+    def differences(self) -> Iterator[Tuple[str, str, bytes]]:
+        """
+            Yields (member, ADDED or REMOVED, line) for every line that
+            differs, by member name and then in sorted line order. members
+            holds a memberchange per member once the generator is done
+        """
+        self.members = dict()
+        self.spills = 0
+        self._used = 0
+        with tempfile.TemporaryDirectory(dir=self.directory, prefix='cavcompare') as tempdir:
+            sides: List[Dict[str, _lines]] = list()
+            oldmembers = self._read(self.old, sides, tempdir)
+            newmembers = self._read(self.new, sides, tempdir)
+            empty = _lines('')
+            for name in sorted(set(oldmembers) | set(newmembers)):
+                old = oldmembers.get(name, empty)
+                new = newmembers.get(name, empty)
+                change = self.members[name] = memberchange(name)
+                change.oldlines = old.count
+                change.newlines = new.count
+                if name in oldmembers and name in newmembers and \
+                        old.digest.digest() == new.digest.digest():
+                    change.identical = True
+                else:
+                    for sign, line in self._join(old, new):
+                        if sign == ADDED:
+                            change.added += 1
+                        else:
+                            change.removed += 1
+                        yield name, sign, line
+                # Release the member before the next one is joined
+                self._used -= old.cost + new.cost
+                oldmembers.pop(name, None)
+                newmembers.pop(name, None)
+
+    def _join(self, old: _lines, new: _lines) -> Iterator[Tuple[str, bytes]]:
+        """
+            Differences of one member. When both sides are in memory and
+            there is room for sets, only the lines that differ are sorted
+        """
+        if not old.runs and not new.runs and \
+                self._used + SETOVERHEAD * (old.count + new.count) <= self.memory:
+            oldset = set(old.buffer)
+            newset = set(new.buffer)
+            if len(oldset) == len(old.buffer) and len(newset) == len(new.buffer):
+                removed = sorted(oldset.difference(newset))
+                added = sorted(newset.difference(oldset))
+                del oldset, newset
+                return _join(removed, added)
+
+        return _join(old.sortedlines(), new.sortedlines())
+
+    def compare(self) -> Dict[str, memberchange]:
+        """
+            Returns a memberchange per member without keeping the lines
+        """
+        for _ in self.differences():
+            pass
+
+        return self.members
+
+    def write(self, output: Any) -> Dict[str, memberchange]:
+        """
+            Write the differences to the binary file object output as
+            member:+line and member:-line
+        """
+        for name, sign, line in self.differences():
+            output.write(b'%s:%s%s\n' % (name.encode('utf-8'), sign.encode('ascii'), line))
+
+        return self.members
+
+
+def _join(old: Iterable[bytes], new: Iterable[bytes]) -> Iterator[Tuple[str, bytes]]:
+    'Merge-join two sorted line streams, duplicates count separately'
+    sentinel = None
+    old = iter(old)
+    new = iter(new)
+    oldline = next(old, sentinel)
+    newline = next(new, sentinel)
+    while oldline is not None and newline is not None:
+        if oldline == newline:
+            oldline = next(old, sentinel)
+            newline = next(new, sentinel)
+        elif oldline < newline:
+            yield REMOVED, oldline
+            oldline = next(old, sentinel)
+        else:
+            yield ADDED, newline
+            newline = next(new, sentinel)
+    while oldline is not None:
+        yield REMOVED, oldline
+        oldline = next(old, sentinel)
+    while newline is not None:
+        yield ADDED, newline
+        newline = next(new, sentinel)
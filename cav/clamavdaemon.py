@@ -0,0 +1,398 @@
+#!/usr/bin/python3
+
+# Keep the verdicts of a mirror directory current and answer queries
+# Copyright 2021 Thomas Karlsson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import zlib
+import errno
+import socket
+import struct
+import tarfile
+import ctypes
+import ctypes.util
+import asyncio
+import argparse
+from typing import List, Dict, Tuple, Optional, Any
+from .clamavfile import clamavfile
+from .clamavcache import clamavcache
+from .clamavverify import EXTENSIONS
+
+SOCKET = 'clamavdaemon.sock'
+POLLINTERVAL = 5.0
+# Wait this long after the last event for a file before parsing it
+SETTLE = 0.05
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCHMASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | \
+    IN_DELETE_SELF | IN_MOVE_SELF
+_EVENT = struct.Struct('iIII')
+
+
+class _inotify:
+    'The inotify watch of one directory through libc'
+    def __init__(self, directory: str):
+        libname = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(libname, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCHMASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, 'inotify_add_watch failed', directory)
+
+    def read(self) -> Tuple[List[str], bool]:
+        """
+            Returns the names that changed since the last read and True
+            when everything has to be looked at again
+        """
+        names: List[str] = list()
+        rescan = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + _EVENT.size <= len(data):
+                _, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    rescan = True
+                elif name:
+                    names.append(os.fsdecode(name))
+
+        return names, rescan
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class fileentry:
+    'What the daemon knows about one file'
+    def __init__(self, name: str, identity: Tuple[int, int, int, int]):
+        self.name = name
+        self.identity = identity
+        self.clamobject: Optional[clamavfile] = None
+        self.ok: Optional[bool] = None
+        self.error: Optional[str] = None
+        self.checked = 0.0
+
+    def dict(self) -> Dict[str, Any]:
+        clamobject = self.clamobject
+        return {'name': self.name, 'ok': self.ok, 'error': self.error,
+                'size': self.identity[2], 'checked': self.checked,
+                'type': clamobject.filetype() if clamobject else None,
+                'version': clamobject.version() if clamobject else None,
+                'signatures': clamobject.signatures() if clamobject else None,
+                'builder': clamobject.builder() if clamobject else None}
+
+
+def _identity(fileinfo: os.stat_result) -> Tuple[int, int, int, int]:
+    return fileinfo.st_dev, fileinfo.st_ino, fileinfo.st_size, fileinfo.st_mtime_ns
+
+
+def _database(name: str) -> str:
+    'daily for daily.cvd, daily.cld and daily-123.cdiff'
+    base = os.path.splitext(name)[0]
+    if name.endswith('.cdiff'):
+        base = base.rpartition('-')[0]
+
+    return base
+
+
+class clamavdaemon:
+    """
+    Watch a mirror directory and keep the parsed header and signature
+    verdict of every CVD, CLD and cdiff file in memory.
+
+    Changes are picked up with inotify, or by comparing inode, size and
+    mtime every pollinterval seconds where inotify is missing or watch
+    is 'poll'. Only files whose identity changed are parsed and verified
+    again, with clamavfile.verify so the event loop keeps answering. The
+    optional clamavcache keeps verdicts across restarts.
+
+    Queries are lines on the Unix socket socketpath and every answer is
+    one JSON line:
+        status          all files
+        status NAME     one file
+        versions        the newest valid version of each database
+        ping
+    """
+    def __init__(self, directory: str, socketpath: str = SOCKET,
+                 cache: Optional[clamavcache] = None, watch: str = 'auto',
+                 pollinterval: float = POLLINTERVAL):
+        self.directory = directory
+        self.socketpath = socketpath
+        self.cache = cache
+        self.watch = watch
+        self.pollinterval = pollinterval
+        self.files: Dict[str, fileentry] = dict()
+        self.queries = 0
+        self.watching: Optional[str] = None
+        self._tasks: Dict[str, asyncio.Task] = dict()
+        self._inotify: Optional[_inotify] = None
+        self._poller: Optional[asyncio.Task] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._answers: Dict[str, bytes] = dict()
+        self._idle = asyncio.Event()
+
+    async def start(self) -> None:
+        if self.watch in ('auto', 'inotify'):
+            try:
+                self._inotify = _inotify(self.directory)
+            except OSError:
+                if self.watch == 'inotify':
+                    raise
+        loop = asyncio.get_running_loop()
+        if self._inotify is not None:
+            loop.add_reader(self._inotify.fd, self._events)
+            self.watching = 'inotify'
+        else:
+            self._poller = asyncio.ensure_future(self._poll())
+            self.watching = 'poll'
+        self.rescan()
+        if os.path.exists(self.socketpath):
+            os.unlink(self.socketpath)
+        self._server = await asyncio.start_unix_server(self._connection, self.socketpath)
+
+    async def serve_forever(self) -> None:
+        if self._server is None:
+            await self.start()
+        await self._server.serve_forever()
+
+    async def close(self) -> None:
+        if self._inotify is not None:
+            asyncio.get_running_loop().remove_reader(self._inotify.fd)
+            self._inotify.close()
+            self._inotify = None
+        if self._poller is not None:
+            self._poller.cancel()
+        for task in list(self._tasks.values()):
+            task.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            try:
+                os.unlink(self.socketpath)
+            except FileNotFoundError:
+                pass
+
+    async def settled(self) -> None:
+        'Wait until every changed file has been verified'
+        while self._tasks:
+            self._idle.clear()
+            await self._idle.wait()
+
+    def rescan(self) -> None:
+        'Look at every file in the directory and forget the removed ones'
+        try:
+            names = {entry.name for entry in os.scandir(self.directory)
+                     if entry.name.endswith(EXTENSIONS)}
+        except OSError:
+            names = set()
+        for name in set(self.files) - names:
+            self.changed(name)
+        for name in sorted(names):
+            self.changed(name)
+
+    def changed(self, name: str) -> None:
+        'name was written, moved or removed'
+        if not name.endswith(EXTENSIONS) or os.path.basename(name) != name:
+            return
+        try:
+            identity = _identity(os.stat(os.path.join(self.directory, name)))
+        except OSError:
+            identity = None
+        entry = self.files.get(name)
+        if entry is not None and entry.identity == identity:
+            return
+        self._answers.clear()
+        task = self._tasks.pop(name, None)
+        if task is not None:
+            task.cancel()
+        if identity is None:
+            self.files.pop(name, None)
+            return
+        self.files[name] = fileentry(name, identity)
+        self._tasks[name] = asyncio.ensure_future(self._check(self.files[name]))
+
+    async def _check(self, entry: fileentry) -> None:
+        try:
+            # Let writers that are not done yet finish
+            await asyncio.sleep(SETTLE)
+            path = os.path.join(self.directory, entry.name)
+            try:
+                clamobject = await clamavfile.open(path)
+                if clamobject.fileinfo is None or _identity(clamobject.fileinfo) != entry.identity:
+                    # Changed again, the event for that is on its way
+                    return
+                entry.ok = await clamobject.verify(self.cache)
+                entry.clamobject = clamobject
+                entry.error = None if entry.ok else 'signature mismatch'
+            except (OSError, ValueError, IndexError, EOFError, zlib.error,
+                    tarfile.TarError) as error:
+                entry.ok = False
+                entry.error = str(error) or type(error).__name__
+            entry.checked = time.time()
+            self._answers.clear()
+        finally:
+            if self._tasks.get(entry.name) is asyncio.current_task():
+                del self._tasks[entry.name]
+            if not self._tasks:
+                self._idle.set()
+
+    def _events(self) -> None:
+        names, rescan = self._inotify.read()
+        if rescan:
+            self.rescan()
+        for name in names:
+            self.changed(name)
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.pollinterval)
+            self.rescan()
+
+    def versions(self) -> Dict[str, int]:
+        'Newest verified version of every database'
+        newest: Dict[str, int] = dict()
+        for entry in self.files.values():
+            if entry.ok and entry.clamobject is not None:
+                database = _database(entry.name)
+                newest[database] = max(newest.get(database, 0), entry.clamobject.version())
+
+        return newest
+
+    def answer(self, query: str) -> bytes:
+        """
+            The JSON line for query. Answers to status and versions are
+            kept until a file changes, so repeated queries are dictionary
+            lookups. Only queries about known files are kept, so there is
+            at most one answer per file and two more
+        """
+        self.queries += 1
+        command, _, argument = query.strip().partition(' ')
+        argument = argument.strip()
+        key = '{} {}'.format(command, argument)
+        answer = self._answers.get(key)
+        if answer is not None:
+            return answer
+        cache = command in ('status', 'versions')
+        if command == 'ping':
+            result: Any = {'ok': True, 'watching': self.watching, 'files': len(self.files),
+                           'pending': len(self._tasks)}
+        elif command == 'status' and argument:
+            entry = self.files.get(argument)
+            cache = entry is not None
+            result = entry.dict() if entry is not None else {'error': 'no such file'}
+        elif command == 'status':
+            result = [self.files[name].dict() for name in sorted(self.files)]
+        elif command == 'versions' and not argument:
+            result = self.versions()
+        else:
+            return json.dumps({'error': 'unknown query'}).encode() + b'\n'
+        answer = json.dumps(result, separators=(',', ':')).encode() + b'\n'
+        if cache:
+            self._answers[key] = answer
+
+        return answer
+
+    async def _connection(self, reader: asyncio.StreamReader,
+                          writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write(self.answer(line.decode('utf-8', 'replace').strip()))
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def query(socketpath: str, text: str) -> Any:
+    'Send one query to a running daemon and return the decoded answer'
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socketpath)
+        client.sendall(text.encode() + b'\n')
+        with client.makefile('rb') as answer:
+            return json.loads(answer.readline())
+
+
+async def _run(arguments: argparse.Namespace) -> None:
+    cache = clamavcache(arguments.cache) if arguments.cache else None
+    daemon = clamavdaemon(arguments.directory, arguments.socket, cache, arguments.watch,
+                          arguments.interval)
+    await daemon.start()
+    try:
+        await daemon.serve_forever()
+    finally:
+        await daemon.close()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Verify a ClamAV mirror directory as it changes')
+    parser.add_argument('directory', nargs='?', default='.', help='mirror directory')
+    parser.add_argument('--socket', default=SOCKET, help='Unix socket for queries')
+    parser.add_argument('--cache', default=None, metavar='FILE',
+                        help='keep verification results in FILE across restarts')
+    parser.add_argument('--watch', choices=('auto', 'inotify', 'poll'), default='auto')
+    parser.add_argument('--interval', type=float, default=POLLINTERVAL,
+                        help='seconds between scans when polling')
+    parser.add_argument('--query', default=None, metavar='QUERY',
+                        help='ask a running daemon, for example "status" or "versions"')
+    arguments = parser.parse_args(argv)
+
+    if arguments.query is not None:
+        try:
+            print(json.dumps(query(arguments.socket, arguments.query)))
+        except OSError as error:
+            print('{}: {}'.format(arguments.socket, error), file=sys.stderr)
+            return 1
+        return 0
+    try:
+        asyncio.run(_run(arguments))
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -16,9 +16,30 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import DNS
 import json
-from typing import Dict, Union
+from typing import Dict, Union, Optional
+from . import clamavmetrics
+from .clamavresolver import clamavresolver, dnserror
+try:
+    import DNS
+except ImportError:
+    DNS = None
+
+DNSNAME = 'current.cvd.clamav.net'
+
+# Shared so the TTL cache covers every clamavdns object in the process
+_resolver: Optional[clamavresolver] = None
+
+
+def defaultresolver() -> clamavresolver:
+    """
+        Returns the process wide resolver using the system nameservers
+    """
+    global _resolver
+    if _resolver is None:
+        _resolver = clamavresolver()
+
+    return _resolver
 
 
 class clamavdns:
@@ -48,25 +69,65 @@ class clamavdns:
 
         return None
 
+    def parsetext(self, text: str) -> None:
+        """
+            Set the fields from a TXT record, raises ValueError unless it
+            has eight fields with numbers where numbers belong
+        """
+        fields = text.strip().strip('"').split(':')
+        if len(fields) != 8 or not fields[0]:
+            raise ValueError('Not a ClamAV version record: {!r}'.format(text))
+        numbers = [int(field) for field in fields[1:]]
+        if min(numbers) < 0:
+            raise ValueError('Negative number in version record: {!r}'.format(text))
+        self._clamversion = fields[0]
+        (self._mainversion, self._dailyversion, self._signaturedate,
+         self._versionwarning, self._functionalitylevel,
+         self._safebrowsingversion, self._bytecodeversion) = numbers
+
+        self._datadict()
+
+        return None
+
     def dnsquery(self) -> None:
-        clamavquery = DNS.DnsRequest("current.cvd.clamav.net",
-                                     qtype="TXT", protocol='udp')
+        if DNS is None:
+            raise RuntimeError('dnsquery needs pydns, use query instead')
+        metrics = clamavmetrics.active()
+        if metrics is not None:
+            started = clamavmetrics.clock()
+        clamavquery = DNS.DnsRequest(DNSNAME, qtype="TXT", protocol='udp')
         res = clamavquery.req()
+        if metrics is not None:
+            metrics.observe(clamavmetrics.DNS, clamavmetrics.clock() - started)
         # Get first answer
-        signaturedata = res.answers[0]['data'][0].split(b':')
-        self._clamversion = signaturedata[0].decode()
-        self._mainversion = int(signaturedata[1].decode())
-        self._dailyversion = int(signaturedata[2].decode())
-        self._signaturedate = int(signaturedata[3].decode())
-        self._versionwarning = int(signaturedata[4].decode())
-        self._functionalitylevel = int(signaturedata[5].decode())
-        self._safebrowsingversion = int(signaturedata[6].decode())
-        self._bytecodeversion = int(signaturedata[7].decode())
-
-        self._datadict()
+        self.parsetext(res.answers[0]['data'][0].decode())
 
         return None
 
+    async def query(self, name: str = DNSNAME,
+                    resolver: Optional[clamavresolver] = None) -> None:
+        """
+            Asynchronous lookup of the version record. The first TXT
+            record that parses is used, answers are cached by resolver
+            (default the shared defaultresolver) for their TTL
+        """
+        if resolver is None:
+            resolver = defaultresolver()
+        metrics = clamavmetrics.active()
+        if metrics is not None:
+            started = clamavmetrics.clock()
+        records = await resolver.txt(name)
+        if metrics is not None:
+            metrics.observe(clamavmetrics.DNS, clamavmetrics.clock() - started)
+        for record in records:
+            try:
+                self.parsetext(record)
+                return None
+            except ValueError:
+                continue
+
+        raise dnserror('No valid version record for {}'.format(name))
+
     def text(self) -> str:
         """
             Returns the same data as the DNS text
@@ -125,7 +186,7 @@ class clamavdns:
         """
             Returns True if the warning flag is 1, else False (0)
         """
-        if self._versionwarning == "1":
+        if str(self._versionwarning) == "1":
             return True
         else:
             return False
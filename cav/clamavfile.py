@@ -16,154 +16,747 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import io
 import os
 import re
+import mmap
+import stat
+import zlib
+import tarfile
+import tempfile
+import asyncio
 import hashlib
-from typing import List, Dict, Union, Any
+import weakref
+import concurrent.futures
+from typing import List, Dict, Tuple, Union, Any, BinaryIO, Callable, Iterator, Optional
+from . import clamavkeys
+from . import clamavmetrics
+from .clamavindex import clamavindex
+from .clamavhashdb import clamavhashdb
+
+CHUNKSIZE = 1024 * 1024
+GZIPMAGIC = b'\x1f\x8b'
+# Header MD5 and signature of CLD files, which are not signed
+UNSIGNED = 'X'
+
+# Work one job of the async API does before it goes back in line
+SLICESIZE = 16 * CHUNKSIZE
+ASYNCWORKERS = min(4, os.cpu_count() or 1)
+
+Destination = Union[str, os.PathLike, BinaryIO, Callable[[bytes], Any]]
+
+_executor: Optional[concurrent.futures.Executor] = None
+_workers = ASYNCWORKERS
+_slots: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]' = \
+    weakref.WeakKeyDictionary()
+
+
+def _regularfileno(fileobject: Any) -> Optional[int]:
+    'Return the file descriptor of fileobject if it is a regular file'
+    try:
+        fileno = fileobject.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG(os.fstat(fileno).st_mode):
+        return None
+
+    return fileno
+
+
+def _umask() -> int:
+    'The process umask, os.umask can only read it by setting it'
+    umask = os.umask(0o022)
+    os.umask(umask)
+
+    return umask
+
+
+# Read once, changing the umask from another thread is not safe
+UMASK = _umask()
+
+
+def mkstempfor(destination: str, suffix: str = '') -> Tuple[int, str]:
+    """
+        Temporary file next to destination for an atomic os.replace.
+        mkstemp creates it 0600, it gets the mode of an existing
+        destination or 0666 less the umask like a plain open would give
+    """
+    directory = os.path.dirname(os.path.abspath(destination))
+    tempfd, temppath = tempfile.mkstemp(dir=directory, suffix=suffix,
+                                        prefix='.' + os.path.basename(destination) + '.')
+    try:
+        mode = stat.S_IMODE(os.stat(destination).st_mode)
+    except OSError:
+        mode = 0o666 & ~UMASK
+    try:
+        os.chmod(temppath, mode)
+    except BaseException:
+        os.close(tempfd)
+        os.unlink(temppath)
+        raise
+
+    return tempfd, temppath
+
+
+def _kernelcopy(infd: int, offset: int, outfd: int, count: int) -> int:
+    """
+        Copy count bytes from infd at offset to the current position of
+        outfd without passing the data through userspace. Tries
+        copy_file_range first and sendfile second, returns the number of
+        bytes copied which is less than count if neither could finish
+    """
+    copied = 0
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        try:
+            while copied < count:
+                if method == 'copy_file_range':
+                    sent = os.copy_file_range(infd, outfd, count - copied,
+                                              offset + copied)
+                else:
+                    sent = os.sendfile(outfd, infd, offset + copied,
+                                       count - copied)
+                if sent == 0:
+                    break
+                copied += sent
+        except OSError:
+            continue
+        break
+
+    return copied
+
+
+def setexecutor(executor: Optional[concurrent.futures.Executor] = None,
+                workers: int = ASYNCWORKERS) -> None:
+    """
+        Run the async API in executor, at most workers jobs at a time per
+        event loop. Without executor a thread pool of workers is started
+        when it is first needed
+    """
+    global _executor, _workers
+    _executor = executor
+    _workers = workers
+    _slots.clear()
+
+
+def _asyncexecutor() -> concurrent.futures.Executor:
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(_workers, thread_name_prefix='clamavfile')
+
+    return _executor
+
+
+def _release(loop: asyncio.AbstractEventLoop, slots: asyncio.Semaphore) -> None:
+    try:
+        loop.call_soon_threadsafe(slots.release)
+    except RuntimeError:
+        # The loop is closed, nobody is waiting for the slot
+        pass
+
+
+async def _offload(function: Callable[..., Any], *args: Any,
+                   cleanup: Optional[Callable[[], Any]] = None) -> Any:
+    """
+        Run function in the executor once a slot is free. Callers that do
+        not get a slot wait in the event loop instead of queueing in the
+        executor. When the caller is cancelled a job that did not start is
+        dropped and cleanup runs once the job is done
+    """
+    loop = asyncio.get_running_loop()
+    slots = _slots.get(loop)
+    if slots is None:
+        slots = _slots[loop] = asyncio.Semaphore(_workers)
+    job = None
+    try:
+        await slots.acquire()
+        try:
+            job = _asyncexecutor().submit(function, *args)
+        except BaseException:
+            slots.release()
+            raise
+        # The slot is held until the thread is done, also when cancelled
+        job.add_done_callback(lambda _: _release(loop, slots))
+        return await asyncio.wrap_future(job)
+    except asyncio.CancelledError:
+        if cleanup is not None:
+            if job is None:
+                cleanup()
+            else:
+                job.add_done_callback(lambda _: cleanup())
+        raise
+
+
+async def _runsteps(steps: Iterator[Any]) -> None:
+    'Advance the generator steps in the executor, one job per step'
+    while await _offload(next, steps, False, cleanup=steps.close) is not False:
+        pass
 
 
 class clamavfile:
     'Extract metadata from ClamAV files'
     def __init__(self, clamfile: str):
-        if not os.path.exists(clamfile):
-            raise FileNotFoundError(clamfile)
-        self.filename = clamfile
-        self.fileinfo = self.fileinformation()
-        self.magicheader = self.readmagicheader()
-        self.header = self.readheader()
-        self.nstr = 118640995551645342603070001658453189751527774412027743746599405743243142607464144767361060640655844749760788890022283424922762488917565551002467771109669598189410434699034532232228621591089508178591428456220796841621637175567590476666928698770143328137383952820383197532047771780196576957695822641224262693037
-        self.estr = 100001027
-        self.pss_nstr = 14783905874077467090262228516557917570254599638376203532031989214105552847269687489771975792123442185817287694951949800908791527542017115600501303394778618535864845235700041590056318230102449612217458549016089313306591388590790796515819654102320725712300822356348724011232654837503241736177907784198700834440681124727060540035754699658105895050096576226753008596881698828185652424901921668758326578462003247906470982092298106789657211905488986281078346361469524484829559560886227198091995498440676639639830463593211386055065360288422394053998134458623712540683294034953818412458362198117811990006021989844180721010947
-        self.pss_estr = 100002053
-        self.pss_nbits = 2048
-
-    def savetofile(self, destinationfile: str) -> None:
-        with open(self.filename, 'rb') as clamfile:
-            if self.magicheader == 'ClamAV-VDB':
-                clamfile.read(self.headersize())
-                with open(destinationfile, 'wb') as extractfile:
-                    extractfile.write(clamfile.read())
-            if self.magicheader == 'ClamAV-Diff':
-                clamfile.read(self.headersize())
+        self.filename: Optional[str] = clamfile
+        self._data: Optional[Any] = None
+        self._setup()
+        with open(clamfile, 'rb') as filehandle:
+            self.fileinfo: Optional[os.stat_result] = os.fstat(filehandle.fileno())
+            if self.fileinfo.st_size == 0:
+                self._parse(b'')
+            else:
+                with mmap.mmap(filehandle.fileno(), 0,
+                               access=mmap.ACCESS_READ) as filedata:
+                    self._parse(filedata)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, name: Optional[str] = None) -> 'clamavfile':
+        """
+            Parse a ClamAV file that is already in memory. name is only
+            used as the filename attribute, nothing is read from disk
+        """
+        clamobject = cls.__new__(cls)
+        clamobject.filename = name
+        clamobject.fileinfo = None
+        clamobject._data = data
+        clamobject._setup()
+        clamobject._parse(data)
+
+        return clamobject
+
+    @classmethod
+    def from_fileobj(cls, fileobject: BinaryIO,
+                     name: Optional[str] = None) -> 'clamavfile':
+        """
+            Parse a ClamAV file from a binary file object. Regular files are
+            mapped into memory, anything else is read from its current
+            position
+        """
+        fileno = _regularfileno(fileobject)
+        if fileno is not None and os.fstat(fileno).st_size:
+            data: Any = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        else:
+            data = fileobject.read()
+
+        return cls.from_bytes(data, name or getattr(fileobject, 'name', None))
+
+    @classmethod
+    async def open(cls, clamfile: str) -> 'clamavfile':
+        'clamavfile(clamfile) without blocking the event loop'
+        return await _offload(cls, clamfile)
+
+    def _setup(self) -> None:
+        self.nstr = clamavkeys.CLAMAVKEY.n
+        self.estr = clamavkeys.CLAMAVKEY.e
+        self.pss_nstr = clamavkeys.CLAMAVPSSKEY.n
+        self.pss_estr = clamavkeys.CLAMAVPSSKEY.e
+        self.pss_nbits = clamavkeys.CLAMAVPSSKEY.nbits
+        self.keynames: Optional[List[str]] = None
+        self._index: Optional[clamavindex] = None
+
+    def _parse(self, filedata: Any) -> None:
+        'Parse magic, header and footer from the whole file in filedata'
+        self.filesize = len(filedata)
+        self.magicheader = self.readmagicheader(filedata[:12])
+        self.header = self.readheader(filedata)
+        # CVD bodies are gzipped, CLD bodies usually a plain tar
+        self.compressed = filedata[self.headersize():self.headersize() + 2] == GZIPMAGIC
+
+    def openraw(self) -> BinaryIO:
+        """
+            Returns a binary file object at the start of the file, from
+            disk or from memory for from_bytes/from_fileobj objects
+        """
+        if self._data is not None:
+            return io.BytesIO(self._data)
+
+        return open(self.filename, 'rb')
+
+    def savetofile(self, destinationfile: Destination) -> int:
+        """
+            Extract the data part of the file to destinationfile, which can
+            be a path, a writable binary file object or a callable that
+            receives the data in chunks. Returns the number of bytes written
+        """
+        if self.magicheader not in ('ClamAV-VDB', 'ClamAV-Diff'):
+            return 0
+        with self.openraw() as clamfile:
+            if isinstance(destinationfile, (str, bytes, os.PathLike)):
                 with open(destinationfile, 'wb') as extractfile:
-                    extractfile.write(clamfile.read(self.datasize()))
-
-    def _chardecode(self, onechar: str) -> int:
-        chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789+/'
-        for i in range(0, 64):
-            if chars[i] == onechar:
-                return i
-
-        return -1
-
-    def _decodesignature(self, signaturestring, e, n) -> str:
-        counter = 0
-        added = 0
-        for onechar in signaturestring:
-            decoded = self._chardecode(onechar)
-    #        /* c = a * 2**d */
-            prod = decoded * pow(2, 6 * counter)
-            added = prod + added
-            counter += 1
-        # /* plain = cipher^e mod n */
-        plainmod = pow(added, e, n)
-
-        return format(plainmod, "02x")
-
-    def _stringtolist(self, instr: str) -> List[str]:
-        return [(instr[i:i+2]) for i in range(0, len(instr), 2)]
-
-    def verifysignature(self) -> bool:
-        md5object = hashlib.md5()
-        sha256object = hashlib.sha256()
-        if self.signature == '':
+                    return self._copydata(clamfile, extractfile)
+            return self._copydata(clamfile, destinationfile)
+
+    def _copydata(self, clamfile: BinaryIO, destination: Destination) -> int:
+        'Copy datasize() bytes after the header in bounded chunks'
+        offset = self.headersize()
+        length = self.datasize()
+        copied = 0
+        if hasattr(destination, 'write'):
+            infd = _regularfileno(clamfile)
+            outfd = _regularfileno(destination)
+            if infd is not None and outfd is not None:
+                destination.flush()
+                copied = _kernelcopy(infd, offset, outfd, length)
+                destination.seek(os.lseek(outfd, 0, os.SEEK_CUR))
+            write = destination.write
+        else:
+            write = destination
+        clamfile.seek(offset + copied)
+        while copied < length:
+            chunk = clamfile.read(min(CHUNKSIZE, length - copied))
+            if not chunk:
+                break
+            write(chunk)
+            copied += len(chunk)
+
+        return copied
+
+    def index(self, indexfile: Optional[str] = None) -> clamavindex:
+        """
+            Returns the seek point index of the tar body, loaded from or
+            saved to the sidecar file indexfile (default filename + .idx)
+        """
+        if self._index is None or (indexfile is not None and
+                                   indexfile != self._index.indexfile):
+            self._index = clamavindex(self, indexfile)
+
+        return self._index
+
+    def iscld(self) -> bool:
+        """
+            True for ClamAV-VDB files written by freshclam after applying
+            cdiffs, which have a plain tar body, or a gzipped one marked
+            UNSIGNED. A gzipped body with an empty signature is a broken
+            CVD and not a CLD
+        """
+        return self.magicheader == 'ClamAV-VDB' and \
+            (not self.compressed or self.signature() == UNSIGNED)
+
+    def _opentar(self) -> tarfile.TarFile:
+        'Random access to the plain tar body of a CLD'
+        clamfile = self.openraw()
+        clamfile.seek(self.headersize())
+
+        return tarfile.open(fileobj=clamfile, mode='r:')
+
+    def members(self) -> List[str]:
+        """
+            Returns the names of the files in the tar body
+        """
+        if not self.compressed:
+            with self._opentar() as tar:
+                names = [tarinfo.name for tarinfo in tar if tarinfo.isreg()]
+                tar.fileobj.close()
+            return names
+
+        return self.index().names()
+
+    def openmember(self, name: str) -> BinaryIO:
+        """
+            Returns a binary stream of one file in the tar body
+        """
+        if not self.compressed:
+            member = self._opentar().extractfile(name)
+            if member is None:
+                raise KeyError(name)
+            return member
+
+        return self.index().open(name)
+
+    def iteratemembers(self) -> Iterator[Tuple[tarfile.TarInfo, BinaryIO]]:
+        """
+            Yields (tarinfo, stream) for the regular files in the tar
+            body in one streaming pass, without building the index. Each
+            stream is only valid until the next member is yielded
+        """
+        with self.openraw() as clamfile:
+            clamfile.seek(self.headersize())
+            with tarfile.open(fileobj=clamfile, mode='r|gz' if self.compressed else 'r|') as tar:
+                for tarinfo in tar:
+                    if not tarinfo.isreg() or os.path.basename(tarinfo.name) != tarinfo.name:
+                        continue
+                    yield tarinfo, tar.extractfile(tarinfo)
+
+    def extractall(self, directory: str) -> List[str]:
+        """
+            Unpack the tar body of a ClamAV-VDB file into directory in one
+            streaming pass. Returns the names of the extracted files
+        """
+        names: List[str] = list()
+        for _ in self._extractsteps(directory, names):
+            pass
+
+        return names
+
+    def _extractsteps(self, directory: str, names: List[str]) -> Iterator[None]:
+        'extractall as a generator that yields after every SLICESIZE bytes'
+        written = 0
+        for tarinfo, member in self.iteratemembers():
+            with open(os.path.join(directory, tarinfo.name), 'wb') as extractfile:
+                for chunk in iter(lambda: member.read(CHUNKSIZE), b''):
+                    extractfile.write(chunk)
+                    written += len(chunk)
+                    if written >= SLICESIZE:
+                        written = 0
+                        yield
+            names.append(tarinfo.name)
+
+    async def extract(self, directory: str) -> List[str]:
+        """
+            extractall without blocking the event loop. The body is
+            unpacked in the executor SLICESIZE bytes per job and
+            cancelling stops after the current job, leaving the files
+            extracted so far
+        """
+        names: List[str] = list()
+        await _runsteps(self._extractsteps(directory, names))
+
+        return names
+
+    def hashdb(self) -> clamavhashdb:
+        """
+            Returns a clamavhashdb with the .hdb, .hsb, .mdb and .msb
+            signatures in the tar body
+        """
+        hashdb = clamavhashdb()
+        hashdb.load(self)
+        hashdb.build()
+
+        return hashdb
+
+    def exporthashdb(self, indexfile: str) -> clamavhashdb:
+        """
+            Save the hash signatures to indexfile for clamavhashdb.open,
+            tagged with the version of this file
+        """
+        hashdb = self.hashdb()
+        hashdb.save(indexfile, self.version())
+
+        return hashdb
+
+    def verifysignature(self, cache: Optional[Any] = None) -> bool:
+        """
+            Check the signature of the file. With a clamavcache the result
+            is looked up and stored by inode, size, mtime and signature.
+            CLD files have no signature over the body and are checked with
+            verifyinfo instead
+        """
+        verdict = self._knownverdict(cache)
+        if verdict is not None:
+            return verdict
+        started = clamavmetrics.clock()
+        if self.iscld():
+            ok, digest = self.verifyinfo(), ''
+        else:
+            with self.openraw() as clamfile:
+                hashobject = self._hashdata(clamfile)
+            ok, digest = self._checkdigest(hashobject.digest()), hashobject.hexdigest()
+
+        return self._checked(cache, started, ok, digest)
+
+    def _knownverdict(self, cache: Optional[Any]) -> Optional[bool]:
+        """
+            False for files without a signature, the verdict in cache or
+            None when the file has to be checked
+        """
+        if self.magicheader not in ('ClamAV-VDB', 'ClamAV-Diff'):
             return False
-        with open(self.filename, 'rb') as clamfile:
+        if self.signature() == '' and not self.iscld():
+            return False
+        if cache is not None and self.fileinfo is not None:
+            cached = cache.lookup(self.fileinfo, self.signature())
+            if cached is not None:
+                return cached[0]
+
+        return None
+
+    def _checked(self, cache: Optional[Any], started: float, ok: bool, digest: str) -> bool:
+        'Store the verdict of a checked file in cache and count it'
+        if cache is not None and self.fileinfo is not None:
+            cache.store(self.filename, self.fileinfo, self.signature(), ok, digest)
+        metrics = clamavmetrics.active()
+        if metrics is not None:
+            metrics.observe(clamavmetrics.VERIFY, clamavmetrics.clock() - started)
+            metrics.count('verified_files')
+            if not ok:
+                metrics.count('verify_failures')
+
+        return ok
+
+    async def verify(self, cache: Optional[Any] = None) -> bool:
+        """
+            verifysignature without blocking the event loop. The signed
+            part is hashed in the executor SLICESIZE bytes per job, so a
+            large file shares the workers with other callers and
+            cancelling stops at the next slice
+        """
+        verdict = self._knownverdict(cache)
+        if verdict is not None:
+            return verdict
+        started = clamavmetrics.clock()
+        if self.iscld():
+            ok, digest = await _offload(self.verifyinfo), ''
+        else:
             if self.magicheader == 'ClamAV-VDB':
-                clamfile.read(512)
-                for chunk in iter(lambda: clamfile.read(8192), b''):
+                hashobject = hashlib.md5()
+                position = self.headersize()
+            else:
+                hashobject = hashlib.sha256()
+                position = 0
+            end = self.headersize() + self.datasize()
+            while position < end:
+                position = await _offload(self._hashslice, hashobject, position, end)
+            ok, digest = await _offload(self._checkdigest, hashobject.digest()), hashobject.hexdigest()
+
+        return self._checked(cache, started, ok, digest)
+
+    def _hashslice(self, hashobject: Any, position: int, end: int) -> int:
+        """
+            Hash at most SLICESIZE bytes from position towards end for
+            verify. Returns the new position, end when the file is short
+        """
+        stop = min(end, position + SLICESIZE)
+        if self._data is not None:
+            with memoryview(self._data) as data:
+                hashobject.update(data[position:stop])
+            return stop
+        with open(self.filename, 'rb') as clamfile:
+            clamfile.seek(position)
+            while position < stop:
+                chunk = clamfile.read(min(CHUNKSIZE, stop - position))
+                if not chunk:
+                    return end
+                hashobject.update(chunk)
+                position += len(chunk)
+
+        return position
+
+    def verifyinfo(self) -> bool:
+        """
+            Check the members of the tar body against the sizes and hashes
+            in its .info member, whose DSIG line must be a valid RSA-PSS
+            signature. Every member except the .info itself must be listed.
+            This is what can be verified of a CLD
+        """
+        hashes: Dict[str, Tuple[int, str, str]] = dict()
+        info: Optional[bytes] = None
+        for tarinfo, member in self.iteratemembers():
+            if tarinfo.name.endswith('.info'):
+                info = member.read()
+                continue
+            md5object = hashlib.md5()
+            sha256object = hashlib.sha256()
+            for chunk in iter(lambda: member.read(CHUNKSIZE), b''):
+                md5object.update(chunk)
+                sha256object.update(chunk)
+            hashes[tarinfo.name] = (tarinfo.size, md5object.hexdigest(),
+                                    sha256object.hexdigest())
+        if info is None or b'\nDSIG:' not in info:
+            return False
+        signed, dsig = info.rsplit(b'DSIG:', 1)
+        digest = hashlib.sha256(signed).digest()
+        if not any(key.verify(dsig.strip().decode('ascii', 'replace'), digest)
+                   for key in clamavkeys.keys(clamavkeys.PSS, self.keynames)):
+            return False
+        listed = 0
+        for line in signed.decode('utf-8', 'replace').splitlines()[1:]:
+            fields = line.split(':')
+            if len(fields) != 3:
+                continue
+            name, size, expected = fields
+            if name not in hashes or hashes[name][0] != int(size) or \
+                    expected.lower() not in hashes[name][1:]:
+                return False
+            listed += 1
+
+        return listed == len(hashes)
+
+    def tocld(self, destinationfile: str, compresslevel: Optional[int] = None) -> 'clamavfile':
+        """
+            Write the database as a CLD in one streaming pass. The body is
+            a plain tar like freshclam writes, or gzip at compresslevel.
+            The header is kept except for the MD5 and signature, which
+            no longer match the body
+        """
+        return self.convert(destinationfile, compresslevel)
+
+    def convert(self, destinationfile: str, compresslevel: Optional[int] = -1,
+                sign: Optional[Callable[[bytes], str]] = None) -> 'clamavfile':
+        """
+            Copy the header and the tar body to destinationfile in one
+            pass. compresslevel None writes a plain tar, -1 keeps a gzipped
+            body as it is and compresses a plain one at the zlib default.
+            sign returns the header signature for the MD5 of the new body,
+            without it MD5 and signature are left UNSIGNED
+        """
+        if self.magicheader != 'ClamAV-VDB':
+            raise ValueError('{} is not a ClamAV-VDB file'.format(self.filename))
+        tempfd, temppath = mkstempfor(destinationfile)
+        md5object = hashlib.md5()
+        try:
+            with self.openraw() as clamfile, os.fdopen(tempfd, 'wb') as output:
+                clamfile.seek(self.headersize())
+                output.write(b' ' * 512)
+                if compresslevel == -1 and self.compressed:
+                    inflater = compressor = None
+                else:
+                    inflater = zlib.decompressobj(31) if self.compressed else None
+                    compressor = None if compresslevel is None else \
+                        zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+                for chunk in iter(lambda: clamfile.read(CHUNKSIZE), b''):
+                    if inflater is not None:
+                        chunk = inflater.decompress(chunk)
+                    if compressor is not None:
+                        chunk = compressor.compress(chunk)
+                    md5object.update(chunk)
+                    output.write(chunk)
+                if compressor is not None:
+                    chunk = compressor.flush()
                     md5object.update(chunk)
-                decryptedhash = self._decodesignature(self.signature(),
-                                                      self.estr,
-                                                      self.nstr)
-                decryptedhash = decryptedhash.zfill(32)
-                if decryptedhash == md5object.hexdigest():
-                    return True
-            if self.magicheader == 'ClamAV-Diff':
-                decryptedsignaturestring = self._decodesignature(self.signature(),
-                                                                 self.pss_estr,
-                                                                 self.pss_nstr)
-                decryptedsignaturestring = decryptedsignaturestring.zfill(512)
-                decryptedsignaturelist = self._stringtolist(decryptedsignaturestring)
-                bytestoread = self.fileinfo.st_size - self.footersize()
-                data = clamfile.read(bytestoread)
-                sha256object.update(data)
-                decryptedbytelist = bytearray()
-                for i in range(0, len(decryptedsignaturelist)):
-                    decryptedbytelist.append(int(decryptedsignaturelist[i],
-                                                 16))
-
-                # MASK
-                mask = bytearray()
-                for i in range(0, 223):
-                    mask.append(decryptedbytelist[i])
-                digest2 = bytearray()
-                for i in range(223, 255):
-                    digest2.append(decryptedbytelist[i])
-
-                datastr = str()
-                for num in range(0, 7):
-                    testhash = hashlib.sha256()
-                    testhash.update(digest2)
-                    testhash.update(b'\x00\x00\x00')
-                    # testhash.update(b'\x00')
-                    # testhash.update(b'\x00')
-                    testhash.update(bytes(chr(num), 'ascii'))
-                    datastr += testhash.hexdigest()
-                datalist = self._stringtolist(datastr)
-                data = bytearray()
-                xordata = bytearray()
-                for i in range(0, 223):
-                    data.append(int(datalist[i], 16))
-                for i in range(0, 223):
-                    xordata.append(data[i] ^ mask[i])
-                xordata[0] &= (0xff >> 1)
-                salt = 0
-                for i in range(0, 223):
-                    if xordata[i] == 0x01:
-                        salt = i + 1
-                        break
-                final = bytearray()
-                final.append(0x00)
-                final.append(0x00)
-                final.append(0x00)
-                final.append(0x00)
-                final.append(0x00)
-                final.append(0x00)
-                final.append(0x00)
-                final.append(0x00)
-                final.extend(sha256object.digest())
-                for i in range(salt, salt + 32):
-                    final.append(xordata[i])
-                finalhash = hashlib.sha256()
-                finalhash.update(final)
-                digest2str = "".join(format(x, '02x') for x in digest2)
-                if finalhash.hexdigest() == digest2str:
-                    return True
+                    output.write(chunk)
+                if inflater is not None and not inflater.eof:
+                    raise ValueError('{} has a truncated body'.format(self.filename))
+                md5 = signature = UNSIGNED
+                if sign is not None:
+                    md5, signature = md5object.hexdigest(), sign(md5object.digest())
+                header = ':'.join([self.filetype(), self.signaturedate(), str(self.version()),
+                                   str(self.signatures()), str(self.functionalitylevel()),
+                                   md5, signature, self.builder(), str(self.epoch())])
+                if len(header) > 512:
+                    raise ValueError('Header longer than 512 bytes')
+                output.seek(0)
+                output.write(header.encode('utf-8').ljust(512, b' '))
+            os.replace(temppath, destinationfile)
+        except BaseException:
+            os.unlink(temppath)
+            raise
+
+        return clamavfile(destinationfile)
+
+    def verifyandsave(self, destinationfile: str) -> bool:
+        """
+            Verify the signature and extract the data part in the same
+            read of the file. The data is written to a temporary file next
+            to destinationfile and only renamed into place when the
+            signature is valid
+        """
+        if self.signature() == '':
+            return False
+        if self.magicheader not in ('ClamAV-VDB', 'ClamAV-Diff'):
+            return False
+        tempfd, temppath = mkstempfor(destinationfile, suffix='.tmp')
+        try:
+            with self.openraw() as clamfile, \
+                    os.fdopen(tempfd, 'wb') as extractfile:
+                hashobject = self._hashdata(clamfile, extractfile.write)
+            if self._checkdigest(hashobject.digest()):
+                os.replace(temppath, destinationfile)
+                return True
+        except BaseException:
+            os.unlink(temppath)
+            raise
+        os.unlink(temppath)
 
         return False
 
+    def _hashdata(self, clamfile: BinaryIO,
+                  write: Optional[Callable[[bytes], Any]] = None) -> Any:
+        """
+            Hash the signed part of the file in one pass, MD5 of the data
+            for ClamAV-VDB and SHA-256 of header and data for ClamAV-Diff.
+            The data part is passed on to write when it is given
+        """
+        if self.magicheader == 'ClamAV-VDB':
+            hashobject = hashlib.md5()
+        else:
+            hashobject = hashlib.sha256()
+        metrics = clamavmetrics.active()
+        if metrics is not None:
+            return self._hashdatatimed(metrics, clamfile, hashobject, write)
+        header = clamfile.read(self.headersize())
+        if self.magicheader == 'ClamAV-Diff':
+            hashobject.update(header)
+        remaining = self.datasize()
+        while remaining > 0:
+            chunk = clamfile.read(min(CHUNKSIZE, remaining))
+            if not chunk:
+                break
+            hashobject.update(chunk)
+            if write is not None:
+                write(chunk)
+            remaining -= len(chunk)
+
+        return hashobject
+
+    def _hashdatatimed(self, metrics: clamavmetrics.clamavmetrics, clamfile: BinaryIO,
+                       hashobject: Any, write: Optional[Callable[[bytes], Any]]) -> Any:
+        'The loop of _hashdata with read and hash time kept apart'
+        clock = clamavmetrics.clock
+        readtime = hashtime = 0.0
+        reads = hashed = 0
+        started = clock()
+        header = clamfile.read(self.headersize())
+        readtime += clock() - started
+        reads += 1
+        if self.magicheader == 'ClamAV-Diff':
+            hashobject.update(header)
+            hashed += len(header)
+        remaining = self.datasize()
+        while remaining > 0:
+            started = clock()
+            chunk = clamfile.read(min(CHUNKSIZE, remaining))
+            hashstarted = clock()
+            readtime += hashstarted - started
+            reads += 1
+            if not chunk:
+                break
+            hashobject.update(chunk)
+            hashtime += clock() - hashstarted
+            hashed += len(chunk)
+            if write is not None:
+                write(chunk)
+            remaining -= len(chunk)
+        metrics.observe(clamavmetrics.READ, readtime, reads)
+        metrics.observe(clamavmetrics.HASH, hashtime)
+        metrics.count('read_calls', reads)
+        metrics.count('read_bytes', len(header) + self.datasize() - remaining)
+        metrics.count('hashed_bytes', hashed)
+
+        return hashobject
+
+    def _checkdigest(self, digest: bytes) -> bool:
+        """
+            Check digest from _hashdata against the RSA signature (MD5) or
+            RSA-PSS signature (SHA-256) in the file, trying every
+            registered key of that kind or only those named in keynames
+        """
+        kind = clamavkeys.MD5 if self.magicheader == 'ClamAV-VDB' else clamavkeys.PSS
+        metrics = clamavmetrics.active()
+        if metrics is not None:
+            started = clamavmetrics.clock()
+        ok = False
+        for key in clamavkeys.keys(kind, self.keynames):
+            if key.verify(self.signature(), digest):
+                ok = True
+                break
+        if metrics is not None:
+            metrics.observe(clamavmetrics.RSA if kind == clamavkeys.MD5 else clamavmetrics.PSS,
+                            clamavmetrics.clock() - started)
+
+        return ok
+
     def fileinformation(self) -> os.stat_result:
         # print(os.stat(self.filename))
         return os.stat(self.filename)
 
-    def readmagicheader(self) -> str:
+    def readmagicheader(self, filedata: Optional[bytes] = None) -> str:
         'Read 12 bytes from file and output header'
-        with open(self.filename, 'rb') as clamfile:
-            filedata = clamfile.read(12)
-            so = re.split(b':', filedata, 1)
+        if filedata is None:
+            with self.openraw() as clamfile:
+                filedata = clamfile.read(12)
+        so = re.split(b':', filedata, 1)
 
-        return so[0].decode('utf-8')
+        return so[0].decode('utf-8', 'replace')
 
     def createheader(self) -> str:
         headerstr: str = ':'.join([self.filetype(), self.signaturedate(),
@@ -174,10 +767,11 @@ class clamavfile:
 
         return headerstr
 
-    def readheader(self) -> Dict[str, Any]:
+    def readheader(self, filedata: Optional[Any] = None) -> Dict[str, Any]:
         """
         Get the magic header bytes from the file to see what kind of
-        ClamAV file it is
+        ClamAV file it is. filedata is the whole file as bytes or mmap,
+        without it the header and footer are read from the file
 
         ClamAV-VDB:19 Sep 2019 12-12 -0400:331:94:63:07b42b8527b2c82d7236bbc
         32458e245:i4NE7BC0pb7xpS39DmgbDXcQl9ka5121HLSuo0mIKvXvZjFb9z7wgU6oOMw
@@ -185,14 +779,21 @@ class clamavfile:
         8udGcUjn/YHJ3rCgGaANSYFRbTgkbDwsuLhGatD7tJf:anvilleg:1568909553
         ClamAV-Diff:50:4228877:
         """
+        if filedata is None:
+            with self.openraw() as clamfile:
+                headerdata = clamfile.read(512)
+                filesize = clamfile.seek(0, 2)
+                clamfile.seek(max(0, filesize - 350))
+                signaturedata = clamfile.read()
+        else:
+            filesize = len(filedata)
+            headerdata = filedata[:512]
+            signaturedata = filedata[max(0, filesize - 350):]
         header: Dict[str, Union[str, int]] = dict()
         if self.magicheader == 'ClamAV-VDB':
-            bytestoread = 512
             headersize = 512
             footersize = 0
-            with open(self.filename, 'rb') as clamfile:
-                filedata = clamfile.read(bytestoread)
-            so = re.split(b':', filedata, 8)
+            so = re.split(b':', headerdata, 8)
             header['headersize'] = headersize
             header['footersize'] = footersize
             header['filetype'] = so[0].decode('utf-8')
@@ -204,13 +805,9 @@ class clamavfile:
             header['signature'] = so[6].decode('utf-8')
             header['builder'] = so[7].decode('utf-8')
             header['epoch'] = int(so[8].decode('utf-8').rstrip())
-            header['datasize'] = self.fileinfo.st_size - headersize - footersize
+            header['datasize'] = filesize - headersize - footersize
         if self.magicheader == 'ClamAV-Diff':
-            with open(self.filename, 'rb') as clamfile:
-                headerdata = clamfile.read(40)
-                clamfile.seek(-350, 2)
-                signaturedata = clamfile.read()
-            so = re.split(b':', headerdata, 3)
+            so = re.split(b':', headerdata[:40], 3)
             header['filetype'] = so[0].decode('utf-8')
             header['version'] = int(so[1].decode('utf-8'))
             header['signatures'] = int(so[2].decode('utf-8'))
@@ -218,17 +815,18 @@ class clamavfile:
                                        len(str(header['version'])) +
                                        len(str(header['signatures'])) +
                                        3)
+            header['footersize'] = 0
             signatureposition = -1
-            for i in range(0, 349):
+            for i in range(0, len(signaturedata) - 1):
                 if not self._signaturecharacter(signaturedata[i]):
                     signatureposition = -1
                 if signaturedata[i] == 58:
                     signatureposition = i
             if signatureposition != -1:
-                header['footersize'] = 350 - signatureposition
+                header['footersize'] = len(signaturedata) - signatureposition
                 header['signature'] = signaturedata[signatureposition + 1:].decode('utf-8')
 
-            header['datasize'] = self.fileinfo.st_size - int(header['headersize']) - int(header['footersize'])
+            header['datasize'] = filesize - int(header['headersize']) - int(header['footersize'])
 
         return header
 
@@ -0,0 +1,433 @@
+#!/usr/bin/python3
+
+# Look up file and PE section hashes in ClamAV hash signatures
+# Copyright 2021 Thomas Karlsson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import mmap
+import struct
+import tempfile
+import binascii
+import operator
+import itertools
+import collections
+from array import array
+from typing import List, Dict, Tuple, Union, Optional, Iterable, BinaryIO, Any
+
+FILE = 'file'
+SECTION = 'section'
+# .hdb/.hsb lines are hash:size:name, .mdb/.msb lines size:hash:name
+EXTENSIONS = {'.hdb': FILE, '.hsb': FILE, '.mdb': SECTION, '.msb': SECTION}
+WIDTHS = (16, 20, 32)
+# Size stored for signatures that match any size
+ANYSIZE = 2 ** 64 - 1
+
+Digest = Union[bytes, str]
+
+INDEXMAGIC = b'CAVHASH\x00'
+INDEXFORMAT = 1
+# magic, format, little endian flag, database version, number of tables
+_HEADER = struct.Struct('<8sIIQI4x')
+# kind, width, count, Bloom filter mask and the offsets of the sections
+_TABLE = struct.Struct('<BB6xQQ6Q')
+_KINDS = (FILE, SECTION)
+
+
+class _table:
+    """
+    Signatures with one kind and digest width. The digests are one
+    sorted buffer of fixed width records and buckets holds the first
+    record of every 2 byte prefix, so a lookup only searches a few dozen
+    records. A Bloom filter in front, indexed directly by three 32 bit
+    pieces of the digest, answers most misses without a search. Sizes
+    and name offsets are arrays in the same order and the names one
+    buffer. The buffers are bytes and arrays when built in memory and
+    read-only maps of an index file when opened from one.
+    """
+    def __init__(self, width: int):
+        self.width = width
+        self.count = 0
+        self.digests: Any = b''
+        self.sizes: Any = array('Q')
+        self.names: Any = b''
+        self.nameoffsets: Any = array('Q', [0])
+        self.buckets: Any = array('I', bytes(4 * 65537))
+        self.bloommask = 8 * 8192 - 1
+        self.bloom: Any = bytes(8192)
+        # digest, big endian size and name as one bytes object, which
+        # sorts much faster than tuples
+        self.pending: List[bytes] = list()
+
+    def __len__(self) -> int:
+        return self.count + len(self.pending)
+
+    def add(self, digest: bytes, size: int, name: bytes) -> None:
+        self.pending.append(digest + size.to_bytes(8, 'big') + name)
+
+    def build(self) -> None:
+        'Merge pending signatures into the sorted arrays'
+        width = self.width
+        records = self.pending
+        self.pending = list()
+        bigendian = array('Q', self.sizes)
+        if sys.byteorder != 'big':
+            bigendian.byteswap()
+        sizes = bigendian.tobytes()
+        records += [self.digests[index * width:(index + 1) * width] +
+                    sizes[index * 8:index * 8 + 8] +
+                    bytes(self.names[self.nameoffsets[index]:self.nameoffsets[index + 1]])
+                    for index in range(self.count)]
+        records.sort()
+        # map with itemgetter keeps the per record work in C
+        sizewidth = width + 8
+        self.count = len(records)
+        self.digests = b''.join(map(operator.itemgetter(slice(0, width)), records))
+        self.sizes = array('Q', b''.join(map(operator.itemgetter(slice(width, sizewidth)), records)))
+        if sys.byteorder != 'big':
+            self.sizes.byteswap()
+        names = list(map(operator.itemgetter(slice(sizewidth, None)), records))
+        self.names = b''.join(names)
+        self.nameoffsets = array('Q', itertools.accumulate(map(len, names), initial=0))
+        counts = collections.Counter(map(operator.itemgetter(slice(0, 2)), records))
+        self.buckets = array('I', itertools.accumulate(
+            (counts.get(prefix.to_bytes(2, 'big'), 0) for prefix in range(65536)), initial=0))
+        # At least 10 bits per signature, three probes give about 1% false
+        # positives
+        bits = 1 << max(16, min(32, (len(records) * 10 - 1).bit_length()))
+        self.bloommask = bits - 1
+        bloom = bytearray(bits // 8)
+        mask = self.bloommask
+        for value in map(int.from_bytes, map(operator.itemgetter(slice(4, 16)), records),
+                         itertools.repeat('little')):
+            for probe in (value & mask, value >> 32 & mask, value >> 64 & mask):
+                bloom[probe >> 3] |= 1 << (probe & 7)
+        self.bloom = bytes(bloom)
+
+    def find(self, digest: bytes, size: Optional[int]) -> int:
+        """
+            Returns the index of the signature for digest and size, any
+            size when size is None, or -1
+        """
+        value = int.from_bytes(digest[4:16], 'little')
+        mask = self.bloommask
+        for probe in (value & mask, value >> 32 & mask, value >> 64 & mask):
+            if not self.bloom[probe >> 3] >> (probe & 7) & 1:
+                return -1
+        width = self.width
+        prefix = digest[0] << 8 | digest[1]
+        end = self.buckets[prefix + 1] * width
+        position = self.digests.find(digest, self.buckets[prefix] * width, end)
+        while position >= 0 and position % width:
+            position = self.digests.find(digest, position + 1, end)
+        if position < 0:
+            return -1
+        index = position // width
+        while position < end and self.digests[position:position + width] == digest:
+            if size is None or self.sizes[index] == size or self.sizes[index] == ANYSIZE:
+                return index
+            index += 1
+            position += width
+
+        return -1
+
+    def name(self, index: int) -> str:
+        return str(self.names[self.nameoffsets[index]:self.nameoffsets[index + 1]], 'utf-8', 'replace')
+
+    def sections(self) -> List[Any]:
+        'Buffers in index file order'
+        return [self.digests, self.sizes, self.nameoffsets, self.names, self.buckets, self.bloom]
+
+    def memory(self) -> int:
+        return sum(memoryview(section).nbytes for section in self.sections())
+
+
+class clamavhashdb:
+    """
+    Compact index of the hash signatures in .hdb, .hsb, .mdb and .msb
+    files for looking up MD5, SHA-1 and SHA-256 digests of files (FILE)
+    or PE sections (SECTION), optionally with their size.
+
+    A signature costs its digest, 16 bytes of size and name offset and
+    its name, a fraction of a dict of strings. Digests are raw bytes or
+    hexadecimal strings. save writes the index to a file that open maps
+    read-only, so worker processes share one copy in the page cache.
+    """
+    def __init__(self):
+        self._tables: Dict[Tuple[str, int], _table] = dict()
+        self.skipped = 0
+        self.dbversion = 0
+        self.indexfile: Optional[str] = None
+        self._identity: Optional[Tuple[int, int, int]] = None
+
+    def version(self) -> int:
+        """
+            Returns the database version the index was saved with
+        """
+        return self.dbversion
+
+    def save(self, indexfile: str, version: Optional[int] = None) -> None:
+        """
+            Write the index to indexfile for open. The file is written
+            next to it and renamed into place, so readers that have the
+            old file mapped keep using it
+        """
+        self.build()
+        if version is not None:
+            self.dbversion = version
+        tables = sorted(self._tables.items())
+        position = _HEADER.size + _TABLE.size * len(tables)
+        entries: List[bytes] = list()
+        layout: List[Tuple[int, Any]] = list()
+        for (kind, width), table in tables:
+            offsets = list()
+            for number, section in enumerate(table.sections()):
+                # Digests get their own map, so they start on a page
+                alignment = mmap.ALLOCATIONGRANULARITY if number == 0 else 8
+                position += -position % alignment
+                offsets.append(position)
+                layout.append((position, section))
+                position += memoryview(section).nbytes
+            entries.append(_TABLE.pack(_KINDS.index(kind), width, table.count,
+                                       table.bloommask, *offsets))
+        directory = os.path.dirname(os.path.abspath(indexfile))
+        tempfd, temppath = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(indexfile) + '.')
+        try:
+            with os.fdopen(tempfd, 'wb') as output:
+                output.write(_HEADER.pack(INDEXMAGIC, INDEXFORMAT, sys.byteorder == 'little',
+                                          self.dbversion, len(tables)))
+                output.write(b''.join(entries))
+                for offset, section in layout:
+                    output.write(bytes(offset - output.tell()))
+                    output.write(memoryview(section).cast('B'))
+                output.flush()
+                os.fsync(output.fileno())
+            os.replace(temppath, indexfile)
+        except BaseException:
+            os.unlink(temppath)
+            raise
+
+    @classmethod
+    def open(cls, indexfile: str) -> 'clamavhashdb':
+        """
+            Map an index written by save read-only. Nothing is read until
+            lookups touch it and the pages are shared with every other
+            process that maps the same file
+        """
+        hashdb = cls()
+        hashdb.indexfile = indexfile
+        hashdb._map()
+
+        return hashdb
+
+    def _map(self) -> None:
+        with open(self.indexfile, 'rb') as indexfile:
+            fileinfo = os.fstat(indexfile.fileno())
+            data = mmap.mmap(indexfile.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, indexformat, little, dbversion, ntables = _HEADER.unpack_from(data)
+            if magic != INDEXMAGIC or indexformat != INDEXFORMAT:
+                raise ValueError('{} is not a hash index'.format(self.indexfile))
+            if little != (sys.byteorder == 'little'):
+                raise ValueError('{} was written on a machine with other byte order'.format(self.indexfile))
+            view = memoryview(data)
+            tables: Dict[Tuple[str, int], _table] = dict()
+            for number in range(ntables):
+                kind, width, count, bloommask, *offsets = _TABLE.unpack_from(
+                    data, _HEADER.size + number * _TABLE.size)
+                table = _table(width)
+                table.count = count
+                table.bloommask = bloommask
+                if count:
+                    table.digests = mmap.mmap(indexfile.fileno(), count * width,
+                                              access=mmap.ACCESS_READ, offset=offsets[0])
+                table.sizes = view[offsets[1]:offsets[1] + 8 * count].cast('Q')
+                table.nameoffsets = view[offsets[2]:offsets[2] + 8 * (count + 1)].cast('Q')
+                table.names = view[offsets[3]:offsets[3] + table.nameoffsets[count]]
+                table.buckets = view[offsets[4]:offsets[4] + 4 * 65537].cast('I')
+                table.bloom = view[offsets[5]:offsets[5] + (bloommask + 1) // 8]
+                tables[(_KINDS[kind], width)] = table
+        # One assignment, lookups running in other threads see either the
+        # old or the new tables
+        self._tables = tables
+        self.dbversion = dbversion
+        self._identity = (fileinfo.st_ino, fileinfo.st_size, fileinfo.st_mtime_ns)
+
+    def reload(self) -> bool:
+        """
+            Map indexfile again if it was replaced since it was mapped.
+            The old map is released once no lookup uses it. Returns True
+            when a new file was mapped
+        """
+        if self.indexfile is None:
+            return False
+        fileinfo = os.stat(self.indexfile)
+        if (fileinfo.st_ino, fileinfo.st_size, fileinfo.st_mtime_ns) == self._identity:
+            return False
+        self._map()
+
+        return True
+
+    def __len__(self) -> int:
+        return sum(len(table) for table in self._tables.values())
+
+    def _gettable(self, kind: str, width: int) -> _table:
+        key = (kind, width)
+        if key not in self._tables:
+            self._tables[key] = _table(width)
+
+        return self._tables[key]
+
+    def addlines(self, lines: Iterable[bytes], kind: str = FILE) -> int:
+        """
+            Add signature lines of kind, returns the number added. Lines
+            that are not hash signatures are counted in skipped
+        """
+        added = 0
+        for line in lines:
+            fields = line.rstrip(b'\r\n').split(b':', 3)
+            if len(fields) < 3:
+                self.skipped += 1
+                continue
+            if kind == FILE:
+                hexdigest, size = fields[0], fields[1]
+            else:
+                size, hexdigest = fields[0], fields[1]
+            try:
+                digest = binascii.a2b_hex(hexdigest)
+                size = ANYSIZE if size == b'*' else int(size)
+            except (ValueError, binascii.Error):
+                self.skipped += 1
+                continue
+            if len(digest) not in WIDTHS:
+                self.skipped += 1
+                continue
+            self._gettable(kind, len(digest)).add(digest, size, fields[2])
+            added += 1
+
+        return added
+
+    def addfile(self, fileobject: BinaryIO, name: str) -> int:
+        """
+            Add the signatures in fileobject if name has a hash signature
+            extension, returns the number added
+        """
+        kind = EXTENSIONS.get(os.path.splitext(name)[1])
+        if kind is None:
+            return 0
+
+        return self.addlines(fileobject, kind)
+
+    def load(self, clamobject: Any) -> int:
+        """
+            Add the hash signature members of a clamavfile
+        """
+        added = 0
+        for tarinfo, member in clamobject.iteratemembers():
+            added += self.addfile(member, tarinfo.name)
+
+        return added
+
+    def build(self) -> None:
+        """
+            Sort signatures added since the last build, lookups build
+            automatically
+        """
+        for table in self._tables.values():
+            if table.pending:
+                table.build()
+
+    def _digest(self, digest: Digest) -> bytes:
+        if isinstance(digest, str):
+            return bytes.fromhex(digest)
+
+        return digest
+
+    def lookup(self, digest: Digest, size: Optional[int] = None,
+               kind: str = FILE) -> Optional[str]:
+        """
+            Returns the name of the signature matching digest, and size
+            when it is given, or None
+        """
+        digest = self._digest(digest)
+        table = self._tables.get((kind, len(digest)))
+        if table is None:
+            return None
+        if table.pending:
+            table.build()
+        index = table.find(digest, size)
+
+        return table.name(index) if index >= 0 else None
+
+    def lookupmany(self, digests: Iterable[Digest],
+                   sizes: Optional[Iterable[Optional[int]]] = None,
+                   kind: str = FILE) -> List[Optional[str]]:
+        """
+            Batched lookup, returns a name or None for every digest
+        """
+        self.build()
+        tables = {width: self._tables[(kind, width)] for width in WIDTHS
+                  if (kind, width) in self._tables}
+        results: List[Optional[str]] = list()
+        append = results.append
+        # find and name inlined, the method calls would cost more than
+        # the search itself
+        for digest, size in zip(digests, itertools.repeat(None) if sizes is None else sizes):
+            if isinstance(digest, str):
+                digest = bytes.fromhex(digest)
+            table = tables.get(len(digest))
+            if table is None:
+                append(None)
+                continue
+            value = int.from_bytes(digest[4:16], 'little')
+            mask = table.bloommask
+            bloom = table.bloom
+            probe = value & mask
+            if not bloom[probe >> 3] >> (probe & 7) & 1:
+                append(None)
+                continue
+            probe = value >> 32 & mask
+            if not bloom[probe >> 3] >> (probe & 7) & 1:
+                append(None)
+                continue
+            probe = value >> 64 & mask
+            if not bloom[probe >> 3] >> (probe & 7) & 1:
+                append(None)
+                continue
+            width = table.width
+            prefix = digest[0] << 8 | digest[1]
+            end = table.buckets[prefix + 1] * width
+            position = table.digests.find(digest, table.buckets[prefix] * width, end)
+            while position >= 0 and position % width:
+                position = table.digests.find(digest, position + 1, end)
+            name = None
+            while 0 <= position < end and table.digests[position:position + width] == digest:
+                index = position // width
+                if size is None or table.sizes[index] == size or table.sizes[index] == ANYSIZE:
+                    name = str(table.names[table.nameoffsets[index]:table.nameoffsets[index + 1]],
+                               'utf-8', 'replace')
+                    break
+                position += width
+            append(name)
+
+        return results
+
+    def memory(self) -> int:
+        """
+            Returns the bytes used by the index
+        """
+        self.build()
+
+        return sum(table.memory() for table in self._tables.values())
@@ -0,0 +1,434 @@
+#!/usr/bin/python3
+
+# Seek point index for the gzipped tar body of ClamAV files
+# Copyright 2021 Thomas Karlsson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import os
+import zlib
+import bisect
+import hashlib
+import struct
+import ctypes
+import ctypes.util
+import tarfile
+import tempfile
+from typing import List, Dict, Tuple, Optional, Any, Iterator
+
+INDEXMAGIC = b'CAVIDX\x00\x02'
+SPAN = 1024 * 1024
+WINSIZE = 32768
+CHUNKSIZE = 256 * 1024
+# Bytes from both ends of the body that tell apart files of the same size
+FINGERPRINT = 1024
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+Z_BLOCK = 5
+
+# out, in, bits, window
+Point = Tuple[int, int, int, bytes]
+
+
+class _zstream(ctypes.Structure):
+    _fields_ = [('next_in', ctypes.c_void_p),
+                ('avail_in', ctypes.c_uint),
+                ('total_in', ctypes.c_ulong),
+                ('next_out', ctypes.c_void_p),
+                ('avail_out', ctypes.c_uint),
+                ('total_out', ctypes.c_ulong),
+                ('msg', ctypes.c_char_p),
+                ('state', ctypes.c_void_p),
+                ('zalloc', ctypes.c_void_p),
+                ('zfree', ctypes.c_void_p),
+                ('opaque', ctypes.c_void_p),
+                ('data_type', ctypes.c_int),
+                ('adler', ctypes.c_ulong),
+                ('reserved', ctypes.c_ulong)]
+
+
+def _loadzlib() -> Optional[Any]:
+    """
+        The zlib module does not expose inflate(Z_BLOCK) which is needed to
+        find deflate block boundaries, so the index builder talks to libz
+        directly. Returns None when libz can not be loaded
+    """
+    libname = ctypes.util.find_library('z')
+    if libname is None:
+        return None
+    try:
+        libz = ctypes.CDLL(libname)
+    except OSError:
+        return None
+    libz.zlibVersion.restype = ctypes.c_char_p
+    libz.inflateInit2_.argtypes = [ctypes.POINTER(_zstream), ctypes.c_int,
+                                   ctypes.c_char_p, ctypes.c_int]
+    libz.inflate.argtypes = [ctypes.POINTER(_zstream), ctypes.c_int]
+    libz.inflateEnd.argtypes = [ctypes.POINTER(_zstream)]
+
+    return libz
+
+
+_libz = _loadzlib()
+
+
+def _gzipheadersize(data: bytes) -> int:
+    'Returns the size of the gzip member header at the start of data'
+    if data[:3] != b'\x1f\x8b\x08':
+        raise ValueError('Not a gzip stream')
+    flags = data[3]
+    position = 10
+    if flags & 4:
+        position += 2 + struct.unpack('<H', data[position:position + 2])[0]
+    for flag in (8, 16):
+        if flags & flag:
+            position = data.index(b'\x00', position) + 1
+    if flags & 2:
+        position += 2
+
+    return position
+
+
+class _tarscanner:
+    'Find the regular members of a tar stream fed to it in pieces'
+    def __init__(self):
+        self.position = 0
+        self.skip = 0
+        self.header = b''
+        self.done = False
+        self.members: Dict[str, Tuple[int, int]] = dict()
+
+    def feed(self, data: bytes) -> None:
+        i = 0
+        while i < len(data) and not self.done:
+            if self.skip:
+                step = min(self.skip, len(data) - i)
+                self.skip -= step
+                i += step
+                continue
+            step = 512 - len(self.header)
+            self.header += data[i:i + step]
+            i += min(step, len(data) - i)
+            if len(self.header) < 512:
+                continue
+            headerend = self.position + i
+            if self.header == bytes(512):
+                self.done = True
+                break
+            tarinfo = tarfile.TarInfo.frombuf(self.header, 'utf-8',
+                                              'surrogateescape')
+            self.header = b''
+            if tarinfo.isreg():
+                self.members[tarinfo.name] = (headerend, tarinfo.size)
+            self.skip = (tarinfo.size + 511) // 512 * 512
+        self.position += len(data)
+
+
+class _memberreader(io.RawIOBase):
+    'Raw stream of one tar member, inflated from the nearest seek point'
+    def __init__(self, clamobject: Any, point: Point, offset: int, size: int):
+        super().__init__()
+        out, position, bits, window = point
+        self._clamfile = clamobject.openraw()
+        self._clamfile.seek(clamobject.headersize() + position - (1 if bits else 0))
+        self._shift = 8 - bits if bits else 0
+        self._carry = b''
+        self._skip = offset - out
+        self._remaining = size
+        self._buffer = b''
+        if window:
+            self._inflater = zlib.decompressobj(-15, zdict=window)
+        else:
+            self._inflater = zlib.decompressobj(-15)
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        self._clamfile.close()
+        super().close()
+
+    def _compressed(self) -> bytes:
+        """
+            Next piece of the deflate stream. A seek point in the middle of
+            a byte is turned into a byte aligned stream by shifting the
+            bits, which is what inflatePrime would do
+        """
+        data = self._clamfile.read(CHUNKSIZE)
+        if not self._shift:
+            return data
+        data = self._carry + data
+        if not data:
+            return data
+        shifted = (int.from_bytes(data, 'little') >> self._shift).to_bytes(len(data), 'little')
+        if len(data) == len(self._carry):
+            self._carry = b''
+            return shifted
+        self._carry = data[-1:]
+
+        return shifted[:-1]
+
+    def _inflate(self) -> bytes:
+        while True:
+            if self._inflater.unconsumed_tail:
+                data = self._inflater.decompress(self._inflater.unconsumed_tail,
+                                                 CHUNKSIZE)
+            elif self._inflater.eof:
+                return b''
+            else:
+                compressed = self._compressed()
+                if not compressed:
+                    return b''
+                data = self._inflater.decompress(compressed, CHUNKSIZE)
+            if self._skip:
+                step = min(self._skip, len(data))
+                self._skip -= step
+                data = data[step:]
+            if data:
+                return data
+
+    def readinto(self, buffer: Any) -> int:
+        if not self._buffer and self._remaining:
+            self._buffer = self._inflate()[:self._remaining]
+            if not self._buffer:
+                raise EOFError('Compressed body ended inside a member')
+            self._remaining -= len(self._buffer)
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+
+        return size
+
+
+class clamavindex:
+    """
+    Seek point index into the gzipped tar body of a ClamAV-VDB file.
+
+    Every SPAN bytes of inflated data the position in the compressed
+    stream is recorded together with the 32 KiB window needed to restart
+    inflating there, along with the offset and size of every tar member.
+    The index is kept in a sidecar file so opening a member later only
+    inflates from the closest seek point instead of from the start.
+    """
+    def __init__(self, clamobject: Any, indexfile: Optional[str] = None,
+                 span: int = SPAN):
+        if clamobject.magicheader != 'ClamAV-VDB':
+            raise ValueError('Only ClamAV-VDB files have a tar body')
+        self.clamobject = clamobject
+        self.indexfile = indexfile
+        if indexfile is None and clamobject.filename is not None:
+            self.indexfile = clamobject.filename + '.idx'
+        self.span = span
+        self.points: List[Point] = list()
+        self.members: Dict[str, Tuple[int, int]] = dict()
+        if not self.load():
+            self.build()
+            if self.indexfile is not None:
+                try:
+                    self.save()
+                except OSError:
+                    pass
+
+    def _identity(self) -> bytes:
+        """
+            SHA-256 of the header MD5 and both ends of the body. The MD5
+            of a CLD is UNSIGNED, the end of a gzip body holds the CRC of
+            the whole tar
+        """
+        identity = hashlib.sha256(self.clamobject.md5().encode('ascii'))
+        start = self.clamobject.headersize()
+        datasize = self.clamobject.datasize()
+        with self.clamobject.openraw() as clamfile:
+            clamfile.seek(start)
+            identity.update(clamfile.read(min(FINGERPRINT, datasize)))
+            clamfile.seek(start + max(0, datasize - FINGERPRINT))
+            identity.update(clamfile.read(FINGERPRINT))
+
+        return identity.digest()
+
+    def build(self) -> None:
+        """
+            Inflate the body once, recording seek points and tar members
+        """
+        self.points = list()
+        scanner = _tarscanner()
+        with self.clamobject.openraw() as clamfile:
+            clamfile.seek(self.clamobject.headersize())
+            start = _gzipheadersize(clamfile.read(512))
+            self.points.append((0, start, 0, b''))
+            clamfile.seek(self.clamobject.headersize())
+            if _libz is not None:
+                self._buildpoints(clamfile, scanner)
+            else:
+                inflater = zlib.decompressobj(47)
+                remaining = self.clamobject.datasize()
+                while remaining > 0 and not scanner.done and not inflater.eof:
+                    data = clamfile.read(min(CHUNKSIZE, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    scanner.feed(inflater.decompress(data))
+        self.members = scanner.members
+
+    def _buildpoints(self, clamfile: Any, scanner: _tarscanner) -> None:
+        stream = _zstream()
+        ret = _libz.inflateInit2_(ctypes.byref(stream), 47, _libz.zlibVersion(),
+                                  ctypes.sizeof(stream))
+        if ret != Z_OK:
+            raise MemoryError('inflateInit2 failed')
+        inbuffer = ctypes.create_string_buffer(CHUNKSIZE)
+        inview = memoryview(inbuffer).cast('B')
+        outbuffer = ctypes.create_string_buffer(CHUNKSIZE)
+        window = b''
+        last = 0
+        remaining = self.clamobject.datasize()
+        try:
+            while not scanner.done:
+                if stream.avail_in == 0:
+                    size = clamfile.readinto(inview[:min(CHUNKSIZE, remaining)])
+                    if not size:
+                        raise EOFError('Compressed body is truncated')
+                    remaining -= size
+                    stream.next_in = ctypes.addressof(inbuffer)
+                    stream.avail_in = size
+                stream.next_out = ctypes.addressof(outbuffer)
+                stream.avail_out = CHUNKSIZE
+                ret = _libz.inflate(ctypes.byref(stream), Z_BLOCK)
+                if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+                    raise zlib.error(stream.msg or 'inflate failed')
+                produced = CHUNKSIZE - stream.avail_out
+                if produced:
+                    data = ctypes.string_at(outbuffer, produced)
+                    scanner.feed(data)
+                    window = (window + data)[-WINSIZE:]
+                if ret == Z_STREAM_END:
+                    break
+                if stream.data_type & 128 and not stream.data_type & 64 \
+                        and stream.total_out - last > self.span:
+                    self.points.append((stream.total_out, stream.total_in,
+                                        stream.data_type & 7, window))
+                    last = stream.total_out
+        finally:
+            _libz.inflateEnd(ctypes.byref(stream))
+
+    def save(self) -> None:
+        'Write the index atomically to the sidecar file'
+        directory = os.path.dirname(os.path.abspath(self.indexfile))
+        tempfd, temppath = tempfile.mkstemp(dir=directory, prefix='.idx')
+        try:
+            with os.fdopen(tempfd, 'wb') as indexfile:
+                self._write(indexfile)
+            os.replace(temppath, self.indexfile)
+        except BaseException:
+            os.unlink(temppath)
+            raise
+
+    def _write(self, indexfile: Any) -> None:
+        indexfile.write(INDEXMAGIC)
+        indexfile.write(self._identity())
+        indexfile.write(struct.pack('<QIII', self.clamobject.datasize(),
+                                    self.span, len(self.points),
+                                    len(self.members)))
+        for out, position, bits, window in self.points:
+            packed = zlib.compress(window, 1)
+            indexfile.write(struct.pack('<QQBI', out, position, bits,
+                                        len(packed)))
+            indexfile.write(packed)
+        for name, (offset, size) in self.members.items():
+            encoded = name.encode('utf-8', 'surrogateescape')
+            indexfile.write(struct.pack('<QQH', offset, size, len(encoded)))
+            indexfile.write(encoded)
+
+    def load(self) -> bool:
+        """
+            Read the sidecar file, returns False when it is missing or
+            belongs to another version of the file
+        """
+        if self.indexfile is None:
+            return False
+        try:
+            with open(self.indexfile, 'rb') as indexfile:
+                data = indexfile.read()
+        except OSError:
+            return False
+        if data[:8] != INDEXMAGIC or data[8:40] != self._identity():
+            return False
+        try:
+            return self._parse(data)
+        except (struct.error, zlib.error, UnicodeDecodeError, ValueError):
+            # Truncated or damaged, build it again
+            return False
+
+    def _parse(self, data: bytes) -> bool:
+        datasize, span, npoints, nmembers = struct.unpack_from('<QIII', data, 40)
+        if datasize != self.clamobject.datasize() or span != self.span:
+            return False
+        position = 60
+        points: List[Point] = list()
+        for _ in range(npoints):
+            out, offset, bits, size = struct.unpack_from('<QQBI', data, position)
+            position += 21
+            window = zlib.decompress(data[position:position + size])
+            if len(window) > WINSIZE or bits > 7:
+                raise ValueError('Bad seek point')
+            points.append((out, offset, bits, window))
+            position += size
+        members: Dict[str, Tuple[int, int]] = dict()
+        for _ in range(nmembers):
+            offset, size, length = struct.unpack_from('<QQH', data, position)
+            position += 18
+            name = data[position:position + length].decode('utf-8', 'surrogateescape')
+            members[name] = (offset, size)
+            position += length
+        if position != len(data):
+            raise ValueError('Index has trailing data')
+        self.points = points
+        self.members = members
+
+        return True
+
+    def names(self) -> List[str]:
+        """
+            Returns the names of the members in archive order
+        """
+        return list(self.members)
+
+    def open(self, name: str) -> io.BufferedReader:
+        """
+            Returns a binary stream with the content of member name
+        """
+        if name not in self.members:
+            raise KeyError(name)
+        offset, size = self.members[name]
+        point = self.points[bisect.bisect_right([p[0] for p in self.points],
+                                                offset) - 1]
+        raw = _memberreader(self.clamobject, point, offset, size)
+
+        return io.BufferedReader(raw, CHUNKSIZE)
+
+    def read(self, name: str) -> bytes:
+        """
+            Returns the content of member name
+        """
+        with self.open(name) as member:
+            return member.read()
+
+    def iterate(self) -> Iterator[Tuple[str, io.BufferedReader]]:
+        'Yields (name, stream) for every member'
+        for name in self.members:
+            with self.open(name) as member:
+                yield name, member
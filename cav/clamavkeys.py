@@ -0,0 +1,292 @@
+#!/usr/bin/python3
+
+# ClamAV signing keys and signature verification
+# Copyright 2021 Thomas Karlsson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import hmac
+import ctypes
+import ctypes.util
+import hashlib
+import binascii
+import weakref
+import threading
+from typing import List, Dict, Optional, Any
+
+ALPHABET = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789+/'
+_NOTALPHABET = str.maketrans('', '', ALPHABET)
+
+MD5 = 'md5'
+PSS = 'pss'
+# Names of the ClamAV keys, tried before any other key
+OFFICIAL = ('clamav', 'clamav-pss')
+
+
+def _loadlibcrypto() -> Optional[Any]:
+    """
+        Python's pow does not use Montgomery multiplication and spends
+        most of a verification in the modular exponentiation, so use
+        OpenSSL's BN_mod_exp_mont when libcrypto can be loaded
+    """
+    libname = ctypes.util.find_library('crypto')
+    if libname is None:
+        return None
+    try:
+        libcrypto = ctypes.CDLL(libname)
+        pointer = ctypes.c_void_p
+        for function in ('BN_new', 'BN_CTX_new', 'BN_MONT_CTX_new', 'BN_bin2bn'):
+            getattr(libcrypto, function).restype = pointer
+        libcrypto.BN_bin2bn.argtypes = [ctypes.c_char_p, ctypes.c_int, pointer]
+        libcrypto.BN_bn2binpad.argtypes = [pointer, ctypes.c_char_p, ctypes.c_int]
+        libcrypto.BN_MONT_CTX_set.argtypes = [pointer, pointer, pointer]
+        libcrypto.BN_mod_exp_mont.argtypes = [pointer] * 6
+        for function in ('BN_bn2binpad', 'BN_MONT_CTX_set', 'BN_mod_exp_mont'):
+            getattr(libcrypto, function).restype = ctypes.c_int
+        for function in ('BN_free', 'BN_CTX_free', 'BN_MONT_CTX_free'):
+            getattr(libcrypto, function).argtypes = [pointer]
+            getattr(libcrypto, function).restype = None
+    except (OSError, AttributeError):
+        return None
+
+    return libcrypto
+
+
+_libcrypto = _loadlibcrypto()
+
+
+class _bnctx:
+    """
+    BN_CTX of one thread, freed when the thread or the _montgomery that
+    holds it in its threading.local goes away
+    """
+    def __init__(self):
+        # Kept so the context can be freed while the module shuts down
+        self._free = _libcrypto.BN_CTX_free
+        self.ctx = _libcrypto.BN_CTX_new()
+        if not self.ctx:
+            raise MemoryError('BN_CTX_new failed')
+
+    def __del__(self):
+        self._free(self.ctx)
+
+
+def _freemontgomery(libcrypto: Any, n: Any, e: Any, mont: Any) -> None:
+    libcrypto.BN_free(n)
+    libcrypto.BN_free(e)
+    libcrypto.BN_MONT_CTX_free(mont)
+
+
+class _montgomery:
+    'Precomputed OpenSSL state for exponentiation modulo one key'
+    def __init__(self, n: int, e: int):
+        self.nbytes = (n.bit_length() + 7) // 8
+        self.n = _libcrypto.BN_bin2bn(n.to_bytes(self.nbytes, 'big'), self.nbytes, None)
+        ebytes = (e.bit_length() + 7) // 8
+        self.e = _libcrypto.BN_bin2bn(e.to_bytes(ebytes, 'big'), ebytes, None)
+        self.mont = _libcrypto.BN_MONT_CTX_new()
+        self._local = threading.local()
+        # BN_free and BN_MONT_CTX_free accept NULL
+        weakref.finalize(self, _freemontgomery, _libcrypto, self.n, self.e, self.mont)
+        if not (self.n and self.e and self.mont) or \
+                not _libcrypto.BN_MONT_CTX_set(self.mont, self.n, self._ctx()):
+            raise MemoryError('Could not set up Montgomery context')
+
+    def _ctx(self) -> Any:
+        'BN_CTX is scratch space that can not be shared between threads'
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            holder = self._local.holder = _bnctx()
+
+        return holder.ctx
+
+    def pow(self, value: int) -> int:
+        base = _libcrypto.BN_bin2bn(value.to_bytes(self.nbytes, 'big'), self.nbytes, None)
+        result = _libcrypto.BN_new()
+        try:
+            if not _libcrypto.BN_mod_exp_mont(result, base, self.e, self.n,
+                                              self._ctx(), self.mont):
+                raise MemoryError('BN_mod_exp_mont failed')
+            output = ctypes.create_string_buffer(self.nbytes)
+            if _libcrypto.BN_bn2binpad(result, output, self.nbytes) != self.nbytes:
+                raise MemoryError('BN_bn2binpad failed')
+        finally:
+            _libcrypto.BN_free(base)
+            _libcrypto.BN_free(result)
+
+        return int.from_bytes(output.raw, 'big')
+
+
+def decodesignature(signature: str) -> int:
+    """
+        Decode a ClamAV signature string into its integer. The string is
+        base64 with the least significant 6 bits first and the case of the
+        letters swapped, so reversing it and swapping case gives standard
+        base64 of the big endian integer. Returns -1 for invalid strings
+    """
+    if not signature or signature.translate(_NOTALPHABET):
+        return -1
+    reverse = signature[::-1].swapcase()
+    reverse = 'A' * (-len(reverse) % 4) + reverse
+
+    return int.from_bytes(binascii.a2b_base64(reverse), 'big')
+
+
+def encodesignature(value: int, length: int) -> str:
+    """
+        Encode value as a ClamAV signature string of length characters
+    """
+    characters = list()
+    for _ in range(length):
+        characters.append(ALPHABET[value & 63])
+        value >>= 6
+    if value:
+        raise ValueError('Value does not fit in {} characters'.format(length))
+
+    return ''.join(characters)
+
+
+def mgf1(seed: bytes, length: int) -> bytes:
+    'MGF1 mask generation with SHA-256'
+    mask = b''.join(hashlib.sha256(seed + counter.to_bytes(4, 'big')).digest()
+                    for counter in range((length + 31) // 32))
+
+    return mask[:length]
+
+
+class clamavkey:
+    """
+    An RSA key that signs ClamAV files. kind is MD5 for the raw RSA
+    signature of the MD5 in CVD headers and PSS for the RSA-PSS SHA-256
+    signature at the end of cdiff files. d is only needed for signing.
+    """
+    def __init__(self, name: str, n: int, e: int, kind: str = MD5,
+                 d: Optional[int] = None):
+        if kind not in (MD5, PSS):
+            raise ValueError('Unknown key kind {}'.format(kind))
+        self.name = name
+        self.n = n
+        self.e = e
+        self.d = d
+        self.kind = kind
+        self.nbits = n.bit_length()
+        self.nbytes = (self.nbits + 7) // 8
+        # Length of the encoded signature string, 6 bits per character
+        self.siglength = (self.nbits + 5) // 6
+        # RSA-PSS encoded message layout for SHA-256 and a 32 byte salt
+        self.emlength = (self.nbits - 1 + 7) // 8
+        self.dblength = self.emlength - 33
+        self.topmask = 0xff >> (8 * self.emlength - (self.nbits - 1))
+        self._montgomery = _montgomery(n, e) if _libcrypto is not None else None
+
+    def decrypt(self, signature: str) -> int:
+        """
+            Returns signature^e mod n, or -1 for an invalid signature
+        """
+        value = decodesignature(signature)
+        if value < 0 or value >= self.n:
+            return -1
+        if self._montgomery is not None:
+            return self._montgomery.pow(value)
+
+        return pow(value, self.e, self.n)
+
+    def verify(self, signature: str, digest: bytes) -> bool:
+        """
+            Check signature against the MD5 (MD5 keys) or SHA-256 (PSS
+            keys) digest of the signed data
+        """
+        if self.kind == MD5:
+            return self.decrypt(signature) == int.from_bytes(digest, 'big')
+
+        return self.verifypss(signature, digest)
+
+    def verifypss(self, signature: str, digest: bytes) -> bool:
+        plain = self.decrypt(signature)
+        if plain < 0 or plain >> (8 * self.emlength):
+            return False
+        encoded = plain.to_bytes(self.emlength, 'big')
+        if encoded[-1] != 0xbc:
+            return False
+        maskeddb = encoded[:self.dblength]
+        messagehash = encoded[self.dblength:-1]
+        db = bytearray((int.from_bytes(maskeddb, 'big') ^
+                        int.from_bytes(mgf1(messagehash, self.dblength), 'big')).to_bytes(self.dblength, 'big'))
+        db[0] &= self.topmask
+        saltposition = db.find(1)
+        if saltposition < 0:
+            return False
+        salt = bytes(db[saltposition + 1:saltposition + 33])
+        check = hashlib.sha256(b'\x00' * 8 + digest + salt).digest()
+
+        return hmac.compare_digest(check, messagehash)
+
+    def sign(self, digest: bytes) -> str:
+        """
+            Returns the signature string of the MD5 (MD5 keys) or SHA-256
+            (PSS keys) digest, needs the private exponent d
+        """
+        if self.d is None:
+            raise ValueError('Key {} has no private exponent'.format(self.name))
+        if self.kind == MD5:
+            plain = int.from_bytes(digest, 'big')
+        else:
+            salt = os.urandom(32)
+            messagehash = hashlib.sha256(b'\x00' * 8 + digest + salt).digest()
+            db = b'\x00' * (self.dblength - 33) + b'\x01' + salt
+            maskeddb = bytearray((int.from_bytes(db, 'big') ^
+                                  int.from_bytes(mgf1(messagehash, self.dblength), 'big')).to_bytes(self.dblength, 'big'))
+            maskeddb[0] &= self.topmask
+            plain = int.from_bytes(bytes(maskeddb) + messagehash + b'\xbc', 'big')
+
+        return encodesignature(pow(plain, self.d, self.n), self.siglength)
+
+
+_registry: Dict[str, clamavkey] = dict()
+
+
+def registerkey(key: clamavkey) -> None:
+    """
+        Add key to the keys tried when verifying, replacing any key with
+        the same name
+    """
+    _registry[key.name] = key
+
+
+def unregisterkey(name: str) -> None:
+    _registry.pop(name, None)
+
+
+def getkey(name: str) -> clamavkey:
+    return _registry[name]
+
+
+def keys(kind: str, names: Optional[List[str]] = None) -> List[clamavkey]:
+    """
+        Returns the registered keys of kind, limited to names when given,
+        with the official ClamAV keys first
+    """
+    found = [key for key in _registry.values()
+             if key.kind == kind and (names is None or key.name in names)]
+
+    return sorted(found, key=lambda key: key.name not in OFFICIAL)
+
+
+CLAMAVKEY = clamavkey('clamav', 118640995551645342603070001658453189751527774412027743746599405743243142607464144767361060640655844749760788890022283424922762488917565551002467771109669598189410434699034532232228621591089508178591428456220796841621637175567590476666928698770143328137383952820383197532047771780196576957695822641224262693037,
+                      100001027, MD5)
+CLAMAVPSSKEY = clamavkey('clamav-pss', 14783905874077467090262228516557917570254599638376203532031989214105552847269687489771975792123442185817287694951949800908791527542017115600501303394778618535864845235700041590056318230102449612217458549016089313306591388590790796515819654102320725712300822356348724011232654837503241736177907784198700834440681124727060540035754699658105895050096576226753008596881698828185652424901921668758326578462003247906470982092298106789657211905488986281078346361469524484829559560886227198091995498440676639639830463593211386055065360288422394053998134458623712540683294034953818412458362198117811990006021989844180721010947,
+                         100002053, PSS)
+registerkey(CLAMAVKEY)
+registerkey(CLAMAVPSSKEY)
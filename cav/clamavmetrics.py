@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+
+# Optional timers and counters for ClamAV file handling
+# Copyright 2021 Thomas Karlsson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import threading
+import contextlib
+from typing import List, Dict, Optional, Callable, Iterator, Any
+
+# Phases timed by the instrumented modules
+READ = 'read'
+HASH = 'hash'
+RSA = 'rsa'
+PSS = 'pss'
+VERIFY = 'verify'
+DNS = 'dns'
+# One nameserver round trip, DNS includes cache hits and retries
+DNSRTT = 'dns_rtt'
+
+TIMER = 'timer'
+COUNTER = 'counter'
+
+# Receives (TIMER or COUNTER, name, value) for every event
+Callback = Callable[[str, str, float], Any]
+
+clock = time.perf_counter
+
+
+class clamavmetrics:
+    """
+    Per-phase timers and counters. The instrumented code asks active()
+    once per call and skips all bookkeeping when it returns None, so
+    disabled metrics cost one function call and a comparison.
+
+    Timers keep count, total and maximum seconds per phase, counters a
+    running total. Both are exported with snapshot(), prometheus() or
+    as events to callbacks added with subscribe().
+    """
+    def __init__(self):
+        self.timers: Dict[str, List[float]] = dict()
+        self.counters: Dict[str, float] = dict()
+        self._callbacks: List[Callback] = list()
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback: Callback) -> None:
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback: Callback) -> None:
+        self._callbacks.remove(callback)
+
+    def observe(self, phase: str, seconds: float, count: int = 1) -> None:
+        """
+            Add seconds spent in phase over count calls
+        """
+        with self._lock:
+            timer = self.timers.get(phase)
+            if timer is None:
+                timer = self.timers[phase] = [0, 0.0, 0.0]
+            timer[0] += count
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds / count if count else 0.0)
+        for callback in self._callbacks:
+            callback(TIMER, phase, seconds)
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        for callback in self._callbacks:
+            callback(COUNTER, name, value)
+
+    @contextlib.contextmanager
+    def time(self, phase: str) -> Iterator[None]:
+        started = clock()
+        try:
+            yield
+        finally:
+            self.observe(phase, clock() - started)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.timers.clear()
+            self.counters.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+            Returns {'timers': {phase: {'count', 'seconds', 'max'}},
+            'counters': {name: total}} plus hash throughput in bytes per
+            second when anything was hashed
+        """
+        with self._lock:
+            timers = {phase: {'count': timer[0], 'seconds': timer[1], 'max': timer[2]}
+                      for phase, timer in self.timers.items()}
+            counters = dict(self.counters)
+        result: Dict[str, Any] = {'timers': timers, 'counters': counters}
+        if HASH in timers and timers[HASH]['seconds'] > 0:
+            result['hashthroughput'] = counters.get('hashed_bytes', 0) / timers[HASH]['seconds']
+
+        return result
+
+    def prometheus(self, prefix: str = 'cav') -> str:
+        """
+            Returns the metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines: List[str] = list()
+        if snapshot['timers']:
+            name = '{}_phase_seconds'.format(prefix)
+            lines.append('# HELP {} Time spent per phase'.format(name))
+            lines.append('# TYPE {} summary'.format(name))
+            for phase, timer in sorted(snapshot['timers'].items()):
+                lines.append('{}_sum{{phase="{}"}} {!r}'.format(name, phase, timer['seconds']))
+                lines.append('{}_count{{phase="{}"}} {}'.format(name, phase, timer['count']))
+            name = '{}_phase_max_seconds'.format(prefix)
+            lines.append('# TYPE {} gauge'.format(name))
+            for phase, timer in sorted(snapshot['timers'].items()):
+                lines.append('{}{{phase="{}"}} {!r}'.format(name, phase, timer['max']))
+        for counter, value in sorted(snapshot['counters'].items()):
+            name = '{}_{}_total'.format(prefix, counter)
+            lines.append('# TYPE {} counter'.format(name))
+            lines.append('{} {}'.format(name, _number(value)))
+        if 'hashthroughput' in snapshot:
+            name = '{}_hash_bytes_per_second'.format(prefix)
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {!r}'.format(name, float(snapshot['hashthroughput'])))
+
+        return ''.join(line + '\n' for line in lines)
+
+
+def _number(value: float) -> str:
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+
+_active: Optional[clamavmetrics] = None
+
+
+def enable(metrics: Optional[clamavmetrics] = None) -> clamavmetrics:
+    """
+        Start collecting into metrics, a new clamavmetrics by default.
+        Returns the collecting object
+    """
+    global _active
+    _active = metrics if metrics is not None else clamavmetrics()
+
+    return _active
+
+
+def disable() -> Optional[clamavmetrics]:
+    """
+        Stop collecting, returns what was collected
+    """
+    global _active
+    metrics, _active = _active, None
+
+    return metrics
+
+
+def active() -> Optional[clamavmetrics]:
+    return _active
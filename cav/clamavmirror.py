@@ -0,0 +1,433 @@
+#!/usr/bin/python3
+
+# Download ClamAV files from a mirror over pooled HTTP connections
+# Copyright 2021 Thomas Karlsson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import ssl
+import json
+import hashlib
+import asyncio
+import contextlib
+import urllib.parse
+from typing import List, Dict, Tuple, Optional, Any, AsyncIterator
+from .clamavfile import clamavfile, CHUNKSIZE
+from .clamavdns import clamavdns
+from .clamavplanner import clamavplanner
+
+USERAGENT = 'cav'
+STATEFILE = 'mirror.state'
+
+
+class streamverifier:
+    """
+    Check the signature of a ClamAV file while it is being received.
+    The file is hashed as bytes are passed to update, holding back only
+    the last HOLDBACK bytes that can contain the cdiff signature, so
+    finish only hashes the tail. Anything that is not a CVD or cdiff is
+    rejected with ValueError as soon as the magic header has arrived.
+    """
+    HOLDBACK = 350
+
+    def __init__(self, keynames: Optional[List[str]] = None):
+        self.keynames = keynames
+        self.size = 0
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.magicheader: Optional[str] = None
+        self.hashobject: Any = None
+        # Offset of the first hashed byte and of the first byte in tail
+        self._start = 0
+        self._position = 0
+
+    def update(self, data: bytes) -> None:
+        if len(self.head) < 512:
+            self.head += data[:512 - len(self.head)]
+        self.tail += data
+        self.size += len(data)
+        if self.magicheader is None:
+            if len(self.head) < 12:
+                return
+            self.magicheader = self.head[:12].split(b':', 1)[0].decode('utf-8', 'replace')
+            if self.magicheader == 'ClamAV-VDB':
+                self.hashobject = hashlib.md5()
+                self._start = 512
+            elif self.magicheader == 'ClamAV-Diff':
+                self.hashobject = hashlib.sha256()
+            else:
+                raise ValueError('Not a ClamAV file: {}'.format(self.magicheader))
+        excess = len(self.tail) - self.HOLDBACK
+        if excess > 0:
+            self._hash(excess)
+
+    def _hash(self, count: int) -> None:
+        'Hash the first count bytes of tail and drop them'
+        skip = max(0, min(count, self._start - self._position))
+        self.hashobject.update(memoryview(self.tail)[skip:count])
+        del self.tail[:count]
+        self._position += count
+
+    def finish(self) -> Tuple[bool, str]:
+        """
+            Returns whether the signature is valid and the hex digest of
+            the signed data, '' when there is no signature to check
+        """
+        if self._position == 0:
+            data = bytes(self.tail)
+        else:
+            data = bytes(self.head) + bytes(self.tail)
+        # Only the header and footer of this object describe the file
+        clamobject = clamavfile.from_bytes(data)
+        clamobject.keynames = self.keynames
+        if self.hashobject is None or clamobject.signature() == '':
+            return False, ''
+        self._hash(len(self.tail) - clamobject.footersize())
+
+        return clamobject._checkdigest(self.hashobject.digest()), self.hashobject.hexdigest()
+
+
+class fetchresult:
+    'Outcome of fetching one file'
+    def __init__(self, filename: str, ok: bool = False, status: int = 0,
+                 received: int = 0, resumedfrom: int = 0, version: int = 0,
+                 unchanged: bool = False, error: Optional[str] = None):
+        self.filename = filename
+        self.ok = ok
+        self.status = status
+        self.received = received
+        self.resumedfrom = resumedfrom
+        self.version = version
+        self.unchanged = unchanged
+        self.error = error
+
+    def text(self) -> str:
+        if self.unchanged:
+            return 'UNCHANGED {}'.format(self.filename)
+        line = '{} {} {} {} bytes'.format('OK' if self.ok else 'FAIL', self.filename,
+                                          self.status, self.received)
+        if self.resumedfrom:
+            line += ' resumed at {}'.format(self.resumedfrom)
+        if self.error:
+            line += ' ({})'.format(self.error)
+
+        return line
+
+
+class _response:
+    'Status, headers and streamed body of one HTTP response'
+    def __init__(self, reader: asyncio.StreamReader, timeout: float):
+        self.reader = reader
+        self.timeout = timeout
+        self.status = 0
+        self.headers: Dict[str, str] = dict()
+        self.keepalive = True
+        self.complete = False
+
+    async def _read(self, coroutine: Any) -> Any:
+        return await asyncio.wait_for(coroutine, self.timeout)
+
+    async def readheaders(self) -> None:
+        statusline = await self._read(self.reader.readline())
+        if not statusline:
+            raise ConnectionError('Connection closed by server')
+        version, status = statusline.split(None, 2)[:2]
+        self.status = int(status)
+        while True:
+            line = await self._read(self.reader.readline())
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            self.headers[name.strip().lower()] = value.strip()
+        connection = self.headers.get('connection', '').lower()
+        self.keepalive = version == b'HTTP/1.1' and connection != 'close' or \
+            connection == 'keep-alive'
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        """
+            Yields the body, complete is set once all of it was read
+        """
+        if self.status in (204, 304) or 100 <= self.status < 200:
+            self.complete = True
+            return
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                sizeline = await self._read(self.reader.readline())
+                remaining = int(sizeline.split(b';', 1)[0], 16)
+                if remaining == 0:
+                    while await self._read(self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                while remaining:
+                    chunk = await self._read(self.reader.read(min(CHUNKSIZE, remaining)))
+                    if not chunk:
+                        raise asyncio.IncompleteReadError(b'', remaining)
+                    remaining -= len(chunk)
+                    yield chunk
+                await self._read(self.reader.readexactly(2))
+        elif 'content-length' in self.headers:
+            remaining = int(self.headers['content-length'])
+            while remaining:
+                chunk = await self._read(self.reader.read(min(CHUNKSIZE, remaining)))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            self.keepalive = False
+            while True:
+                chunk = await self._read(self.reader.read(CHUNKSIZE))
+                if not chunk:
+                    break
+                yield chunk
+        self.complete = True
+
+    async def drain(self) -> None:
+        'Read and drop the body so the connection can be reused'
+        async for _ in self.chunks():
+            pass
+
+
+class _connectionpool:
+    """
+    Keep-alive HTTP/1.1 connections to one server, at most connections
+    requests are in flight at a time and idle connections are reused
+    """
+    def __init__(self, baseurl: str, connections: int, timeout: float):
+        url = urllib.parse.urlsplit(baseurl)
+        self.host = url.hostname or 'localhost'
+        self.tls = url.scheme == 'https'
+        self.port = url.port or (443 if self.tls else 80)
+        self.path = url.path.rstrip('/')
+        self.timeout = timeout
+        self.opened = 0
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = list()
+        self._semaphore = asyncio.Semaphore(connections)
+
+    async def _open(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        context = ssl.create_default_context() if self.tls else None
+        connection = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context), self.timeout)
+        self.opened += 1
+
+        return connection
+
+    def _request(self, filename: str, headers: Dict[str, str]) -> bytes:
+        lines = ['GET {}/{} HTTP/1.1'.format(self.path, urllib.parse.quote(filename)),
+                 'Host: {}'.format(self.host if self.port in (80, 443)
+                                   else '{}:{}'.format(self.host, self.port)),
+                 'User-Agent: {}'.format(USERAGENT)]
+        lines += ['{}: {}'.format(name, value) for name, value in headers.items()]
+
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    @contextlib.asynccontextmanager
+    async def get(self, filename: str, headers: Dict[str, str]) -> AsyncIterator[_response]:
+        async with self._semaphore:
+            while True:
+                reused = bool(self._idle)
+                reader, writer = self._idle.pop() if reused else await self._open()
+                response = _response(reader, self.timeout)
+                try:
+                    writer.write(self._request(filename, headers))
+                    await writer.drain()
+                    await response.readheaders()
+                    break
+                except (OSError, asyncio.IncompleteReadError):
+                    writer.close()
+                    # The server may have closed an idle connection
+                    if not reused:
+                        raise
+                except BaseException:
+                    # Timed out or cancelled halfway through a response
+                    writer.close()
+                    raise
+            try:
+                yield response
+            finally:
+                if response.complete and response.keepalive:
+                    self._idle.append((reader, writer))
+                else:
+                    writer.close()
+
+    def close(self) -> None:
+        for _, writer in self._idle:
+            writer.close()
+        self._idle.clear()
+
+
+class clamavmirror:
+    """
+    Fetch CVD and cdiff files from baseurl into directory. At most
+    connections downloads run at a time over reused connections.
+
+    Files are received into a hidden .part file while their signature is
+    checked, and only renamed to their real name when it is valid.
+    ETag and Last-Modified of complete and partial files are kept in
+    mirror.state, unchanged files are not downloaded again and
+    interrupted downloads are resumed with a Range request.
+    """
+    def __init__(self, baseurl: str, directory: str, connections: int = 4,
+                 timeout: float = 30.0, keynames: Optional[List[str]] = None):
+        self.directory = directory
+        self.keynames = keynames
+        self.statefile = os.path.join(directory, STATEFILE)
+        self._pool = _connectionpool(baseurl, connections, timeout)
+        self._state: Dict[str, Dict[str, Any]] = self._loadstate()
+
+    def _loadstate(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.statefile, 'r') as statefile:
+                return json.load(statefile)
+        except (OSError, ValueError):
+            return dict()
+
+    def _savestate(self) -> None:
+        temppath = self.statefile + '.tmp'
+        with open(temppath, 'w') as statefile:
+            json.dump(self._state, statefile, indent='  ')
+        os.replace(temppath, self.statefile)
+
+    def _partpath(self, filename: str) -> str:
+        return os.path.join(self.directory, '.' + filename + '.part')
+
+    def _conditions(self, filename: str) -> Tuple[Dict[str, str], int]:
+        'Request headers and the offset a partial download resumes at'
+        headers: Dict[str, str] = dict()
+        state = self._state.get(filename, dict())
+        if os.path.exists(os.path.join(self.directory, filename)):
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('lastmodified'):
+                headers['If-Modified-Since'] = state['lastmodified']
+        offset = 0
+        validator = state.get('partetag') or state.get('partlastmodified')
+        if validator:
+            try:
+                offset = os.path.getsize(self._partpath(filename))
+            except OSError:
+                offset = 0
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            headers['If-Range'] = validator
+
+        return headers, offset
+
+    async def fetch(self, filename: str) -> fetchresult:
+        """
+            Download filename unless it is unchanged. Never raises for
+            network or verification errors, they are in the result
+        """
+        if os.path.basename(filename) != filename or filename.startswith('.'):
+            return fetchresult(filename, error='Invalid file name')
+        result = fetchresult(filename)
+        headers, offset = self._conditions(filename)
+        try:
+            async with self._pool.get(filename, headers) as response:
+                result.status = response.status
+                if response.status == 304:
+                    await response.drain()
+                    result.ok = result.unchanged = True
+                    return result
+                if response.status == 206 and \
+                        response.headers.get('content-range', '').startswith('bytes {}-'.format(offset)):
+                    result.resumedfrom = offset
+                elif response.status != 200:
+                    result.error = 'HTTP status {}'.format(response.status)
+                    await response.drain()
+                    return result
+                await self._receive(filename, response, result)
+        except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as error:
+            result.error = str(error) or type(error).__name__
+
+        return result
+
+    async def _receive(self, filename: str, response: _response,
+                       result: fetchresult) -> None:
+        partpath = self._partpath(filename)
+        state = self._state.setdefault(filename, dict())
+        state['partetag'] = response.headers.get('etag')
+        state['partlastmodified'] = response.headers.get('last-modified')
+        self._savestate()
+        verifier = streamverifier(self.keynames)
+        with open(partpath, 'r+b' if result.resumedfrom else 'wb') as partfile:
+            if result.resumedfrom:
+                for chunk in iter(lambda: partfile.read(CHUNKSIZE), b''):
+                    verifier.update(chunk)
+                partfile.truncate(result.resumedfrom)
+            try:
+                async for chunk in response.chunks():
+                    verifier.update(chunk)
+                    partfile.write(chunk)
+                    result.received += len(chunk)
+            except ValueError:
+                partfile.close()
+                self._discard(filename)
+                raise
+            partfile.flush()
+            os.fsync(partfile.fileno())
+        try:
+            ok, _ = verifier.finish()
+            result.version = clamavfile(partpath).version()
+        except (ValueError, IndexError):
+            self._discard(filename)
+            raise ValueError('Malformed ClamAV header')
+        if not ok:
+            self._discard(filename)
+            result.error = 'signature mismatch'
+            return
+        os.replace(partpath, os.path.join(self.directory, filename))
+        self._state[filename] = {'etag': state['partetag'],
+                                 'lastmodified': state['partlastmodified'],
+                                 'size': verifier.size}
+        self._savestate()
+        result.ok = True
+
+    def _discard(self, filename: str) -> None:
+        with contextlib.suppress(OSError):
+            os.unlink(self._partpath(filename))
+        state = self._state.get(filename, dict())
+        state.pop('partetag', None)
+        state.pop('partlastmodified', None)
+        self._savestate()
+
+    async def fetchall(self, filenames: List[str]) -> List[fetchresult]:
+        """
+            Fetch filenames concurrently, results are in the same order
+        """
+        return list(await asyncio.gather(*[self.fetch(filename) for filename in filenames]))
+
+    async def sync(self, record: Optional[clamavdns] = None,
+                   databases: Optional[List[str]] = None) -> List[fetchresult]:
+        """
+            Bring the databases up to the versions in record, looked up
+            in DNS when not given, following the clamavplanner plan and
+            falling back to the full CVD when a cdiff can not be fetched
+        """
+        if record is None:
+            record = clamavdns()
+            await record.query()
+        plans = clamavplanner(self.directory).plan(record, databases)
+        results: List[fetchresult] = list()
+        for plan in plans.values():
+            fetched = await self.fetchall(plan.fetch())
+            results += fetched
+            if not plan.full and not all(result.ok for result in fetched):
+                results.append(await self.fetch(plan.database + '.cvd'))
+
+        return results
+
+    def close(self) -> None:
+        self._pool.close()
@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+
+# Plan the cheapest update from local ClamAV files to the DNS version
+# Copyright 2021 Thomas Karlsson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+from typing import List, Dict, Tuple, Optional, Callable
+from .clamavfile import clamavfile
+from .clamavdns import clamavdns
+
+# Database name and the clamavdns method with its advertised version
+DATABASES = {'main': 'mainversion', 'daily': 'dailyversion',
+             'bytecode': 'bytecodeversion', 'safebrowsing': 'safebrowsingversion'}
+FULLEXTENSIONS = ('.cvd', '.cld')
+
+_CDIFFNAME = re.compile(r'^([A-Za-z0-9_]+)-([0-9]+)\.cdiff$')
+_FULLNAME = re.compile(r'^([A-Za-z0-9_]+)\.(cvd|cld)$')
+
+# Remote file name to its size in bytes, None when the mirror lacks it
+Sizes = Callable[[str], Optional[int]]
+
+
+def cdiffname(database: str, version: int) -> str:
+    return '{}-{}.cdiff'.format(database, version)
+
+
+class localdatabase:
+    'What the local directory holds of one database'
+    def __init__(self, name: str):
+        self.name = name
+        self.path: Optional[str] = None
+        self.version = 0
+        self.size = 0
+        self.cdiffs: Dict[int, Tuple[str, int]] = dict()
+        self.stale: List[str] = list()
+
+
+class updateplan:
+    """
+    How to bring one database from localversion to targetversion. Either
+    cdiffs lists (version, local path or None, bytes to fetch) in the
+    order to apply them, or full is True and the whole CVD is fetched.
+    gaps are the versions missing from the local cdiff history and stale
+    the local files that are wrong or newer than targetversion. cdiffs
+    at or below localversion are history a mirror keeps for clients
+    that lag behind, they are not stale.
+    """
+    def __init__(self, database: str, localversion: int, targetversion: int):
+        self.database = database
+        self.localversion = localversion
+        self.targetversion = targetversion
+        self.cdiffs: List[Tuple[int, Optional[str], int]] = list()
+        self.full = False
+        self.fullsize: Optional[int] = None
+        self.chainsize: Optional[int] = None
+        self.reason = ''
+        self.gaps: List[int] = list()
+        self.stale: List[str] = list()
+
+    def uptodate(self) -> bool:
+        return not self.full and not self.cdiffs
+
+    def fetch(self) -> List[str]:
+        """
+            Returns the remote file names to download, in order
+        """
+        if self.full:
+            return [self.database + '.cvd']
+
+        return [cdiffname(self.database, version)
+                for version, path, _ in self.cdiffs if path is None]
+
+    def bytes(self) -> int:
+        """
+            Returns the bytes to download, unknown sizes count as 0
+        """
+        if self.full:
+            return self.fullsize or 0
+
+        return sum(size for _, _, size in self.cdiffs)
+
+    def text(self) -> str:
+        if self.uptodate():
+            line = '{} {} up to date'.format(self.database, self.localversion)
+        elif self.full:
+            line = '{} {} -> {} full {} ({} bytes)'.format(self.database, self.localversion,
+                                                          self.targetversion,
+                                                          self.database + '.cvd', self.bytes())
+        else:
+            line = '{} {} -> {} {} cdiffs, {} to fetch ({} bytes)'.format(
+                self.database, self.localversion, self.targetversion,
+                len(self.cdiffs), len(self.fetch()), self.bytes())
+        if self.reason:
+            line += ', ' + self.reason
+        if self.gaps:
+            line += ', gaps ' + ','.join(str(version) for version in self.gaps)
+        if self.stale:
+            line += ', stale ' + ','.join(self.stale)
+
+        return line
+
+
+class clamavplanner:
+    """
+    Compare the files in directory with the versions advertised in DNS
+    and plan the fewest bytes to download. Only file headers are read.
+
+    sizes gives the size of remote files and returns None for files the
+    mirror does not have, which breaks a cdiff chain. Without it sizes
+    are estimated from the local files: a missing cdiff is as large as
+    the median local cdiff and the CVD as large as the local one.
+    maxchain limits the number of cdiffs to download before a full CVD
+    is used instead, like mirrors that only keep recent cdiffs.
+    """
+    def __init__(self, directory: str, sizes: Optional[Sizes] = None,
+                 maxchain: Optional[int] = None):
+        self.directory = directory
+        self.sizes = sizes
+        self.maxchain = maxchain
+
+    def inventory(self) -> Dict[str, localdatabase]:
+        """
+            Returns the local databases by name
+        """
+        databases: Dict[str, localdatabase] = dict()
+        for filename in sorted(os.listdir(self.directory)):
+            cdiffmatch = _CDIFFNAME.match(filename)
+            fullmatch = _FULLNAME.match(filename)
+            if cdiffmatch is None and fullmatch is None:
+                continue
+            name = (cdiffmatch or fullmatch).group(1)
+            database = databases.setdefault(name, localdatabase(name))
+            path = os.path.join(self.directory, filename)
+            try:
+                clamobject = clamavfile(path)
+                version = clamobject.version()
+                size = clamobject.filesize
+            except (OSError, ValueError, IndexError):
+                database.stale.append(filename)
+                continue
+            if cdiffmatch is not None:
+                if clamobject.magicheader != 'ClamAV-Diff' or version != int(cdiffmatch.group(2)):
+                    database.stale.append(filename)
+                    continue
+                database.cdiffs[version] = (path, size)
+            elif clamobject.magicheader != 'ClamAV-VDB':
+                database.stale.append(filename)
+            elif version > database.version:
+                if database.path is not None:
+                    database.stale.append(os.path.basename(database.path))
+                database.path, database.version, database.size = path, version, size
+            else:
+                database.stale.append(filename)
+
+        return databases
+
+    def _remotesize(self, database: localdatabase, filename: str) -> Optional[int]:
+        if self.sizes is not None:
+            return self.sizes(filename)
+        if filename.endswith('.cdiff'):
+            sizes = sorted(size for _, size in database.cdiffs.values())
+            return sizes[len(sizes) // 2] if sizes else 0
+
+        return database.size or None
+
+    def planone(self, database: localdatabase, targetversion: int) -> updateplan:
+        """
+            Plan the update of one database to targetversion
+        """
+        plan = updateplan(database.name, database.version, targetversion)
+        plan.stale = list(database.stale)
+        for version, (path, _) in sorted(database.cdiffs.items()):
+            if version > targetversion:
+                plan.stale.append(os.path.basename(path))
+        if database.cdiffs:
+            plan.gaps = [version for version in range(min(database.cdiffs), targetversion + 1)
+                         if version not in database.cdiffs]
+        if targetversion <= database.version:
+            return plan
+
+        chain: List[Tuple[int, Optional[str], int]] = list()
+        plan.chainsize = 0
+        if database.path is None:
+            plan.reason = 'no local database'
+            plan.chainsize = None
+        for version in range(database.version + 1, targetversion + 1):
+            if plan.chainsize is None:
+                break
+            if version in database.cdiffs:
+                chain.append((version, database.cdiffs[version][0], 0))
+                continue
+            size = self._remotesize(database, cdiffname(database.name, version))
+            if size is None:
+                plan.reason = 'cdiff {} not available'.format(version)
+                plan.chainsize = None
+            else:
+                chain.append((version, None, size))
+                plan.chainsize += size
+        fetches = sum(1 for _, path, _ in chain if path is None)
+        if plan.chainsize is not None and self.maxchain is not None and fetches > self.maxchain:
+            plan.reason = 'chain of {} cdiffs is longer than {}'.format(fetches, self.maxchain)
+            plan.chainsize = None
+        plan.fullsize = self._remotesize(database, database.name + '.cvd')
+        if plan.chainsize is not None and (plan.fullsize is None or
+                                           plan.chainsize <= plan.fullsize):
+            plan.cdiffs = chain
+        else:
+            plan.full = True
+            if plan.chainsize is not None:
+                plan.reason = 'cdiffs are larger than the full database'
+
+        return plan
+
+    def plan(self, record: clamavdns,
+             databases: Optional[List[str]] = None) -> Dict[str, updateplan]:
+        """
+            Plan the update of each database, by default those with a
+            version in record that are present locally
+        """
+        inventory = self.inventory()
+        if databases is None:
+            databases = [name for name in DATABASES if name in inventory]
+        plans: Dict[str, updateplan] = dict()
+        for name in databases:
+            targetversion = int(getattr(record, DATABASES[name])())
+            plans[name] = self.planone(inventory.get(name, localdatabase(name)),
+                                       targetversion)
+
+        return plans
@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+
+# Asynchronous DNS TXT resolver for the ClamAV version record
+# Copyright 2021 Thomas Karlsson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import random
+import struct
+import asyncio
+from typing import List, Dict, Tuple, Optional, Union
+from . import clamavmetrics
+
+TYPE_TXT = 16
+CLASS_IN = 1
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+
+Nameserver = Tuple[str, int]
+
+
+class dnserror(Exception):
+    'No usable answer from any nameserver'
+
+
+def encodequery(queryid: int, name: str, qtype: int = TYPE_TXT) -> bytes:
+    """
+        Returns a recursive DNS query for name
+    """
+    question = b''
+    for label in name.rstrip('.').split('.'):
+        encoded = label.encode('idna')
+        if not 0 < len(encoded) < 64:
+            raise ValueError('Invalid DNS name {}'.format(name))
+        question += bytes([len(encoded)]) + encoded
+    question += b'\x00' + struct.pack('>HH', qtype, CLASS_IN)
+
+    return struct.pack('>HHHHHH', queryid, FLAG_RD, 1, 0, 0, 0) + question
+
+
+def _readname(message: bytes, offset: int) -> Tuple[str, int]:
+    'Read a possibly compressed name, returns it and the offset after it'
+    labels: List[str] = list()
+    end = -1
+    jumps = 0
+    while True:
+        length = message[offset]
+        if length & 0xc0 == 0xc0:
+            if end < 0:
+                end = offset + 2
+            jumps += 1
+            if jumps > 32:
+                raise dnserror('Compression loop in DNS name')
+            offset = struct.unpack_from('>H', message, offset)[0] & 0x3fff
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(message[offset:offset + length].decode('ascii', 'replace'))
+        offset += length
+
+    return '.'.join(labels), end if end >= 0 else offset
+
+
+def decoderesponse(message: bytes, queryid: int,
+                   name: str) -> Tuple[bool, List[str], int]:
+    """
+        Parse a response to encodequery. Returns (truncated, TXT records,
+        smallest TTL) and raises dnserror for responses that do not answer
+        the query
+    """
+    try:
+        responseid, flags, qdcount, ancount, _, _ = struct.unpack_from('>HHHHHH', message)
+        if responseid != queryid or not flags & FLAG_QR:
+            raise dnserror('Response does not match the query')
+        if flags & FLAG_TC:
+            return True, list(), 0
+        if flags & 0x000f:
+            raise dnserror('Server answered with rcode {}'.format(flags & 0x000f))
+        offset = 12
+        for _ in range(qdcount):
+            qname, offset = _readname(message, offset)
+            if qname.lower() != name.rstrip('.').lower():
+                raise dnserror('Response is for another name')
+            offset += 4
+        records: List[str] = list()
+        ttl = 2 ** 31 - 1
+        for _ in range(ancount):
+            _, offset = _readname(message, offset)
+            rtype, rclass, rttl, rdlength = struct.unpack_from('>HHIH', message, offset)
+            offset += 10
+            rdata = message[offset:offset + rdlength]
+            if len(rdata) != rdlength:
+                raise dnserror('Truncated resource record')
+            offset += rdlength
+            if rtype != TYPE_TXT or rclass != CLASS_IN:
+                continue
+            strings: List[bytes] = list()
+            position = 0
+            while position < len(rdata):
+                length = rdata[position]
+                strings.append(rdata[position + 1:position + 1 + length])
+                position += 1 + length
+            records.append(b''.join(strings).decode('ascii', 'replace'))
+            ttl = min(ttl, rttl)
+    except (struct.error, IndexError) as error:
+        raise dnserror('Malformed DNS response: {}'.format(error))
+    if not records:
+        raise dnserror('No TXT record in response')
+
+    return False, records, ttl
+
+
+class _udpclient(asyncio.DatagramProtocol):
+    def __init__(self, queryid: int, name: str):
+        self.queryid = queryid
+        self.name = name
+        self.answer: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        if self.answer.done():
+            return
+        try:
+            self.answer.set_result(decoderesponse(data, self.queryid, self.name))
+        except dnserror:
+            # Keep waiting, a spoofed or stray datagram must not win
+            pass
+
+    def error_received(self, exc: Exception) -> None:
+        if not self.answer.done():
+            self.answer.set_exception(exc)
+
+
+def systemnameservers(resolvconf: str = '/etc/resolv.conf') -> List[Nameserver]:
+    """
+        Returns the nameservers from resolv.conf, or localhost
+    """
+    nameservers: List[Nameserver] = list()
+    try:
+        with open(resolvconf, 'r') as configuration:
+            for line in configuration:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    nameservers.append((fields[1], 53))
+    except OSError:
+        pass
+
+    return nameservers or [('127.0.0.1', 53)]
+
+
+class clamavresolver:
+    """
+    Asynchronous TXT lookups that race all nameservers, retry with
+    exponential backoff, repeat truncated answers over TCP and cache
+    answers for their TTL. Concurrent lookups of the same name share
+    one upstream query.
+    """
+    def __init__(self, nameservers: Optional[List[Union[str, Nameserver]]] = None,
+                 timeout: float = 2.0, attempts: int = 3, backoff: float = 0.25,
+                 maxttl: int = 3600):
+        if nameservers is None:
+            nameservers = list(systemnameservers())
+        self.nameservers: List[Nameserver] = [(server, 53) if isinstance(server, str)
+                                              else server for server in nameservers]
+        self.timeout = timeout
+        self.attempts = attempts
+        self.backoff = backoff
+        self.maxttl = maxttl
+        self.upstreamqueries = 0
+        self.cachehits = 0
+        self._cache: Dict[str, Tuple[float, List[str]]] = dict()
+        self._inflight: Dict[str, asyncio.Future] = dict()
+
+    def flush(self) -> None:
+        self._cache.clear()
+
+    async def txt(self, name: str) -> List[str]:
+        """
+            Returns the TXT records of name
+        """
+        loop = asyncio.get_running_loop()
+        key = name.rstrip('.').lower()
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] > loop.time():
+            self._cachehit()
+            return cached[1]
+        if key in self._inflight:
+            self._cachehit()
+            return await asyncio.shield(self._inflight[key])
+        future = loop.create_task(self._lookup(key, name))
+        self._inflight[key] = future
+
+        return await asyncio.shield(future)
+
+    async def _lookup(self, key: str, name: str) -> List[str]:
+        'Resolve name for everyone waiting on key and cache the answer'
+        try:
+            records, ttl = await self._resolve(name)
+            self._cache[key] = (asyncio.get_running_loop().time() + min(ttl, self.maxttl),
+                                records)
+        finally:
+            self._inflight.pop(key, None)
+
+        return records
+
+    def _cachehit(self) -> None:
+        self.cachehits += 1
+        metrics = clamavmetrics.active()
+        if metrics is not None:
+            metrics.count('dns_cache_hits')
+
+    async def _resolve(self, name: str) -> Tuple[List[str], int]:
+        lasterror: Exception = dnserror('No nameservers')
+        for attempt in range(self.attempts):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            queries = [asyncio.ensure_future(self._query(server, name))
+                       for server in self.nameservers]
+            try:
+                for finished in asyncio.as_completed(queries, timeout=self.timeout):
+                    try:
+                        return await finished
+                    except (OSError, dnserror, asyncio.IncompleteReadError) as error:
+                        lasterror = error
+            except asyncio.TimeoutError:
+                lasterror = dnserror('Timeout after {}s'.format(self.timeout))
+            finally:
+                for query in queries:
+                    query.cancel()
+
+        raise dnserror('Lookup of {} failed: {}'.format(name, lasterror))
+
+    async def _query(self, server: Nameserver, name: str) -> Tuple[List[str], int]:
+        loop = asyncio.get_running_loop()
+        queryid = random.getrandbits(16)
+        self.upstreamqueries += 1
+        metrics = clamavmetrics.active()
+        if metrics is not None:
+            metrics.count('dns_upstream_queries')
+        started = loop.time()
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: _udpclient(queryid, name), remote_addr=server)
+        try:
+            transport.sendto(encodequery(queryid, name))
+            truncated, records, ttl = await protocol.answer
+        finally:
+            transport.close()
+        if metrics is not None:
+            metrics.observe(clamavmetrics.DNSRTT, loop.time() - started)
+        if truncated:
+            return await self._querytcp(server, name)
+
+        return records, ttl
+
+    async def _querytcp(self, server: Nameserver, name: str) -> Tuple[List[str], int]:
+        queryid = random.getrandbits(16)
+        reader, writer = await asyncio.open_connection(server[0], server[1])
+        try:
+            query = encodequery(queryid, name)
+            writer.write(struct.pack('>H', len(query)) + query)
+            await writer.drain()
+            length = struct.unpack('>H', await reader.readexactly(2))[0]
+            truncated, records, ttl = decoderesponse(await reader.readexactly(length),
+                                                     queryid, name)
+        finally:
+            writer.close()
+        if truncated:
+            raise dnserror('Truncated response over TCP')
+
+        return records, ttl
@@ -0,0 +1,348 @@
+#!/usr/bin/python3
+
+# Serve a directory of ClamAV files to freshclam over HTTP
+# Copyright 2021 Thomas Karlsson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import zlib
+import asyncio
+import tarfile
+import hashlib
+import email.utils
+from typing import List, Dict, Tuple, Optional
+from .clamavfile import clamavfile
+from .clamavdns import clamavdns
+from .clamavcache import clamavcache
+
+SERVERNAME = 'cav'
+# Longest request line or header line and most header lines accepted
+MAXLINE = 8192
+MAXHEADERS = 100
+CURRENTPATHS = ('/current', '/current.cvd.clamav.net')
+
+_SERVABLE = re.compile(r'^[A-Za-z0-9_]+(\.cvd|\.cld|-[0-9]+\.cdiff)$')
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+_REASONS = {200: 'OK', 206: 'Partial Content', 304: 'Not Modified', 400: 'Bad Request',
+            403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+            416: 'Range Not Satisfiable', 503: 'Service Unavailable'}
+
+
+class _servedfile:
+    'What is known about one file while its inode, size and mtime stay'
+    def __init__(self, path: str, clamobject: clamavfile):
+        fileinfo = clamobject.fileinfo
+        self.path = path
+        self.identity = (fileinfo.st_dev, fileinfo.st_ino, fileinfo.st_size,
+                         fileinfo.st_mtime_ns)
+        self.fileinfo = fileinfo
+        self.clamobject = clamobject
+        self.size = fileinfo.st_size
+        # Strong validator from the header, no need to hash the file
+        token = clamobject.md5() if len(clamobject.md5()) == 32 else \
+            hashlib.sha256(clamobject.signature().encode('ascii')).hexdigest()[:32]
+        self.etag = '"{}-{}-{}"'.format(clamobject.version(), token, self.size)
+        modified = clamobject.epoch() or int(fileinfo.st_mtime)
+        self.lastmodified = email.utils.formatdate(modified, usegmt=True)
+        self.modified = modified
+        self.verified: Optional[asyncio.Future] = None
+
+
+class clamavserver:
+    """
+    asyncio HTTP/1.1 server for a mirror directory of CVD, CLD and cdiff
+    files, for freshclam clients pointed at it with PrivateMirror.
+
+    Files are sent with loop.sendfile, which uses os.sendfile on plain
+    sockets, so the data never passes through Python. ETag and
+    Last-Modified come from the parsed header (MD5 or signature, version
+    and build time) and single byte ranges, If-None-Match,
+    If-Modified-Since and If-Range are honoured. A file is only served
+    after its signature verified, looked up in the optional clamavcache
+    and otherwise checked once with clamavfile.verify per inode, size and mtime.
+
+    /current answers the TXT record of the DNS version lookup from
+    record, or from statefile written by clamavdns.savestatefile, which
+    is read again when it changes.
+    """
+    def __init__(self, directory: str, host: str = '127.0.0.1', port: int = 0,
+                 cache: Optional[clamavcache] = None, record: Optional[clamavdns] = None,
+                 statefile: Optional[str] = None, idletimeout: float = 30,
+                 verify: bool = True):
+        self.directory = directory
+        self.host = host
+        self.port = port
+        self.cache = cache
+        self.record = record
+        self.statefile = statefile
+        self.idletimeout = idletimeout
+        self.verify = verify
+        self.requests = 0
+        self.bytessent = 0
+        self.refused = 0
+        self.notmodified = 0
+        self._files: Dict[str, _servedfile] = dict()
+        self._statemtime = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._connection, self.host, self.port,
+                                                  backlog=4096, limit=MAXLINE)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self) -> None:
+        if self._server is None:
+            await self.start()
+        await self._server.serve_forever()
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def _current(self) -> Optional[str]:
+        'The TXT record, raises ValueError when the statefile can not be read'
+        if self.statefile is not None:
+            try:
+                mtime = os.stat(self.statefile).st_mtime_ns
+            except OSError:
+                return self.record.text() if self.record else None
+            if mtime != self._statemtime:
+                record = clamavdns()
+                try:
+                    record.loadstatefile(self.statefile)
+                except (OSError, ValueError, KeyError, TypeError) as error:
+                    raise ValueError('Can not read {}: {}'.format(self.statefile, error))
+                self.record = record
+                self._statemtime = mtime
+        if self.record is None:
+            return None
+
+        return self.record.text()
+
+    async def _lookup(self, name: str) -> Optional[_servedfile]:
+        """
+            Returns the served file for name when it exists and verified,
+            raises PermissionError when it failed verification
+        """
+        if not _SERVABLE.match(name):
+            return None
+        path = os.path.join(self.directory, name)
+        try:
+            fileinfo = os.stat(path)
+        except OSError:
+            return None
+        served = self._files.get(name)
+        if served is None or served.identity != (fileinfo.st_dev, fileinfo.st_ino,
+                                                 fileinfo.st_size, fileinfo.st_mtime_ns):
+            try:
+                # Parsing reads the file, keep it off the event loop
+                clamobject = await clamavfile.open(path)
+                served = self._files[name] = _servedfile(path, clamobject)
+            except (OSError, ValueError, IndexError):
+                # Not a ClamAV file or one that is still being written
+                self._files.pop(name, None)
+                raise PermissionError(name)
+        if not self.verify:
+            return served
+        if served.verified is None:
+            served.verified = asyncio.ensure_future(self._verified(served))
+        if not await asyncio.shield(served.verified):
+            raise PermissionError(name)
+
+        return served
+
+    async def _verified(self, served: _servedfile) -> bool:
+        try:
+            return await served.clamobject.verify(self.cache)
+        except (OSError, ValueError, EOFError, zlib.error, tarfile.TarError):
+            return False
+
+    async def _connection(self, reader: asyncio.StreamReader,
+                          writer: asyncio.StreamWriter) -> None:
+        try:
+            while await self._request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _readheaders(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, str, Dict[str, str]]]:
+        requestline = await asyncio.wait_for(reader.readline(), self.idletimeout)
+        if not requestline:
+            return None
+        parts = requestline.decode('latin-1').split()
+        headers: Dict[str, str] = dict()
+        for _ in range(MAXHEADERS):
+            line = await asyncio.wait_for(reader.readline(), self.idletimeout)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ValueError('Too many header lines')
+        if len(parts) != 3 or not parts[2].startswith('HTTP/1.'):
+            return '', '', 'HTTP/1.0', headers
+
+        return parts[0], parts[1], parts[2], headers
+
+    async def _request(self, reader: asyncio.StreamReader,
+                       writer: asyncio.StreamWriter) -> bool:
+        'Answer one request, returns whether the connection stays open'
+        request = await self._readheaders(reader)
+        if request is None:
+            return False
+        method, target, version, headers = request
+        self.requests += 1
+        connection = headers.get('connection', '').lower()
+        keepalive = version == 'HTTP/1.1' and connection != 'close' or connection == 'keep-alive'
+        if 'content-length' in headers or 'transfer-encoding' in headers:
+            # Requests with bodies are not expected, do not try to skip them
+            keepalive = False
+        if not method:
+            await self._respond(writer, 400, keepalive=False)
+            return False
+        if method not in ('GET', 'HEAD'):
+            await self._respond(writer, 405, {'Allow': 'GET, HEAD'}, keepalive=keepalive)
+            return keepalive
+        path = target.split('?', 1)[0]
+        head = method == 'HEAD'
+        if path in CURRENTPATHS:
+            try:
+                current = self._current()
+            except ValueError:
+                await self._respond(writer, 503, {'Retry-After': '10'}, keepalive=keepalive)
+                return keepalive
+            if current is None:
+                await self._respond(writer, 404, keepalive=keepalive)
+            else:
+                body = current.encode('ascii') + b'\n'
+                await self._respond(writer, 200, {'Content-Type': 'text/plain',
+                                                  'Cache-Control': 'no-cache'},
+                                    body, keepalive, head)
+            return keepalive
+        try:
+            served = await self._lookup(path.lstrip('/'))
+        except PermissionError:
+            self.refused += 1
+            await self._respond(writer, 403, keepalive=keepalive)
+            return keepalive
+        if served is None:
+            await self._respond(writer, 404, keepalive=keepalive)
+            return keepalive
+        await self._sendfile(writer, served, headers, keepalive, head)
+
+        return keepalive
+
+    def _notmodified(self, served: _servedfile, headers: Dict[str, str]) -> bool:
+        if 'if-none-match' in headers:
+            tags = [tag.strip() for tag in headers['if-none-match'].split(',')]
+            return '*' in tags or served.etag in tags or 'W/' + served.etag in tags
+        if 'if-modified-since' in headers:
+            try:
+                since = email.utils.parsedate_to_datetime(headers['if-modified-since'])
+            except (TypeError, ValueError):
+                return False
+            return served.modified <= since.timestamp()
+
+        return False
+
+    def _range(self, served: _servedfile, headers: Dict[str, str]) -> Optional[Tuple[int, int]]:
+        """
+            Returns (start, end) of a single satisfiable range, (0, -1) when
+            the range can not be satisfied and None for the whole file
+        """
+        match = _RANGE.match(headers.get('range', '').replace(' ', ''))
+        if match is None:
+            return None
+        ifrange = headers.get('if-range')
+        if ifrange is not None and ifrange != served.etag and ifrange != served.lastmodified:
+            return None
+        first, last = match.groups()
+        if not first and not last:
+            return None
+        if first:
+            start = int(first)
+            end = min(int(last), served.size - 1) if last else served.size - 1
+            if last and int(last) < start:
+                return None
+        else:
+            start = max(0, served.size - int(last))
+            end = served.size - 1
+        if start >= served.size or served.size == 0:
+            return (0, -1)
+
+        return start, end
+
+    async def _sendfile(self, writer: asyncio.StreamWriter, served: _servedfile,
+                        headers: Dict[str, str], keepalive: bool, head: bool) -> None:
+        validators = {'ETag': served.etag, 'Last-Modified': served.lastmodified}
+        if self._notmodified(served, headers):
+            self.notmodified += 1
+            await self._respond(writer, 304, validators, keepalive=keepalive)
+            return
+        byterange = self._range(served, headers)
+        if byterange == (0, -1):
+            await self._respond(writer, 416, {'Content-Range': 'bytes */{}'.format(served.size)},
+                                keepalive=keepalive)
+            return
+        status = 200
+        start, end = 0, served.size - 1
+        extra = dict(validators)
+        extra['Content-Type'] = 'application/octet-stream'
+        if byterange is not None:
+            status = 206
+            start, end = byterange
+            extra['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, served.size)
+        count = end - start + 1
+        with open(served.path, 'rb') as servefile:
+            fileinfo = os.fstat(servefile.fileno())
+            if (fileinfo.st_dev, fileinfo.st_ino, fileinfo.st_size,
+                    fileinfo.st_mtime_ns) != served.identity:
+                # Replaced since it was verified, let the client retry
+                await self._respond(writer, 503, {'Retry-After': '1'}, keepalive=False)
+                raise ConnectionError('File replaced while serving')
+            await self._respond(writer, status, extra, None, keepalive, head, count)
+            if head or not count:
+                return
+            await writer.drain()
+            loop = asyncio.get_running_loop()
+            sent = await loop.sendfile(writer.transport, servefile, start, count)
+            self.bytessent += sent
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int,
+                       headers: Optional[Dict[str, str]] = None, body: bytes = b'',
+                       keepalive: bool = True, head: bool = False,
+                       length: Optional[int] = None) -> None:
+        lines: List[str] = ['HTTP/1.1 {} {}'.format(status, _REASONS.get(status, '')),
+                            'Server: ' + SERVERNAME,
+                            'Date: ' + email.utils.formatdate(usegmt=True)]
+        if status not in (304, 416) and 200 <= status < 300:
+            lines.append('Accept-Ranges: bytes')
+        for name, value in (headers or dict()).items():
+            lines.append('{}: {}'.format(name, value))
+        if body is None:
+            body = b''
+        if status != 304:
+            lines.append('Content-Length: {}'.format(len(body) if length is None else length))
+        lines.append('Connection: ' + ('keep-alive' if keepalive else 'close'))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if body and not head:
+            writer.write(body)
+            self.bytessent += len(body)
+        await writer.drain()
@@ -0,0 +1,423 @@
+#!/usr/bin/python3
+
+# Content-addressable store of ClamAV database versions
+# Copyright 2021 Thomas Karlsson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import json
+import zlib
+import base64
+import struct
+import hashlib
+import tarfile
+import tempfile
+from typing import List, Dict, Tuple, Union, Optional, Iterator, Any, BinaryIO
+from .clamavfile import clamavfile, mkstempfor, CHUNKSIZE
+from .clamavindex import _gzipheadersize
+
+# Largest tail after the end of archive blocks kept in a manifest
+MAXTRAILER = 1024 * 1024
+# Objects are kept deflated on disk
+OBJECTLEVEL = 6
+# gzip XFL byte to the compression level that sets it
+_XFLLEVELS = {2: 9, 4: 1}
+# Levels tried after the one the gzip header suggests, most common first
+_LEVELS = (6, 9, 1, 5, 4, 3, 2, 7, 8)
+
+_MANIFESTNAME = re.compile(r'^(.+)-([0-9]+)\.json$')
+
+
+class _objectwriter:
+    """
+    Deflate one object to a temporary file and move it to the SHA-256
+    of its content
+    """
+    def __init__(self, store: 'clamavstore'):
+        self.store = store
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.compressor = zlib.compressobj(OBJECTLEVEL)
+        self.new = False
+        tempfd, self.temppath = tempfile.mkstemp(dir=store.objects, prefix='.new')
+        self.output = os.fdopen(tempfd, 'wb')
+
+    def write(self, data: bytes) -> None:
+        self.sha256.update(data)
+        self.size += len(data)
+        self.output.write(self.compressor.compress(data))
+
+    def finish(self) -> str:
+        self.output.write(self.compressor.flush())
+        self.output.close()
+        digest = self.sha256.hexdigest()
+        path = self.store.objectpath(digest)
+        if os.path.exists(path):
+            os.unlink(self.temppath)
+            self.store.duplicates += 1
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.temppath, path)
+            self.store.stored += 1
+            self.new = True
+
+        return digest
+
+    def abort(self) -> None:
+        self.output.close()
+        os.unlink(self.temppath)
+
+
+class _tarsplitter:
+    """
+    Split a tar stream fed in pieces into raw headers, member data sent
+    to objects and the tail after the end of archive blocks
+    """
+    def __init__(self, store: 'clamavstore'):
+        self.store = store
+        self.entries: List[Dict[str, Any]] = list()
+        self.header = b''
+        self.remaining = 0
+        self.padding = 0
+        self.writer: Optional[_objectwriter] = None
+        self.trailer: Optional[bytearray] = None
+        # Objects this archive added to the store
+        self.created: List[str] = list()
+
+    def feed(self, data: bytes) -> None:
+        position = 0
+        while position < len(data):
+            if self.trailer is not None:
+                self.trailer += data[position:]
+                if len(self.trailer) > MAXTRAILER:
+                    raise ValueError('Tail after the end of the tar archive too long')
+                return
+            if self.remaining:
+                step = min(self.remaining, len(data) - position)
+                self.writer.write(data[position:position + step])
+                self.remaining -= step
+                position += step
+                if not self.remaining:
+                    self.entries[-1]['object'] = self.writer.finish()
+                    if self.writer.new:
+                        self.created.append(self.entries[-1]['object'])
+                    self.writer = None
+                continue
+            if self.padding:
+                step = min(self.padding, len(data) - position)
+                if data[position:position + step].strip(b'\x00'):
+                    raise ValueError('Tar padding is not zero')
+                self.padding -= step
+                position += step
+                continue
+            step = min(512 - len(self.header), len(data) - position)
+            self.header += data[position:position + step]
+            position += step
+            if len(self.header) < 512:
+                continue
+            if self.header == bytes(512):
+                self.trailer = bytearray(self.header)
+                self.header = b''
+                continue
+            tarinfo = tarfile.TarInfo.frombuf(self.header, 'utf-8', 'surrogateescape')
+            size = tarinfo.size if tarinfo.type not in (tarfile.LNKTYPE, tarfile.SYMTYPE,
+                                                        tarfile.DIRTYPE, tarfile.CHRTYPE,
+                                                        tarfile.BLKTYPE, tarfile.FIFOTYPE) else 0
+            self.entries.append({'name': tarinfo.name, 'header': _encode(self.header),
+                                 'size': size, 'object': None})
+            self.header = b''
+            if size:
+                self.writer = _objectwriter(self.store)
+                self.remaining = size
+                self.padding = -size % 512
+
+    def finish(self) -> bytes:
+        if self.header or self.remaining or self.padding or self.trailer is None:
+            raise ValueError('Truncated tar archive')
+
+        return bytes(self.trailer)
+
+    def discard(self) -> None:
+        'Abort the member being written and remove the objects added so far'
+        if self.writer is not None:
+            self.writer.abort()
+            self.writer = None
+        for digest in self.created:
+            os.unlink(self.store.objectpath(digest))
+            self.store.stored -= 1
+        self.created = list()
+
+
+def _encode(data: bytes) -> str:
+    return base64.b64encode(data).decode('ascii')
+
+
+def _decode(text: str) -> bytes:
+    return base64.b64decode(text.encode('ascii'))
+
+
+class clamavstore:
+    """
+    Versions of ClamAV databases kept as one deflated object per distinct
+    tar member, named by its SHA-256, and a small JSON manifest per version
+    with the CVD header, the raw tar headers and the gzip parameters.
+    Members that do not change between versions are stored once.
+
+    rebuild streams the tar back through zlib and checks the MD5 of the
+    compressed body against the original. add looks for the compression
+    level that reproduces the body byte for byte. When none does, for
+    example because it was compressed by another zlib, the compressed
+    body is stored as an object of its own and the manifest refers to no
+    member objects.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.objects = os.path.join(directory, 'objects')
+        self.manifests = os.path.join(directory, 'manifests')
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.manifests, exist_ok=True)
+        self.stored = 0
+        self.duplicates = 0
+
+    def objectpath(self, digest: str) -> str:
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    def manifestpath(self, dbname: str, version: int) -> str:
+        return os.path.join(self.manifests, '{}-{}.json'.format(dbname, version))
+
+    def add(self, clamobject: Union[str, clamavfile],
+            dbname: Optional[str] = None) -> Dict[str, Any]:
+        """
+            Store a CVD or CLD, dbname defaults to the file name without
+            extension. Returns the manifest
+        """
+        if isinstance(clamobject, str):
+            clamobject = clamavfile(clamobject)
+        if clamobject.magicheader != 'ClamAV-VDB':
+            raise ValueError('Only ClamAV-VDB files can be stored')
+        if dbname is None:
+            dbname = os.path.splitext(os.path.basename(clamobject.filename))[0]
+        manifest: Dict[str, Any] = {'dbname': dbname, 'version': clamobject.version(),
+                                    'compressed': clamobject.compressed}
+        splitter = _tarsplitter(self)
+        md5object = hashlib.md5()
+        try:
+            with clamobject.openraw() as clamfile:
+                manifest['header'] = _encode(clamfile.read(clamobject.headersize()))
+                first = clamfile.read(CHUNKSIZE)
+                inflater = None
+                if clamobject.compressed:
+                    headersize = _gzipheadersize(first)
+                    manifest['gzipheader'] = _encode(first[:headersize])
+                    manifest['level'] = _XFLLEVELS.get(first[8], 6)
+                    inflater = zlib.decompressobj(-15)
+                    md5object.update(first[:headersize])
+                    first = first[headersize:]
+                chunk = first
+                while chunk:
+                    md5object.update(chunk)
+                    splitter.feed(inflater.decompress(chunk) if inflater else chunk)
+                    chunk = clamfile.read(CHUNKSIZE)
+                trailer = splitter.finish()
+                if inflater is not None and (not inflater.eof or len(inflater.unused_data) != 8):
+                    raise ValueError('gzip body is not a single member')
+            manifest['members'] = splitter.entries
+            manifest['trailer'] = _encode(trailer)
+            manifest['md5'] = md5object.hexdigest()
+            levels = [manifest['level']] if clamobject.compressed else [None]
+            if clamobject.compressed:
+                levels += [level for level in _LEVELS if level != manifest['level']]
+            for level in levels:
+                if level is not None:
+                    manifest['level'] = level
+                if self._reproduces(manifest, clamobject):
+                    break
+            else:
+                manifest = {key: value for key, value in manifest.items()
+                            if key not in ('members', 'trailer', 'level')}
+                manifest['body'] = self._storebody(clamobject)
+                splitter.discard()
+            self._savemanifest(manifest)
+        except BaseException:
+            splitter.discard()
+            raise
+
+        return manifest
+
+    def _reproduces(self, manifest: Dict[str, Any], clamobject: clamavfile) -> bool:
+        'Compare the rebuilt body with the original up to the first difference'
+        with clamobject.openraw() as clamfile:
+            clamfile.seek(clamobject.headersize())
+            for piece in self._body(manifest):
+                if clamfile.read(len(piece)) != piece:
+                    return False
+
+            return clamfile.read(1) == b''
+
+    def _storebody(self, clamobject: clamavfile) -> str:
+        'Store the body as it is, for bodies rebuild can not reproduce'
+        writer = _objectwriter(self)
+        try:
+            with clamobject.openraw() as clamfile:
+                clamfile.seek(clamobject.headersize())
+                for chunk in iter(lambda: clamfile.read(CHUNKSIZE), b''):
+                    writer.write(chunk)
+        except BaseException:
+            writer.abort()
+            raise
+
+        return writer.finish()
+
+    def _savemanifest(self, manifest: Dict[str, Any]) -> None:
+        path = self.manifestpath(manifest['dbname'], manifest['version'])
+        tempfd, temppath = tempfile.mkstemp(dir=self.manifests, prefix='.new')
+        with os.fdopen(tempfd, 'w') as output:
+            json.dump(manifest, output)
+        os.replace(temppath, path)
+
+    def manifest(self, dbname: str, version: int) -> Dict[str, Any]:
+        with open(self.manifestpath(dbname, version)) as manifestfile:
+            return json.load(manifestfile)
+
+    def versions(self, dbname: Optional[str] = None) -> List[Tuple[str, int]]:
+        """
+            Returns the stored (dbname, version) pairs in order
+        """
+        stored: List[Tuple[str, int]] = list()
+        for name in os.listdir(self.manifests):
+            match = _MANIFESTNAME.match(name)
+            if match and (dbname is None or match.group(1) == dbname):
+                stored.append((match.group(1), int(match.group(2))))
+
+        return sorted(stored)
+
+    def _readobject(self, digest: str) -> Iterator[bytes]:
+        inflater = zlib.decompressobj()
+        try:
+            with open(self.objectpath(digest), 'rb') as objectfile:
+                for chunk in iter(lambda: objectfile.read(CHUNKSIZE), b''):
+                    yield inflater.decompress(chunk)
+            yield inflater.flush()
+        except zlib.error as error:
+            raise ValueError('Object {} is damaged: {}'.format(digest, error))
+
+    def _tar(self, manifest: Dict[str, Any]) -> Iterator[bytes]:
+        for entry in manifest['members']:
+            yield _decode(entry['header'])
+            if entry['size']:
+                yield from self._readobject(entry['object'])
+                if entry['size'] % 512:
+                    yield bytes(-entry['size'] % 512)
+        yield _decode(manifest['trailer'])
+
+    def _body(self, manifest: Dict[str, Any]) -> Iterator[bytes]:
+        'The body after the CVD header, rebuilt in pieces'
+        if 'body' in manifest:
+            yield from self._readobject(manifest['body'])
+            return
+        if not manifest['compressed']:
+            yield from self._tar(manifest)
+            return
+        yield _decode(manifest['gzipheader'])
+        compressor = zlib.compressobj(manifest['level'], zlib.DEFLATED, -15)
+        crc = 0
+        size = 0
+        pending: List[bytes] = list()
+        pendingsize = 0
+        for piece in self._tar(manifest):
+            crc = zlib.crc32(piece, crc)
+            size += len(piece)
+            pending.append(piece)
+            pendingsize += len(piece)
+            if pendingsize >= CHUNKSIZE:
+                yield compressor.compress(b''.join(pending))
+                pending = list()
+                pendingsize = 0
+        yield compressor.compress(b''.join(pending))
+        yield compressor.flush()
+        yield struct.pack('<II', crc, size & 0xffffffff)
+
+    def write(self, dbname: str, version: int, output: BinaryIO) -> int:
+        """
+            Stream a stored version to the binary file object output.
+            Raises ValueError when the body does not match its MD5.
+            Returns the number of bytes written
+        """
+        manifest = self.manifest(dbname, version)
+        header = _decode(manifest['header'])
+        output.write(header)
+        written = len(header)
+        md5object = hashlib.md5()
+        for piece in self._body(manifest):
+            md5object.update(piece)
+            output.write(piece)
+            written += len(piece)
+        if md5object.hexdigest() != manifest['md5']:
+            raise ValueError('Rebuilt {}-{} does not match its MD5'.format(dbname, version))
+
+        return written
+
+    def rebuild(self, dbname: str, version: int, destination: str) -> clamavfile:
+        """
+            Write a stored version to destination, which only appears when
+            the rebuilt body matches the original
+        """
+        tempfd, temppath = mkstempfor(destination)
+        try:
+            with os.fdopen(tempfd, 'wb') as output:
+                self.write(dbname, version, output)
+            os.replace(temppath, destination)
+        except BaseException:
+            os.unlink(temppath)
+            raise
+
+        return clamavfile(destination)
+
+    def remove(self, dbname: str, version: int) -> None:
+        """
+            Forget a version, prune removes the objects only it used
+        """
+        os.unlink(self.manifestpath(dbname, version))
+
+    def prune(self) -> int:
+        """
+            Delete objects no manifest refers to. Returns how many
+        """
+        referenced = set()
+        for dbname, version in self.versions():
+            manifest = self.manifest(dbname, version)
+            referenced.update(entry['object'] for entry in manifest.get('members', list())
+                              if entry['object'])
+            if 'body' in manifest:
+                referenced.add(manifest['body'])
+        removed = 0
+        for prefix in os.listdir(self.objects):
+            if not os.path.isdir(os.path.join(self.objects, prefix)):
+                continue
+            for name in os.listdir(os.path.join(self.objects, prefix)):
+                if prefix + name not in referenced:
+                    os.unlink(os.path.join(self.objects, prefix, name))
+                    removed += 1
+
+        return removed
+
+    def disksize(self) -> int:
+        'Bytes used by objects and manifests'
+        total = 0
+        for root, _, names in os.walk(self.directory):
+            total += sum(os.path.getsize(os.path.join(root, name)) for name in names)
+
+        return total
@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+
+# Verify many ClamAV files in parallel
+# Copyright 2021 Thomas Karlsson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import zlib
+import sqlite3
+import tarfile
+import argparse
+import concurrent.futures
+from typing import List, Dict, Iterable, Iterator, Optional, Any
+from .clamavfile import clamavfile
+from .clamavcache import clamavcache
+
+EXTENSIONS = ('.cvd', '.cdiff', '.cld')
+
+_caches: Dict[str, clamavcache] = dict()
+
+
+class verifyresult:
+    'Outcome of verifying one file'
+    def __init__(self, path: str, ok: bool = False, seconds: float = 0.0,
+                 byteshashed: int = 0, version: int = 0,
+                 error: Optional[str] = None):
+        self.path = path
+        self.ok = ok
+        self.seconds = seconds
+        self.byteshashed = byteshashed
+        self.version = version
+        self.error = error
+
+    def dict(self) -> Dict[str, Any]:
+        return {'path': self.path, 'ok': self.ok, 'seconds': self.seconds,
+                'byteshashed': self.byteshashed, 'version': self.version,
+                'error': self.error}
+
+    def text(self) -> str:
+        """
+            Returns one line for the command line output
+        """
+        status = 'OK' if self.ok else 'FAIL'
+        line = '{} {} {:.3f}s {} bytes'.format(status, self.path,
+                                              self.seconds, self.byteshashed)
+        if self.error:
+            line += ' ({})'.format(self.error)
+
+        return line
+
+
+def hashedsize(clamobject: clamavfile) -> int:
+    'Number of bytes covered by the signature of clamobject'
+    if clamobject.magicheader == 'ClamAV-Diff':
+        return clamobject.headersize() + clamobject.datasize()
+
+    return clamobject.datasize()
+
+
+def _cache(cachefile: str) -> clamavcache:
+    'One cache connection per process and cache file'
+    if cachefile not in _caches:
+        _caches[cachefile] = clamavcache(cachefile)
+
+    return _caches[cachefile]
+
+
+def verifyfile(path: str, cachefile: Optional[str] = None) -> verifyresult:
+    """
+        Verify one file, never raises so it can run in a worker process.
+        Files found unchanged in cachefile are not hashed again and are
+        reported with 0 bytes hashed
+    """
+    start = time.perf_counter()
+    try:
+        cache = _cache(cachefile) if cachefile is not None else None
+        hits = cache.hits if cache is not None else 0
+        clamobject = clamavfile(path)
+        ok = clamobject.verifysignature(cache=cache)
+        if cache is not None and cache.hits > hits:
+            return verifyresult(path, ok, time.perf_counter() - start,
+                                version=clamobject.version(),
+                                error=None if ok else 'signature mismatch (cached)')
+        return verifyresult(path, ok, time.perf_counter() - start,
+                            hashedsize(clamobject), clamobject.version(),
+                            None if ok else 'signature mismatch')
+    except (OSError, ValueError, IndexError, EOFError, zlib.error,
+            tarfile.TarError, sqlite3.Error) as error:
+        return verifyresult(path, False, time.perf_counter() - start,
+                            error=str(error) or type(error).__name__)
+
+
+def findfiles(paths: Iterable[str]) -> List[str]:
+    """
+        Expand directories in paths to the ClamAV files below them
+    """
+    found: List[str] = list()
+    for path in paths:
+        if not os.path.isdir(path):
+            found.append(path)
+            continue
+        for root, _, filenames in os.walk(path):
+            for filename in sorted(filenames):
+                if filename.endswith(EXTENSIONS):
+                    found.append(os.path.join(root, filename))
+
+    return found
+
+
+def _bysize(paths: Iterable[str]) -> List[str]:
+    'Largest files first so they do not end up last in the queue'
+    def size(path: str) -> int:
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            return 0
+
+    return sorted(paths, key=size, reverse=True)
+
+
+def verify_many(paths: Iterable[str], workers: Optional[int] = None,
+                cachefile: Optional[str] = None) -> Iterator[verifyresult]:
+    """
+        Verify paths on a pool of worker processes, yielding results as
+        they complete. workers defaults to the number of CPUs, 1 verifies
+        in this process. Results are reused from and saved to the
+        clamavcache in cachefile when it is given
+    """
+    queue = _bysize(paths)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(queue)))
+    if workers == 1:
+        for path in queue:
+            yield verifyfile(path, cachefile)
+        return
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(verifyfile, path, cachefile) for path in queue]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Verify the signatures of ClamAV CVD and cdiff files')
+    parser.add_argument('paths', nargs='+', help='files or mirror directories')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='worker processes (default: number of CPUs)')
+    parser.add_argument('--json', action='store_true',
+                        help='print one JSON object per file')
+    parser.add_argument('--cache', default=None, metavar='FILE',
+                        help='reuse verification results stored in FILE')
+    arguments = parser.parse_args(argv)
+
+    failed = 0
+    for result in verify_many(findfiles(arguments.paths), arguments.workers,
+                              arguments.cache):
+        if not result.ok:
+            failed += 1
+        if arguments.json:
+            print(json.dumps(result.dict()), flush=True)
+        else:
+            print(result.text(), flush=True)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+import os
+import sys
+sys.path.append('../')
+from cav import clamavkeys
+from cav.clamavbuilder import clamavbuilder, diffscript
+from cav.clamavcdiff import clamavcdiff
+from test_clamavkeys import privatekey
+
+
+def writetree(directory, files):
+    directory.mkdir()
+    for name, data in files.items():
+        (directory / name).write_bytes(data)
+
+
+def test_build_and_diff(tmp_path):
+    key = privatekey(clamavkeys.MD5, 'private')
+    psskey = privatekey(clamavkeys.PSS, 'private-pss')
+    builder = clamavbuilder(key, psskey, builder='tester', functionalitylevel=90)
+    old = {'private.hdb': b''.join(b'%032x:%d:Private.Sig-%d\n' % (i, i, i) for i in range(300)),
+           'private.ndb': b'Ndb.Sig-1:0:*:4142\nNdb.Sig-2:0:*:4344\n',
+           'private.ldb': b'Ldb.Sig-1;Engine:51-255,Target:1;0;41\n'}
+    new = dict(old)
+    new['private.hdb'] = b''.join(b'%032x:%d:Private.Sig-%d\n' % (i, i, i) for i in range(300) if i != 7)
+    new['private.hdb'] = new['private.hdb'].replace(b'Private.Sig-100\n', b'Private.Sig-100-renamed\n')
+    new['private.hdb'] += b'ffffffffffffffffffffffffffffffff:1:Private.Sig-new\n'
+    new['private.ndb'] = b'Ndb.Sig-1:0:*:4142\nNdb.Sig-2 changed:0:*:4344\n'
+    del new['private.ldb']
+    new['private.fp'] = b'00000000000000000000000000000000:1:Clean\n'
+    writetree(tmp_path / 'old', old)
+    writetree(tmp_path / 'new', new)
+
+    clamobject = builder.buildcvd(str(tmp_path / 'old'), str(tmp_path / 'private.cvd'), 10)
+    assert clamobject.version() == 10
+    assert clamobject.signatures() == 303
+    assert clamobject.builder() == 'tester'
+    assert clamobject.functionalitylevel() == 90
+    assert clamobject.members() == ['private.hdb', 'private.ldb', 'private.ndb', 'private.info']
+    assert clamobject.verifysignature() is False
+    clamavkeys.registerkey(key)
+    clamavkeys.registerkey(psskey)
+    try:
+        assert clamobject.verifysignature() is True
+        extracted = tmp_path / 'extracted'
+        extracted.mkdir()
+        clamobject.extractall(str(extracted))
+        assert clamavcdiff(str(extracted)).verifyinfo('private.info') == []
+        info = clamobject.openmember('private.info').read().split(b'\n')
+        assert info[-2].startswith(b'DSIG:')
+        os.unlink(extracted / 'private.info')
+
+        script = b''.join(diffscript(str(tmp_path / 'old'), str(tmp_path / 'new')))
+        assert b'XCHG 101 00000000000000000000000000000064 00000000000000000000000000000064:100:Private.Sig-100-renamed\n' in script
+        assert b'DEL 8 00000000000000000000000000000007' in script
+        assert b'UNLINK private.ldb\n' in script
+        cdiff = builder.buildcdiff(str(tmp_path / 'old'), str(tmp_path / 'new'),
+                                   str(tmp_path / 'private-11.cdiff'), 11)
+        assert cdiff.filetype() == 'ClamAV-Diff'
+        assert cdiff.signatures() == len(script)
+        assert cdiff.verifysignature() is True
+        clamavcdiff(str(extracted)).apply([cdiff])
+    finally:
+        clamavkeys.unregisterkey('private')
+        clamavkeys.unregisterkey('private-pss')
+    assert sorted(os.listdir(extracted)) == sorted(new)
+    for name, data in new.items():
+        assert (extracted / name).read_bytes() == data
+
+
+def test_compactcdiffs(tmp_path):
+    key = privatekey(clamavkeys.MD5, 'private')
+    psskey = privatekey(clamavkeys.PSS, 'private-pss')
+    builder = clamavbuilder(key, psskey)
+    versions = [{'private.hdb': b''.join(b'%032x:%d:Sig-%d\n' % (i, i, i) for i in range(200)),
+                 'private.ndb': b'Ndb.Sig-1:0:*:4142\n'}]
+    for version in range(1, 6):
+        files = dict(versions[-1])
+        lines = files['private.hdb'].splitlines(True)
+        lines = [line for number, line in enumerate(lines) if number % 7 != version]
+        lines[3] = b'%032x:%d:Changed-%d\n' % (version, version, version)
+        lines += [b'%032x:%d:Added-%d-%d\n' % (version, version, version, i) for i in range(20)]
+        files['private.hdb'] = b''.join(lines)
+        if version == 3:
+            files['private.fp'] = b'temporary\n'
+        versions.append(files)
+    for version, files in enumerate(versions):
+        writetree(tmp_path / str(version), files)
+    chain = [builder.buildcdiff(str(tmp_path / str(version - 1)), str(tmp_path / str(version)),
+                                str(tmp_path / 'private-{}.cdiff'.format(version)), version)
+             for version in range(1, 6)]
+    clamavkeys.registerkey(psskey)
+    try:
+        compacted = builder.compactcdiffs(chain, str(tmp_path / 'private-1-5.cdiff'),
+                                          str(tmp_path / '0'))
+        assert compacted.version() == 5 and compacted.verifysignature()
+        clamavcdiff(str(tmp_path / '0')).apply([compacted])
+    finally:
+        clamavkeys.unregisterkey('private-pss')
+    assert compacted.signatures() < sum(cdiff.signatures() for cdiff in chain)
+    assert sorted(os.listdir(tmp_path / '0')) == sorted(versions[-1])
+    for name, data in versions[-1].items():
+        assert (tmp_path / '0' / name).read_bytes() == data
+
+
+def test_unmatchable_lines(tmp_path):
+    old = {'private.ign2': b'Sig-1\n Sig-2\nSig-3\nSig-4\n',
+           'private.ndb': b'Ndb.Sig-1:0:*:4142\n\nNdb.Sig-2:0:*:4344\n',
+           'private.cfg': b' indented\nkept\n',
+           'private.pdb': b'H:first\n'}
+    new = {'private.ign2': b'Sig-1\nSig-3\nSig-4\n',
+           'private.ndb': b'Ndb.Sig-1:0:*:4142\nNdb.Sig-2:0:*:4344\n',
+           'private.cfg': b'changed\nkept\n',
+           'private.pdb': b'H:first\n\nH:second\n'}
+    writetree(tmp_path / 'old', old)
+    writetree(tmp_path / 'new', new)
+    writetree(tmp_path / 'applied', old)
+    script = list(diffscript(str(tmp_path / 'old'), str(tmp_path / 'new')))
+    assert b'DEL 2  Sig-2\n' in script
+    assert b'UNLINK private.ndb\n' in script and b'UNLINK private.cfg\n' in script
+    assert not [line for line in script if line.startswith((b'DEL', b'XCHG')) and
+                not line.split(b' ', 2)[2].strip()]
+    # ADD needs a signature, blank lines are left out
+    assert b'ADD \n' not in script and b'ADD H:second\n' in script
+    clamavcdiff(str(tmp_path / 'applied')).applyscripts([script])
+    for name, data in new.items():
+        assert (tmp_path / 'applied' / name).read_bytes() == data.replace(b'\n\n', b'\n')
+    # Published files get a normal mode, not the 0600 of mkstemp
+    builder = clamavbuilder(privatekey(clamavkeys.MD5, 'private'),
+                            privatekey(clamavkeys.PSS, 'private-pss'))
+    builder.buildcvd(str(tmp_path / 'new'), str(tmp_path / 'private.cvd'), 1, 'private')
+    builder.buildcdiff(str(tmp_path / 'old'), str(tmp_path / 'new'), str(tmp_path / 'private-1.cdiff'), 1)
+    (tmp_path / 'plain').write_bytes(b'')
+    for name in ('private.cvd', 'private-1.cdiff'):
+        assert os.stat(tmp_path / name).st_mode == os.stat(tmp_path / 'plain').st_mode
@@ -0,0 +1,43 @@
+import hashlib
+import os
+import shutil
+import sys
+sys.path.append('../')
+from cav.clamavfile import clamavfile
+from cav.clamavcache import clamavcache
+from cav.clamavverify import verify_many
+
+
+def test_cache(tmp_path):
+    shutil.copy('daily-25784.cdiff', tmp_path / 'daily-25784.cdiff')
+    path = str(tmp_path / 'daily-25784.cdiff')
+    cache = clamavcache(str(tmp_path / 'clamav.cache'))
+    assert cache.verify(path) is True
+    assert cache.hits == 0 and cache.misses == 1
+    assert cache.verify(path) is True
+    assert cache.hits == 1
+    assert clamavfile(path).verifysignature(cache=cache) is True
+    assert cache.hits == 2
+    with open(path, 'rb') as cdiff:
+        digest = hashlib.sha256(cdiff.read()[:-343]).hexdigest()
+    assert cache.lookup(os.stat(path)) == (True, digest)
+
+    with open(path, 'r+b') as cdiff:
+        cdiff.seek(100)
+        cdiff.write(b'X')
+    os.utime(path, ns=(0, 0))
+    assert cache.verify(path) is False
+    assert cache.hits == 3
+    os.unlink(path)
+    assert cache.prune() == 1
+
+
+def test_verify_many_cache(tmp_path, monkeypatch):
+    cachefile = str(tmp_path / 'clamav.cache')
+    first = list(verify_many(['daily-25784.cdiff', 'main-59.cdiff'], workers=2, cachefile=cachefile))
+    assert all(result.ok and result.byteshashed for result in first)
+    second = list(verify_many(['daily-25784.cdiff', 'main-59.cdiff'], workers=1, cachefile=cachefile))
+    assert all(result.ok and result.byteshashed == 0 for result in second)
+    # Relative paths are stored absolute, prune works from anywhere
+    monkeypatch.chdir(tmp_path)
+    assert clamavcache(cachefile).prune() == 0
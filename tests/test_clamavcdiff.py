@@ -0,0 +1,133 @@
+import os
+import gzip
+import hashlib
+import pytest
+import sys
+sys.path.append('../')
+from cav.clamavfile import clamavfile
+from cav.clamavcdiff import clamavcdiff, cdifferror, parsescript, scriptlines, compactscripts
+
+
+def writeinfo(directory, names):
+    lines = ['ClamAV-VDB:test']
+    for name in names:
+        data = (directory / name).read_bytes()
+        lines.append('{}:{}:{}'.format(name, len(data), hashlib.sha256(data).hexdigest()))
+    (directory / 'daily.info').write_text('\n'.join(lines) + '\nDSIG:X\n')
+
+
+def makecdiff(filename, version, script):
+    data = gzip.compress(script, mtime=0)
+    with open(filename, 'wb') as cdiff:
+        cdiff.write(b'ClamAV-Diff:%d:%d:' % (version, len(script)))
+        cdiff.write(data)
+        cdiff.write(b':' + b'A' * 342)
+
+
+def test_parsescript():
+    operations = parsescript([b'OPEN daily.ldb\n', b'ADD Sig;Engine:51-255 with spaces\n',
+                              b'DEL 2 Old\n', b'XCHG 3 Prefix New line\n', b'CLOSE\n',
+                              b'MOVE a.ndb b.ndb 1 x 2 y\n', b'UNLINK a.ndb\n'])
+    assert len(operations) == 3
+    assert operations[0].adds == [b'Sig;Engine:51-255 with spaces']
+    assert operations[0].dels == {2: b'Old'}
+    assert operations[0].xchgs == {3: (b'Prefix', b'New line')}
+    with pytest.raises(cdifferror):
+        parsescript([b'ADD x\n'])
+    with pytest.raises(cdifferror):
+        parsescript([b'OPEN ../etc/passwd\n'])
+
+
+def test_apply_chain(tmp_path):
+    base = tmp_path / 'base'
+    base.mkdir()
+    (base / 'daily.hdb').write_bytes(b''.join(b'%032x:10:Sig-%d\n' % (i, i) for i in range(1000)))
+    (base / 'daily.ndb').write_bytes(b'Ndb-1:0:*:41\nNdb-2:0:*:42\nNdb-3:0:*:43\n')
+    (base / 'old.ndb').write_bytes(b'gone\n')
+
+    first = b''.join([b'OPEN daily.hdb\n', b'DEL 1 00000000\n',
+                      b'XCHG 500 000000000000000000000000000001f3 ',
+                      b'00000000000000000000000000000000:10:Changed\n'] +
+                     [b'ADD %032x:20:New-%d\n' % (i, i) for i in range(50)] +
+                     [b'CLOSE\n', b'MOVE daily.ndb moved.ndb 2 Ndb-2 3 Ndb-3\n',
+                      b'UNLINK old.ndb\n'])
+    second = b'OPEN daily.hdb\nDEL 1000 00000000000000000000000000000000:20\nADD last:1:Last\nCLOSE\n'
+    makecdiff(tmp_path / 'daily-2.cdiff', 2, first)
+    makecdiff(tmp_path / 'daily-3.cdiff', 3, second)
+    assert list(scriptlines(clamavfile(str(tmp_path / 'daily-3.cdiff')))) == second.splitlines(True)
+
+    expected = [b'%032x:10:Sig-%d\n' % (i, i) for i in range(1, 1000)]
+    expected[498] = b'00000000000000000000000000000000:10:Changed\n'
+    expected += [b'%032x:20:New-%d\n' % (i, i) for i in range(1, 50)] + [b'last:1:Last\n']
+
+    clamavcdiff(str(base)).apply([str(tmp_path / 'daily-3.cdiff'),
+                                  str(tmp_path / 'daily-2.cdiff')], verify=False)
+    assert (base / 'daily.hdb').read_bytes() == b''.join(expected)
+    assert (base / 'daily.ndb').read_bytes() == b'Ndb-1:0:*:41\n'
+    assert (base / 'moved.ndb').read_bytes() == b'Ndb-2:0:*:42\nNdb-3:0:*:43\n'
+    assert not (base / 'old.ndb').exists()
+    writeinfo(base, ['daily.hdb', 'daily.ndb'])
+    assert clamavcdiff(str(base)).verifyinfo('daily.info') == []
+    (base / 'daily.ndb').write_bytes(b'Ndb-1:0:*:40\n')
+    assert clamavcdiff(str(base)).verifyinfo('daily.info') == ['daily.ndb']
+
+
+def test_apply_mismatch(tmp_path):
+    (tmp_path / 'daily.hdb').write_bytes(b'aaa\nbbb\n')
+    with pytest.raises(cdifferror):
+        clamavcdiff(str(tmp_path)).applyscripts([[b'OPEN daily.hdb\n', b'DEL 2 ccc\n', b'CLOSE\n']])
+    assert (tmp_path / 'daily.hdb').read_bytes() == b'aaa\nbbb\n'
+    assert [p.name for p in tmp_path.iterdir()] == ['daily.hdb']
+
+    # A failed MOVE leaves both files as they were
+    (tmp_path / 'moved.hdb').write_bytes(b'zzz\n')
+    for move in (b'MOVE daily.hdb moved.hdb 1 aaa 2 ccc\n', b'MOVE daily.hdb moved.hdb 1 aaa 3 ccc\n'):
+        with pytest.raises(cdifferror):
+            clamavcdiff(str(tmp_path)).applyscripts([[move]])
+        assert (tmp_path / 'daily.hdb').read_bytes() == b'aaa\nbbb\n'
+        assert (tmp_path / 'moved.hdb').read_bytes() == b'zzz\n'
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['daily.hdb', 'moved.hdb']
+    clamavcdiff(str(tmp_path)).applyscripts([[b'MOVE daily.hdb moved.hdb 2 bbb 2 bbb\n']])
+    assert (tmp_path / 'moved.hdb').read_bytes() == b'zzz\nbbb\n'
+
+
+def test_apply_keeps_mode(tmp_path):
+    (tmp_path / 'daily.hdb').write_bytes(b'aaa\nbbb\n')
+    (tmp_path / 'moved.hdb').write_bytes(b'zzz\n')
+    os.chmod(tmp_path / 'daily.hdb', 0o644)
+    os.chmod(tmp_path / 'moved.hdb', 0o640)
+    clamavcdiff(str(tmp_path)).applyscripts([[b'OPEN daily.hdb\n', b'ADD ccc\n', b'CLOSE\n',
+                                              b'MOVE daily.hdb moved.hdb 1 aaa 1 aaa\n']])
+    assert (tmp_path / 'daily.hdb').read_bytes() == b'bbb\nccc\n'
+    assert (tmp_path / 'moved.hdb').read_bytes() == b'zzz\naaa\n'
+    assert os.stat(tmp_path / 'daily.hdb').st_mode & 0o777 == 0o644
+    assert os.stat(tmp_path / 'moved.hdb').st_mode & 0o777 == 0o640
+
+    with pytest.raises(cdifferror):
+        clamavcdiff(str(tmp_path)).applyscripts([[b'UNLINK missing.hdb\n']])
+
+
+def test_compactscripts(tmp_path):
+    scripts = [[b'OPEN a.db\n', b'DEL 2 l2\n', b'XCHG 3 l3 x3\n', b'ADD n1\n', b'ADD n2\n', b'CLOSE\n'],
+               [b'OPEN a.db\n', b'XCHG 2 x3 y3\n', b'DEL 5 n1\n', b'XCHG 6 n2 m2\n',
+                b'DEL 4 l5\n', b'ADD n3\n', b'CLOSE\n'],
+               [b'OPEN a.db\n', b'DEL 2 y3\n', b'CLOSE\n', b'OPEN b.db\n', b'ADD z\n', b'CLOSE\n',
+                b'UNLINK b.db\n', b'UNLINK gone.db\n', b'OPEN c.db\n', b'ADD c1\n', b'CLOSE\n']]
+    compacted = list(compactscripts(scripts, {'a.db': 5, 'gone.db': 1}))
+    assert compacted == [b'UNLINK gone.db\n', b'OPEN a.db\n', b'DEL 2 l2\n', b'DEL 3 l3\n',
+                         b'DEL 5 l5\n', b'ADD m2\n', b'ADD n3\n', b'CLOSE\n',
+                         b'OPEN c.db\n', b'ADD c1\n', b'CLOSE\n']
+    for name, scriptlist in (('chain', scripts), ('compacted', [compacted])):
+        directory = tmp_path / name
+        directory.mkdir()
+        (directory / 'a.db').write_bytes(b'l1\nl2\nl3\nl4\nl5\n')
+        (directory / 'gone.db').write_bytes(b'x\n')
+        clamavcdiff(str(directory)).applyscripts(scriptlist)
+    assert sorted(p.name for p in (tmp_path / 'chain').iterdir()) == ['a.db', 'c.db']
+    for name in ('a.db', 'c.db'):
+        assert (tmp_path / 'chain' / name).read_bytes() == (tmp_path / 'compacted' / name).read_bytes()
+
+    with pytest.raises(cdifferror):
+        list(compactscripts(scripts))
+    with pytest.raises(cdifferror):
+        list(compactscripts([scripts[0], [b'OPEN a.db\n', b'DEL 5 nX\n', b'CLOSE\n']], {'a.db': 5}))
@@ -0,0 +1,109 @@
+import os
+import sys
+import json
+import hashlib
+sys.path.append('../')
+from cav import clamavkeys
+from cav.clamavbuilder import clamavbuilder
+from cav.clamavcheckpoint import clamavcheckpoint, statehash, _selftest, _DIGESTS
+from test_clamavkeys import privatekey
+
+
+def test_statehash():
+    for kind, reference in (('md5', hashlib.md5), ('sha256', hashlib.sha256)):
+        first = statehash(kind)
+        first.update(b'a' * 1000)
+        assert first.digest() == reference(b'a' * 1000).digest()
+        resumed = statehash(kind, first.state())
+        resumed.update(b'b' * 77)
+        first.update(b'b' * 77)
+        assert resumed.digest() == first.digest() == reference(b'a' * 1000 + b'b' * 77).digest()
+
+
+def test_selftest(monkeypatch):
+    assert _selftest() is True
+    # A struct size that does not fit the library fails the self-test
+    monkeypatch.setitem(_DIGESTS, 'md5', ('MD5', 16, 80))
+    assert _selftest() is False
+
+
+def test_cdiff_grows(tmp_path):
+    data = open('daily-25784.cdiff', 'rb').read()
+    path = str(tmp_path / 'daily-25784.cdiff')
+    checkpoint = clamavcheckpoint(path, interval=10000)
+    with open(path, 'wb') as partial:
+        partial.write(data[:30000])
+    assert checkpoint.verify() is False and not checkpoint.complete
+    assert checkpoint.resumedfrom == 0 and checkpoint.hashed == 30000 - 350
+    with open(path, 'ab') as partial:
+        partial.write(data[30000:])
+    assert checkpoint.verify() is True and checkpoint.complete
+    assert checkpoint.resumedfrom == 29650 and checkpoint.hashed == len(data) - 343 - 29650
+    # Nothing new to hash
+    assert checkpoint.verify() is True and checkpoint.hashed == 0
+    checkpoint.remove()
+    assert not os.path.exists(path + '.ckpt')
+
+
+def test_cvd_rewritten(tmp_path):
+    key = privatekey(clamavkeys.MD5, 'checkpoint-test')
+    (tmp_path / 'source').mkdir()
+    (tmp_path / 'source' / 'daily.hdb').write_bytes(os.urandom(500000).hex().encode())
+    clamavbuilder(key).buildcvd(str(tmp_path / 'source'), str(tmp_path / 'daily.cvd'), 3)
+    data = (tmp_path / 'daily.cvd').read_bytes()
+    path = str(tmp_path / 'growing.cvd')
+    checkpoint = clamavcheckpoint(path, str(tmp_path / 'state.json'), interval=65536)
+    clamavkeys.registerkey(key)
+    try:
+        with open(path, 'wb') as partial:
+            partial.write(data[:400000])
+        assert checkpoint.verify() is False and checkpoint.hashed == 400000 - 512
+        with open(path, 'ab') as partial:
+            partial.write(data[400000:])
+        assert checkpoint.verify() is True and checkpoint.resumedfrom == 400000
+
+        # A changed prefix starts over from the header
+        damaged = bytearray(data)
+        damaged[len(data) - 1000] ^= 1
+        with open(path, 'wb') as partial:
+            partial.write(bytes(damaged))
+        assert checkpoint.verify() is False
+        assert checkpoint.resumedfrom < len(data) - 1000
+        with open(path, 'wb') as partial:
+            partial.write(data)
+        assert checkpoint.verify() is True
+    finally:
+        clamavkeys.unregisterkey('checkpoint-test')
+
+
+def test_changed_prefix(tmp_path):
+    data = open('daily-25784.cdiff', 'rb').read()
+    path = str(tmp_path / 'daily-25784.cdiff')
+    checkpoint = clamavcheckpoint(path, interval=10000)
+    with open(path, 'wb') as partial:
+        partial.write(data[:30000])
+    assert checkpoint.verify() is False
+    # Rewritten with the rest of the file and a changed byte early on
+    damaged = bytearray(data)
+    damaged[100] ^= 1
+    with open(path, 'r+b') as partial:
+        partial.write(bytes(damaged))
+    assert checkpoint.verify() is False and checkpoint.resumedfrom == 0
+
+    # A new file in its place is hashed from the start
+    with open(path, 'wb') as partial:
+        partial.write(data[:30000])
+    assert checkpoint.verify() is False
+    with open(path + '.new', 'wb') as full:
+        full.write(data)
+    os.replace(path + '.new', path)
+    assert checkpoint.verify() is True and checkpoint.resumedfrom == 0
+
+    # Saved states from another OpenSSL build are not used
+    with open(path + '.ckpt') as sidecar:
+        saved = json.load(sidecar)
+    saved['library'] = 'other'
+    with open(path + '.ckpt', 'w') as sidecar:
+        json.dump(saved, sidecar)
+    assert checkpoint.verify() is True and checkpoint.resumedfrom == 0
+    assert len(bytes.fromhex(saved['checkpoints'][-1]['state'])) == 112
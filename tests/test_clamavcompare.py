@@ -0,0 +1,46 @@
+import io
+import sys
+import collections
+sys.path.append('../')
+from cav.clamavfile import clamavfile
+from cav.clamavcompare import clamavcompare, ADDED, REMOVED
+from test_clamavindex import makecvd, hdblines
+
+
+def test_compare(tmp_path):
+    oldhdb = hdblines(20000, 1).splitlines(True)
+    newhdb = oldhdb[:5000] + oldhdb[5100:] + hdblines(300, 2).splitlines(True) + [oldhdb[7]]
+    makecvd(str(tmp_path / 'old.cvd'), {'daily.info': b'ClamAV-VDB:old\n',
+                                        'daily.hdb': b''.join(oldhdb),
+                                        'daily.ldb': b'Same.Sig;Engine:51-255\n',
+                                        'daily.fp': b'removed:1:x\nno newline'})
+    makecvd(str(tmp_path / 'new.cvd'), {'daily.info': b'ClamAV-VDB:new\n',
+                                        'daily.hdb': b''.join(newhdb),
+                                        'daily.ldb': b'Same.Sig;Engine:51-255\n',
+                                        'daily.ign2': b'Ignored.Sig\n'})
+    old = clamavfile(str(tmp_path / 'old.cvd'))
+    new = clamavfile(str(tmp_path / 'new.cvd'))
+
+    expected = collections.Counter(line.rstrip(b'\n') for line in newhdb)
+    expected.subtract(line.rstrip(b'\n') for line in oldhdb)
+    for memory in (1 << 26, 200000):
+        comparison = clamavcompare(old, new, memory=memory, directory=str(tmp_path))
+        differences = list(comparison.differences())
+        members = comparison.members
+        assert (comparison.spills > 0) == (memory == 200000)
+        assert members['daily.hdb'].added == 301 and members['daily.hdb'].removed == 100
+        assert members['daily.hdb'].oldlines == 20000 and members['daily.hdb'].newlines == 20201
+        assert collections.Counter({line: 1 if sign == ADDED else -1
+                                    for name, sign, line in differences if name == 'daily.hdb'}) == \
+            collections.Counter({line: count for line, count in expected.items() if count})
+        assert members['daily.ldb'].identical and not members['daily.ldb'].added
+        assert [(sign, line) for name, sign, line in differences if name == 'daily.fp'] == \
+            [(REMOVED, b'no newline'), (REMOVED, b'removed:1:x')]
+        assert [(sign, line) for name, sign, line in differences if name == 'daily.ign2'] == \
+            [(ADDED, b'Ignored.Sig')]
+        assert sorted(p.name for p in tmp_path.iterdir()) == ['new.cvd', 'old.cvd']
+
+    output = io.BytesIO()
+    summary = clamavcompare(old, new).write(output)
+    assert output.getvalue().splitlines()[:2] == [b'daily.fp:-no newline', b'daily.fp:-removed:1:x']
+    assert [repr(change) for change in summary.values()][:2] == ['daily.fp: +0 -2', 'daily.hdb: +301 -100']
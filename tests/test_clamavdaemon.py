@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import shutil
+import asyncio
+import pytest
+sys.path.append('../')
+from cav.clamavcache import clamavcache
+from cav.clamavdaemon import clamavdaemon, main
+
+
+async def ask(socketpath, *queries):
+    reader, writer = await asyncio.open_unix_connection(socketpath)
+    answers = list()
+    for text in queries:
+        writer.write(text.encode() + b'\n')
+        answers.append(json.loads(await reader.readline()))
+    writer.close()
+    return answers
+
+
+async def until(condition, timeout=10):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError('timed out')
+
+
+@pytest.mark.parametrize('watch', ['auto', 'poll'])
+def test_daemon(tmp_path, watch):
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    shutil.copy('daily-25784.cdiff', str(mirror))
+    shutil.copy('main-59.cdiff', str(mirror))
+    (mirror / 'notes.txt').write_bytes(b'ignored')
+    socketpath = str(tmp_path / 'daemon.sock')
+    cache = clamavcache(str(tmp_path / 'clamav.cache'))
+
+    async def run():
+        daemon = clamavdaemon(str(mirror), socketpath, cache, watch=watch, pollinterval=0.05)
+        await daemon.start()
+        try:
+            await daemon.settled()
+            ping, status, versions = await ask(socketpath, 'ping', 'status', 'versions')
+            assert ping['ok'] and ping['files'] == 2 and ping['watching'] in ('inotify', 'poll')
+            assert [entry['name'] for entry in status] == ['daily-25784.cdiff', 'main-59.cdiff']
+            assert status[0]['ok'] is True and status[0]['version'] == 25784
+            assert versions['daily'] == 25784
+            parsed = daemon.files['daily-25784.cdiff'].clamobject
+
+            # A replaced file is verified again, the unchanged one is not
+            shutil.copy('daily-25784-signature-fail.cdiff', str(mirror / 'daily-25785.cdiff'))
+            await until(lambda: daemon.files.get('daily-25785.cdiff') is not None and
+                        daemon.files['daily-25785.cdiff'].ok is False)
+            (entry,) = await ask(socketpath, 'status daily-25785.cdiff')
+            assert entry['ok'] is False and entry['error'] == 'signature mismatch'
+            assert daemon.files['daily-25784.cdiff'].clamobject is parsed
+            assert (await ask(socketpath, 'versions'))[0]['daily'] == 25784
+
+            os.unlink(str(mirror / 'daily-25785.cdiff'))
+            # A damaged body is a failed check, not a dead task
+            header = b'ClamAV-VDB:18 Oct 2026 10-00 +0000:5:1:90:X:X:tester:1600000000'.ljust(512, b' ')
+            (mirror / 'bytecode.cld').write_bytes(header + b'garbage' * 100)
+            await until(lambda: daemon.files.get('bytecode.cld') is not None and
+                        daemon.files['bytecode.cld'].checked)
+            assert daemon.files['bytecode.cld'].ok is False and daemon.files['bytecode.cld'].error
+            await until(lambda: 'daily-25785.cdiff' not in daemon.files)
+            (entry, unknown) = await ask(socketpath, 'status daily-25785.cdiff', 'help')
+            assert entry['error'] == 'no such file' and unknown['error'] == 'unknown query'
+            # Unknown names are answered but not kept
+            await ask(socketpath, *['status missing-{}.cvd'.format(number) for number in range(50)])
+            assert len(daemon._answers) <= len(daemon.files) + 2
+        finally:
+            await daemon.close()
+        assert not os.path.exists(socketpath)
+        return daemon
+
+    daemon = asyncio.run(run())
+    assert daemon.queries == 57
+
+
+def test_main(tmp_path, capsys):
+    assert main(['--socket', str(tmp_path / 'missing.sock'), '--query', 'ping']) == 1
+    assert 'missing.sock' in capsys.readouterr().err
@@ -1,4 +1,6 @@
 import pytest
+import io
+import os
 import sys
 sys.path.append('../')
 from cav.clamavfile import clamavfile
@@ -47,3 +49,170 @@ def test_fileinfo_daily():
 def test_fileinfo_daily_failed():
     clamobject = clamavfile('daily-signature-fail.cvd')
     assert clamobject.verifysignature() is False
+
+
+def test_savetofile_destinations(tmp_path):
+    clamobject = clamavfile('daily-25784.cdiff')
+    with open('daily-25784.cdiff', 'rb') as cdiff:
+        cdiff.seek(clamobject.headersize())
+        expected = cdiff.read(clamobject.datasize())
+    assert clamobject.savetofile(str(tmp_path / 'path.gz')) == len(expected)
+    assert (tmp_path / 'path.gz').read_bytes() == expected
+
+    with open(tmp_path / 'fileobj.gz', 'wb') as extractfile:
+        extractfile.write(b'prefix')
+        assert clamobject.savetofile(extractfile) == len(expected)
+        extractfile.write(b'suffix')
+    assert (tmp_path / 'fileobj.gz').read_bytes() == b'prefix' + expected + b'suffix'
+
+    chunks = []
+    assert clamobject.savetofile(chunks.append) == len(expected)
+    assert b''.join(chunks) == expected
+
+
+def test_verifyandsave(tmp_path):
+    clamobject = clamavfile('daily-25784.cdiff')
+    assert clamobject.verifyandsave(str(tmp_path / 'daily.gz')) is True
+    assert clamobject.savetofile(str(tmp_path / 'expected.gz')) == clamobject.datasize()
+    assert (tmp_path / 'daily.gz').read_bytes() == (tmp_path / 'expected.gz').read_bytes()
+    # Same mode as the plain write of savetofile, not the 0600 of mkstemp
+    assert os.stat(tmp_path / 'daily.gz').st_mode == os.stat(tmp_path / 'expected.gz').st_mode
+    os.chmod(tmp_path / 'daily.gz', 0o640)
+    assert clamobject.verifyandsave(str(tmp_path / 'daily.gz')) is True
+    assert os.stat(tmp_path / 'daily.gz').st_mode & 0o777 == 0o640
+
+    clamobject = clamavfile('daily-25784-signature-fail.cdiff')
+    assert clamobject.verifyandsave(str(tmp_path / 'fail.gz')) is False
+    assert sorted(os.listdir(tmp_path)) == ['daily.gz', 'expected.gz']
+
+
+def test_from_bytes_and_fileobj(tmp_path):
+    with open('daily-25784.cdiff', 'rb') as cdiff:
+        data = cdiff.read()
+    fromdisk = clamavfile('daily-25784.cdiff')
+    frombytes = clamavfile.from_bytes(data)
+    assert frombytes.header == fromdisk.header
+    assert frombytes.verifysignature() is True
+    assert clamavfile.from_bytes(data[:-1] + b'X').verifysignature() is False
+    assert frombytes.savetofile(str(tmp_path / 'frombytes.gz')) == fromdisk.datasize()
+
+    with open('daily-25784.cdiff', 'rb') as cdiff:
+        fromfile = clamavfile.from_fileobj(cdiff)
+    assert fromfile.filename == 'daily-25784.cdiff'
+    assert fromfile.header == fromdisk.header
+    assert fromfile.verifysignature() is True
+    assert clamavfile.from_fileobj(io.BytesIO(data)).signatures() == 227432
+
+
+def test_cld_conversion(tmp_path):
+    from cav import clamavkeys
+    from cav.clamavbuilder import clamavbuilder
+    from test_clamavkeys import privatekey
+    key = privatekey(clamavkeys.MD5, 'cld-test')
+    psskey = privatekey(clamavkeys.PSS, 'cld-test-pss')
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'daily.hdb').write_bytes(b''.join(b'%032x:%d:Sig-%d\n' % (i, i, i) for i in range(5000)))
+    (source / 'daily.ldb').write_bytes(b'Logical.Sig;Engine:51-255\n')
+    builder = clamavbuilder(key, psskey, compresslevel=6)
+    cvd = builder.buildcvd(str(source), str(tmp_path / 'daily.cvd'), 42)
+    clamavkeys.registerkey(key)
+    clamavkeys.registerkey(psskey)
+    try:
+        assert not cvd.iscld() and cvd.verifysignature()
+
+        cld = cvd.tocld(str(tmp_path / 'daily.cld'))
+        assert cld.iscld() and not cld.compressed
+        assert cld.filetype() == 'ClamAV-VDB' and cld.version() == 42
+        assert cld.md5() == 'X' and cld.signatures() == cvd.signatures()
+        assert cld.members() == cvd.members()
+        assert cld.openmember('daily.hdb').read() == (source / 'daily.hdb').read_bytes()
+        assert cld.verifysignature() is True
+        assert cld.hashdb().lookup('%032x' % 17) == 'Sig-17'
+
+        packed = cld.tocld(str(tmp_path / 'packed.cld'), compresslevel=1)
+        assert packed.iscld() and packed.compressed and packed.verifysignature()
+        assert os.stat(tmp_path / 'packed.cld').st_mode == os.stat(tmp_path / 'daily.cvd').st_mode
+        # An unsigned gzipped CVD is not a CLD and is rejected
+        header = cvd.header
+        broken = ':'.join(['ClamAV-VDB', header['signaturedate'], '42', str(cvd.signatures()),
+                           str(cvd.functionalitylevel()), cvd.md5(), '', 'tester', '0'])
+        (tmp_path / 'broken.cvd').write_bytes(broken.encode().ljust(512, b' ') +
+                                              (tmp_path / 'daily.cvd').read_bytes()[512:])
+        broken = clamavfile(str(tmp_path / 'broken.cvd'))
+        assert not broken.iscld() and broken.verifysignature() is False
+
+        resigned = builder.tocvd(str(tmp_path / 'daily.cld'), str(tmp_path / 'served.cvd'))
+        assert not resigned.iscld() and resigned.verifysignature()
+        assert resigned.members() == cvd.members()
+        assert resigned.header['signaturedate'] == cvd.header['signaturedate']
+        # A gzipped body is copied unless recompress is asked for
+        copied = builder.tocvd(packed, str(tmp_path / 'copied.cvd'))
+        assert (tmp_path / 'copied.cvd').read_bytes()[512:] == (tmp_path / 'packed.cld').read_bytes()[512:]
+        assert copied.verifysignature()
+        assert builder.tocvd(packed, str(tmp_path / 'copied.cvd'), recompress=True).datasize() != packed.datasize()
+
+        # A member that does not match .info fails
+        data = bytearray((tmp_path / 'daily.cld').read_bytes())
+        position = data.index(b'Logical.Sig')
+        data[position] = ord('l')
+        (tmp_path / 'daily.cld').write_bytes(bytes(data))
+        assert clamavfile(str(tmp_path / 'daily.cld')).verifysignature() is False
+    finally:
+        clamavkeys.unregisterkey('cld-test')
+        clamavkeys.unregisterkey('cld-test-pss')
+    assert cld.verifysignature() is False
+
+
+def test_async(tmp_path, monkeypatch):
+    import asyncio
+    from cav import clamavkeys
+    from cav import clamavfile as clamavfilemodule
+    from cav.clamavbuilder import clamavbuilder
+    from cav.clamavcache import clamavcache
+    from test_clamavkeys import privatekey
+    key = privatekey(clamavkeys.MD5, 'async-test')
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'daily.hdb').write_bytes(b''.join(b'%032x:%d:Sig-%d\n' % (i, i, i) for i in range(20000)))
+    clamavbuilder(key, compresslevel=1).buildcvd(str(source), str(tmp_path / 'daily.cvd'), 7)
+    (tmp_path / 'out').mkdir()
+    (tmp_path / 'partial').mkdir()
+    # Small slices so every file takes many jobs, one worker for all
+    monkeypatch.setattr(clamavfilemodule, 'SLICESIZE', 4096)
+    clamavfilemodule.setexecutor(workers=1)
+    cache = clamavcache(str(tmp_path / 'clamav.cache'))
+
+    async def run():
+        cdiff = await clamavfile.open('daily-25784.cdiff')
+        assert cdiff.version() == 25784
+        assert await cdiff.verify() is True
+        assert await (await clamavfile.open('daily-25784-signature-fail.cdiff')).verify() is False
+        cvd = await clamavfile.open(str(tmp_path / 'daily.cvd'))
+        frombytes = clamavfile.from_bytes((tmp_path / 'daily.cvd').read_bytes())
+        results = await asyncio.gather(cvd.verify(cache), frombytes.verify(), cdiff.verify())
+        assert results == [True, True, True] and cache.misses == 1
+        assert await cvd.verify(cache) is True and cache.hits == 1
+
+        # Cancelled between slices, the worker and slot are given back
+        task = asyncio.ensure_future(frombytes.verify())
+        await asyncio.sleep(0.001)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        names = await cvd.extract(str(tmp_path / 'out'))
+        assert names == cvd.members() == ['daily.hdb', 'daily.info']
+        task = asyncio.ensure_future(cvd.extract(str(tmp_path / 'partial')))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return await asyncio.wait_for(cdiff.verify(), 10)
+
+    clamavkeys.registerkey(key)
+    try:
+        assert asyncio.run(run()) is True
+    finally:
+        clamavkeys.unregisterkey('async-test')
+        clamavfilemodule.setexecutor()
+    assert (tmp_path / 'out' / 'daily.hdb').read_bytes() == (source / 'daily.hdb').read_bytes()
@@ -0,0 +1,91 @@
+import sys
+import hashlib
+sys.path.append('../')
+from cav.clamavfile import clamavfile
+from cav.clamavhashdb import clamavhashdb, SECTION
+from test_clamavindex import makecvd, hdblines
+
+
+def test_lookup(tmp_path):
+    sha256 = hashlib.sha256(b'eicar').hexdigest()
+    sha1 = hashlib.sha1(b'eicar').hexdigest()
+    section = hashlib.md5(b'section').hexdigest()
+    members = {'daily.hdb': hdblines(5000, 1) + b'%s:68:Eicar-Md5\n' % hashlib.md5(b'eicar').hexdigest().encode(),
+               'daily.hsb': b'%s:68:Eicar-Sha256\n%s:*:Eicar-Sha1:73\n' % (sha256.encode(), sha1.encode()),
+               'daily.mdb': b'4096:%s:Section-Md5\n8192:%s:Section-Md5-Big\n' % (section.encode(), section.encode()),
+               'daily.ndb': b'Not.A.Hash:0:*:41414141\n',
+               'daily.info': b'ClamAV-VDB:test\n'}
+    makecvd(str(tmp_path / 'daily.cvd'), members)
+    hashdb = clamavfile(str(tmp_path / 'daily.cvd')).hashdb()
+    assert len(hashdb) == 5005 and hashdb.skipped == 0
+
+    assert hashdb.lookup(hashlib.md5(b'eicar').hexdigest()) == 'Eicar-Md5'
+    assert hashdb.lookup(hashlib.md5(b'eicar').digest(), 68) == 'Eicar-Md5'
+    assert hashdb.lookup(hashlib.md5(b'eicar').digest(), 69) is None
+    assert hashdb.lookup(sha256, 68) == 'Eicar-Sha256'
+    assert hashdb.lookup(sha1, 12345) == 'Eicar-Sha1'
+    assert hashdb.lookup(hashlib.md5(b'clean').digest()) is None
+    assert hashdb.lookup(section) is None
+    assert hashdb.lookup(section, 8192, SECTION) == 'Section-Md5-Big'
+    assert hashdb.lookup(section, 4096, SECTION) == 'Section-Md5'
+
+    signatures = [line.split(b':') for line in hdblines(5000, 1).splitlines()]
+    digests = [bytes.fromhex(fields[0].decode()) for fields in signatures]
+    sizes = [int(fields[1]) for fields in signatures]
+    names = [fields[2].decode() for fields in signatures]
+    assert hashdb.lookupmany(digests) == names
+    assert hashdb.lookupmany(digests, sizes) == names
+    assert hashdb.lookupmany(digests, [size + 1 for size in sizes]) == [None] * 5000
+    assert hashdb.lookupmany([hashlib.md5(b'%d' % i).digest() for i in range(1000)]) == [None] * 1000
+
+    hashdb.addlines([b'%s:10:Added-Later\n' % hashlib.md5(b'later').hexdigest().encode(),
+                     b'not a signature\n'])
+    assert hashdb.lookup(hashlib.md5(b'later').digest(), 10) == 'Added-Later'
+    assert hashdb.lookup(digests[17]) == names[17]
+    assert hashdb.skipped == 1
+    # Digest, size, name offset and name per signature plus fixed tables
+    assert hashdb.memory() < 5006 * 64 + 4 * (65537 * 4 + 8192)
+
+
+def test_indexfile(tmp_path):
+    section = hashlib.md5(b'section').hexdigest()
+    members = {'daily.hdb': hdblines(3000, 1),
+               'daily.hsb': b'%s:*:Eicar-Sha256\n' % hashlib.sha256(b'eicar').hexdigest().encode(),
+               'daily.mdb': b'4096:%s:Section-Md5\n' % section.encode(),
+               'daily.info': b'ClamAV-VDB:test\n'}
+    makecvd(str(tmp_path / 'daily.cvd'), members)
+    indexfile = str(tmp_path / 'daily.idx')
+    built = clamavfile(str(tmp_path / 'daily.cvd')).exporthashdb(indexfile)
+
+    mapped = clamavhashdb.open(indexfile)
+    assert mapped.version() == built.version() and len(mapped) == len(built) == 3002
+    signatures = [line.split(b':') for line in hdblines(3000, 1).splitlines()]
+    digests = [bytes.fromhex(fields[0].decode()) for fields in signatures]
+    names = [fields[2].decode() for fields in signatures]
+    assert mapped.lookupmany(digests) == names
+    assert mapped.lookup(hashlib.sha256(b'eicar').digest(), 5) == 'Eicar-Sha256'
+    assert mapped.lookup(section, 4096, SECTION) == 'Section-Md5'
+    assert mapped.lookup(hashlib.md5(b'clean').digest()) is None
+    assert not mapped.reload()
+
+    # A new index replaces the file while lookups on the old tables go on
+    oldtables = mapped._tables
+    replacement = clamavhashdb()
+    replacement.addlines([b'%s:10:Replaced\n' % hashlib.md5(b'new').hexdigest().encode()])
+    replacement.save(indexfile, 12345)
+    assert mapped.reload() and mapped.version() == 12345
+    assert mapped.lookup(hashlib.md5(b'new').digest(), 10) == 'Replaced'
+    assert mapped.lookup(digests[5]) is None
+    assert oldtables[('file', 16)].name(oldtables[('file', 16)].find(digests[5], None)) == names[5]
+
+    # Mapped tables are copied when signatures are added
+    mapped.addlines([b'%s:11:Added\n' % hashlib.md5(b'added').hexdigest().encode()])
+    assert mapped.lookup(hashlib.md5(b'added').digest()) == 'Added'
+    assert mapped.lookup(hashlib.md5(b'new').digest()) == 'Replaced'
+
+    (tmp_path / 'bad.idx').write_bytes(b'\x00' * 64)
+    try:
+        clamavhashdb.open(str(tmp_path / 'bad.idx'))
+        assert False
+    except ValueError:
+        pass
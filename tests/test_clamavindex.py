@@ -0,0 +1,89 @@
+import io
+import os
+import gzip
+import random
+import tarfile
+import hashlib
+import sys
+sys.path.append('../')
+from cav.clamavfile import clamavfile
+from cav.clamavindex import clamavindex
+
+
+def makecvd(filename, members, md5=None):
+    body = io.BytesIO()
+    with gzip.GzipFile(fileobj=body, mode='wb', mtime=0) as gzipfile:
+        with tarfile.open(fileobj=gzipfile, mode='w', format=tarfile.USTAR_FORMAT) as tar:
+            for name, data in members.items():
+                tarinfo = tarfile.TarInfo(name)
+                tarinfo.size = len(data)
+                tar.addfile(tarinfo, io.BytesIO(data))
+    body = body.getvalue()
+    header = ':'.join(['ClamAV-VDB', '16 Apr 2020 07-58 -0400', '25784', '4', '63',
+                       md5 or hashlib.md5(body).hexdigest(), 'X', 'test', '1587038339'])
+    with open(filename, 'wb') as cvd:
+        cvd.write(header.encode('ascii').ljust(512, b' '))
+        cvd.write(body)
+
+
+def hdblines(count, seed):
+    generator = random.Random(seed)
+    return b''.join(b'%032x:%d:Test.Sig-%d-0\n' % (generator.getrandbits(128),
+                                                   generator.randrange(1, 10 ** 7), i)
+                    for i in range(count))
+
+
+def test_members_and_random_access(tmp_path):
+    members = {'daily.info': b'ClamAV-VDB:test\ndaily.hdb:1:x\n',
+               'daily.hdb': hdblines(20000, 1),
+               'daily.hsb': hdblines(30000, 2),
+               'daily.ldb': hdblines(5000, 3)}
+    makecvd(tmp_path / 'daily.cvd', members)
+    clamobject = clamavfile(str(tmp_path / 'daily.cvd'))
+    assert clamobject.members() == list(members)
+    assert (tmp_path / 'daily.cvd.idx').exists()
+    assert clamobject.openmember('daily.info').read() == members['daily.info']
+
+    index = clamavindex(clamobject, str(tmp_path / 'daily.idx'), span=65536)
+    assert len(index.points) > 5
+    for name, data in members.items():
+        assert index.read(name) == data
+
+    index = clamavindex(clamobject, str(tmp_path / 'daily.idx'), span=65536)
+    assert index.load() is True
+    assert index.read('daily.ldb') == members['daily.ldb']
+    assert index.open('daily.hsb').readline() == members['daily.hsb'].split(b'\n')[0] + b'\n'
+
+    # A truncated or damaged sidecar is built again
+    saved = (tmp_path / 'daily.idx').read_bytes()
+    for damaged in (saved[:len(saved) // 2], saved[:100] + b'\xff' * 40 + saved[140:]):
+        (tmp_path / 'daily.idx').write_bytes(damaged)
+        index = clamavindex(clamobject, str(tmp_path / 'daily.idx'), span=65536)
+        assert index.read('daily.ldb') == members['daily.ldb']
+        assert (tmp_path / 'daily.idx').read_bytes() == saved
+    assert sorted(os.listdir(str(tmp_path))) == ['daily.cvd', 'daily.cvd.idx', 'daily.idx']
+
+
+def test_unsigned_identity(tmp_path):
+    # Packed CLDs all have the MD5 X, the sidecar of another one is not used
+    first = {'daily.hdb': hdblines(5000, 5)}
+    second = {'daily.hdb': hdblines(5000, 6)}
+    makecvd(tmp_path / 'first.cld', first, md5='X')
+    makecvd(tmp_path / 'second.cld', second, md5='X')
+    assert clamavfile(str(tmp_path / 'first.cld')).members() == ['daily.hdb']
+    clamobject = clamavfile(str(tmp_path / 'second.cld'))
+    # Same size as far as the sidecar can tell
+    sidecar = bytearray((tmp_path / 'first.cld.idx').read_bytes())
+    sidecar[40:48] = clamobject.datasize().to_bytes(8, 'little')
+    (tmp_path / 'second.cld.idx').write_bytes(bytes(sidecar))
+    index = clamavindex(clamobject, str(tmp_path / 'second.cld.idx'))
+    assert index.read('daily.hdb') == second['daily.hdb']
+
+
+def test_extractall(tmp_path):
+    members = {'main.info': b'ClamAV-VDB:test\n', 'main.hdb': hdblines(100, 4)}
+    makecvd(tmp_path / 'main.cvd', members)
+    (tmp_path / 'main').mkdir()
+    assert clamavfile(str(tmp_path / 'main.cvd')).extractall(str(tmp_path / 'main')) == list(members)
+    for name, data in members.items():
+        assert (tmp_path / 'main' / name).read_bytes() == data
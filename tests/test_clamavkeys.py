@@ -0,0 +1,69 @@
+import hashlib
+import sys
+import threading
+sys.path.append('../')
+from cav import clamavkeys
+from cav.clamavkeys import clamavkey, decodesignature, encodesignature
+from cav.clamavfile import clamavfile
+
+# 1024 bit key for tests only
+TESTN = 164955408083598324579989919423569083673202159832562759626904040543059160274265427067350665255879839517276317257899827672108760373251798512216811088735687597358494731759390510559782838158659917702189410241234167354124290693453298762867088923781906104546080412583306048578180470452950245523909039864069375871981
+TESTD = 22257666260025023792069378480287797838200202929632917029780313876470881399901264500306421301825616382368348772626274869225899384785169511017185108529375546580702998981701185731159754638696374906691245153175869311431403151021400583287137819219782838083084994319129726043955095106336977246226952688894353422401
+
+
+def privatekey(kind=clamavkeys.MD5, name='test'):
+    return clamavkey(name, TESTN, 65537, kind, TESTD)
+
+
+def test_decode_encode():
+    signature = '4Jp9JtGJY6nUk8JHDQQpQeBwlfXqskvhXL+vesDNqAeWCmjbudU+Hy/Nj4/BH2vl70c/R5B/VYY+eqqCQo6o7VGLqLJr/E+19gejqMp/iRcuHrtnLw6V/x3UjO3/qYVSlcJvAjtMI7FK32wjB+Sp8kaS/ZbfaFQp6trRQhisjqf'
+    value = sum(clamavkeys.ALPHABET.index(c) << (6 * i) for i, c in enumerate(signature))
+    assert decodesignature(signature) == value
+    assert encodesignature(value, len(signature)) == signature
+    assert decodesignature('abc!') == -1
+    assert clamavkeys.CLAMAVKEY.verify(signature, bytes.fromhex('92baacd59fd26e6bcf03077add78d209'))
+    assert not clamavkeys.CLAMAVKEY.verify(signature, bytes.fromhex('92baacd59fd26e6bcf03077add78d208'))
+
+
+def test_pss_fixture():
+    with open('daily-25784.cdiff', 'rb') as cdiff:
+        digest = hashlib.sha256(cdiff.read()[:-343]).digest()
+    signature = clamavfile('daily-25784.cdiff').signature()
+    assert clamavkeys.CLAMAVPSSKEY.verify(signature, digest)
+    assert not clamavkeys.CLAMAVPSSKEY.verify(signature, bytes(32))
+
+
+def test_registry():
+    key = privatekey()
+    digest = hashlib.md5(b'private database').digest()
+    signature = encodesignature(pow(int.from_bytes(digest, 'big'), key.d, key.n), key.siglength)
+    assert not any(k.verify(signature, digest) for k in clamavkeys.keys(clamavkeys.MD5))
+    clamavkeys.registerkey(key)
+    try:
+        assert clamavkeys.getkey('test') is key
+        assert [k.name for k in clamavkeys.keys(clamavkeys.MD5)] == ['clamav', 'test']
+        assert clamavkeys.keys(clamavkeys.MD5, ['test']) == [key]
+        assert any(k.verify(signature, digest) for k in clamavkeys.keys(clamavkeys.MD5))
+        # Registered again after the test key, still tried first
+        clamavkeys.registerkey(clamavkeys.CLAMAVKEY)
+        clamavkeys.unregisterkey('clamav')
+        clamavkeys.registerkey(clamavkeys.CLAMAVKEY)
+        assert [k.name for k in clamavkeys.keys(clamavkeys.MD5)] == ['clamav', 'test']
+    finally:
+        clamavkeys.unregisterkey('test')
+        clamavkeys.registerkey(clamavkeys.CLAMAVKEY)
+    assert clamavkeys.keys(clamavkeys.MD5) == [clamavkeys.CLAMAVKEY]
+
+
+def test_threads():
+    key = privatekey()
+    digest = hashlib.md5(b'threads').digest()
+    signature = key.sign(digest)
+    results = list()
+    threads = [threading.Thread(target=lambda: results.append(key.verify(signature, digest)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [True] * 8
@@ -0,0 +1,82 @@
+import sys
+import shutil
+import asyncio
+sys.path.append('../')
+from cav import clamavkeys, clamavmetrics
+from cav.clamavfile import clamavfile
+from cav.clamavcache import clamavcache
+from cav.clamavbuilder import clamavbuilder
+from cav.clamavdns import clamavdns
+from cav.clamavresolver import clamavresolver
+from test_clamavkeys import privatekey
+from test_clamavresolver import standin, startserver, RECORD
+
+
+def test_disabled():
+    assert clamavmetrics.active() is None
+    assert clamavfile('daily-25784.cdiff').verifysignature()
+    assert clamavmetrics.disable() is None
+
+
+def test_verify_and_cache(tmp_path):
+    key = privatekey(clamavkeys.MD5, 'metrics-test')
+    clamavkeys.registerkey(key)
+    (tmp_path / 'source').mkdir()
+    (tmp_path / 'source' / 'daily.hdb').write_bytes(b'%032x:1:Sig\n' % 1 * 10000)
+    clamavbuilder(key).buildcvd(str(tmp_path / 'source'), str(tmp_path / 'daily.cvd'), 7)
+    shutil.copy('daily-25784.cdiff', str(tmp_path / 'daily-25784.cdiff'))
+    events = list()
+    metrics = clamavmetrics.enable()
+    metrics.subscribe(lambda *event: events.append(event))
+    try:
+        assert clamavfile(str(tmp_path / 'daily.cvd')).verifysignature()
+        cache = clamavcache(str(tmp_path / 'clamav.cache'))
+        assert cache.verify(str(tmp_path / 'daily-25784.cdiff'))
+        assert cache.verify(str(tmp_path / 'daily-25784.cdiff'))
+    finally:
+        assert clamavmetrics.disable() is metrics
+        clamavkeys.unregisterkey('metrics-test')
+    assert clamavfile('daily-25784.cdiff').verifysignature()
+
+    snapshot = metrics.snapshot()
+    timers = snapshot['timers']
+    assert set(timers) == {'read', 'hash', 'rsa', 'pss', 'verify'}
+    assert timers['verify']['count'] == 2 and timers['rsa']['count'] == 1
+    counters = snapshot['counters']
+    cdiffsize = clamavfile('daily-25784.cdiff').filesize
+    cvdsize = (tmp_path / 'daily.cvd').stat().st_size
+    assert counters['read_bytes'] == cvdsize + cdiffsize - clamavfile('daily-25784.cdiff').footersize()
+    assert counters['hashed_bytes'] == counters['read_bytes'] - 512
+    assert counters['cache_hits'] == 1 and counters['cache_misses'] == 1
+    assert counters['verified_files'] == 2 and 'verify_failures' not in counters
+    assert snapshot['hashthroughput'] > 0
+    assert ('counter', 'cache_hits', 1) in events
+    assert len([event for event in events if event[:2] == ('timer', 'verify')]) == 2
+
+    text = metrics.prometheus()
+    assert '# TYPE cav_phase_seconds summary\n' in text
+    assert 'cav_phase_seconds_count{phase="verify"} 2\n' in text
+    assert 'cav_cache_hits_total 1\n' in text
+    assert 'cav_read_bytes_total {}\n'.format(counters['read_bytes']) in text
+    metrics.reset()
+    assert metrics.prometheus() == ''
+
+
+def test_dns():
+    async def run():
+        server = standin([RECORD])
+        transport, address = await startserver(server)
+        resolver = clamavresolver([address])
+        try:
+            for _ in range(3):
+                await clamavdns().query(resolver=resolver)
+        finally:
+            transport.close()
+
+    metrics = clamavmetrics.enable(clamavmetrics.clamavmetrics())
+    try:
+        asyncio.run(run())
+    finally:
+        clamavmetrics.disable()
+    assert metrics.timers['dns'][0] == 3 and metrics.timers['dns_rtt'][0] == 1
+    assert metrics.counters == {'dns_upstream_queries': 1, 'dns_cache_hits': 2}
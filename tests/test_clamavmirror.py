@@ -0,0 +1,210 @@
+import io
+import os
+import sys
+import asyncio
+import threading
+import http.server
+sys.path.append('../')
+from cav import clamavkeys
+from cav.clamavdns import clamavdns
+from cav.clamavfile import clamavfile
+from cav.clamavbuilder import clamavbuilder
+from cav.clamavmirror import clamavmirror, streamverifier
+from test_clamavkeys import privatekey
+
+
+class standin(http.server.BaseHTTPRequestHandler):
+    'Serves files from the dictionary files with ETag and Range support'
+    protocol_version = 'HTTP/1.1'
+    files = dict()
+    connections = 0
+    requests = list()
+
+    def setup(self):
+        standin.connections += 1
+        super().setup()
+
+    def log_message(self, *arguments):
+        pass
+
+    def do_GET(self):
+        name = self.path.lstrip('/')
+        standin.requests.append((name, self.headers.get('Range'),
+                                 self.headers.get('If-None-Match')))
+        if name not in self.files:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data, etag = self.files[name]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == etag:
+            start = int(self.headers['Range'][6:].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+
+def serve():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), standin)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+
+def buildfiles(tmp_path, versions):
+    builder = clamavbuilder(privatekey(clamavkeys.MD5, 'mirror-test'),
+                            privatekey(clamavkeys.PSS, 'mirror-test-pss'))
+    source = tmp_path / 'source'
+    source.mkdir()
+    files = dict()
+    for version in versions:
+        (source / 'daily.hdb').write_bytes(b''.join(b'%032x:%d:Daily.Sig-%d\n' % (i, version, i)
+                                                    for i in range(500 * version)))
+        builder.buildcvd(str(source), str(tmp_path / 'daily.cvd'), version)
+        files['daily.cvd'] = ((tmp_path / 'daily.cvd').read_bytes(), '"v{}"'.format(version))
+    builder.writecdiff(iter([b'OPEN daily.hdb\n', b'ADD 00:1:Sig\n', b'CLOSE\n']),
+                       str(tmp_path / 'daily-3.cdiff'), 3)
+    files['daily-3.cdiff'] = ((tmp_path / 'daily-3.cdiff').read_bytes(), '"c3"')
+    return files
+
+
+def test_streamverifier(tmp_path):
+    clamavkeys.registerkey(privatekey(clamavkeys.MD5, 'mirror-test'))
+    clamavkeys.registerkey(privatekey(clamavkeys.PSS, 'mirror-test-pss'))
+    try:
+        files = buildfiles(tmp_path, [2])
+        for name, (data, _) in files.items():
+            clamobject = clamavfile.from_bytes(data)
+            expected = clamobject._hashdata(io.BytesIO(data)).hexdigest()
+            for size in (1, 7, 349, 4096):
+                verifier = streamverifier()
+                for position in range(0, len(data), size):
+                    verifier.update(data[position:position + size])
+                ok, digest = verifier.finish()
+                assert ok and digest == expected, (name, size)
+            verifier = streamverifier()
+            verifier.update(data[:-20] + b'x' + data[-19:])
+            assert not verifier.finish()[0]
+    finally:
+        clamavkeys.unregisterkey('mirror-test')
+        clamavkeys.unregisterkey('mirror-test-pss')
+    verifier = streamverifier()
+    try:
+        verifier.update(b'<html>Not found</html>')
+        assert False
+    except ValueError:
+        pass
+
+
+def test_timeout_closes_connection(tmp_path):
+    async def run():
+        closed = asyncio.Event()
+
+        async def stall(reader, writer):
+            await reader.readuntil(b'\r\n\r\n')
+            await reader.read()
+            closed.set()
+
+        server = await asyncio.start_server(stall, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        downloader = clamavmirror('http://127.0.0.1:{}'.format(port), str(tmp_path), timeout=0.2)
+        try:
+            result = await downloader.fetch('daily.cvd')
+            await asyncio.wait_for(closed.wait(), 5)
+        finally:
+            downloader.close()
+            server.close()
+        return result
+
+    result = asyncio.run(run())
+    assert not result.ok and result.error == 'TimeoutError'
+
+
+def test_fetch_conditional_resume(tmp_path):
+    clamavkeys.registerkey(privatekey(clamavkeys.MD5, 'mirror-test'))
+    clamavkeys.registerkey(privatekey(clamavkeys.PSS, 'mirror-test-pss'))
+    server, url = serve()
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    standin.files = buildfiles(tmp_path, [2])
+    standin.connections = 0
+    standin.requests = list()
+
+    async def run():
+        downloader = clamavmirror(url, str(mirror), connections=2)
+        try:
+            first = await downloader.fetchall(['daily.cvd', 'daily-3.cdiff', 'daily-4.cdiff'])
+            second = await downloader.fetchall(['daily.cvd', 'daily-3.cdiff'])
+        finally:
+            downloader.close()
+        return first, second
+
+    try:
+        first, second = asyncio.run(run())
+        assert [result.ok for result in first] == [True, True, False]
+        assert first[0].version == 2 and first[1].version == 3
+        assert first[2].status == 404
+        assert all(result.unchanged for result in second)
+        assert standin.connections <= 2
+        assert (mirror / 'daily.cvd').read_bytes() == standin.files['daily.cvd'][0]
+
+        # Interrupted download resumes with a Range request
+        data, etag = standin.files['daily-3.cdiff']
+        os.unlink(str(mirror / 'daily-3.cdiff'))
+        (mirror / '.daily-3.cdiff.part').write_bytes(data[:100])
+        state = clamavmirror(url, str(mirror))
+        state._state['daily-3.cdiff'] = {'partetag': etag}
+        state._savestate()
+        standin.requests = list()
+        result = asyncio.run(state.fetch('daily-3.cdiff'))
+        assert result.ok and result.resumedfrom == 100 and result.received == len(data) - 100
+        assert standin.requests == [('daily-3.cdiff', 'bytes=100-', None)]
+        assert not (mirror / '.daily-3.cdiff.part').exists()
+
+        # A corrupt file never becomes visible
+        standin.files['daily-3.cdiff'] = (data[:-10] + b'AAAAAAAAAA', '"bad"')
+        os.unlink(str(mirror / 'daily-3.cdiff'))
+        result = asyncio.run(clamavmirror(url, str(mirror)).fetch('daily-3.cdiff'))
+        assert not result.ok and result.error == 'signature mismatch'
+        assert sorted(os.listdir(str(mirror))) == ['daily.cvd', 'mirror.state']
+    finally:
+        server.shutdown()
+        server.server_close()
+        clamavkeys.unregisterkey('mirror-test')
+        clamavkeys.unregisterkey('mirror-test-pss')
+
+
+def test_sync(tmp_path):
+    clamavkeys.registerkey(privatekey(clamavkeys.MD5, 'mirror-test'))
+    clamavkeys.registerkey(privatekey(clamavkeys.PSS, 'mirror-test-pss'))
+    server, url = serve()
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    files = buildfiles(tmp_path, [2])
+    (mirror / 'daily.cvd').write_bytes(files['daily.cvd'][0])
+    (tmp_path / 'new').mkdir()
+    standin.files = buildfiles(tmp_path / 'new', [4])
+    standin.files['daily-3.cdiff'] = files['daily-3.cdiff']
+    record = clamavdns()
+    record.parsetext('0.103.0:59:4:1584556141:0:63:0:331')
+    try:
+        results = asyncio.run(clamavmirror(url, str(mirror)).sync(record, ['daily']))
+        # daily-4.cdiff is missing so the full CVD is fetched
+        assert [(result.filename, result.ok) for result in results] == \
+            [('daily-3.cdiff', True), ('daily-4.cdiff', False), ('daily.cvd', True)]
+        assert results[-1].version == 4
+    finally:
+        server.shutdown()
+        server.server_close()
+        clamavkeys.unregisterkey('mirror-test')
+        clamavkeys.unregisterkey('mirror-test-pss')
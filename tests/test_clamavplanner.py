@@ -0,0 +1,69 @@
+import sys
+sys.path.append('../')
+from cav import clamavkeys
+from cav.clamavdns import clamavdns
+from cav.clamavbuilder import clamavbuilder
+from cav.clamavplanner import clamavplanner
+from test_clamavkeys import privatekey
+from test_clamavcdiff import makecdiff
+
+
+def makemirror(directory, version, cdiffs):
+    source = directory / 'source'
+    source.mkdir()
+    (source / 'daily.hdb').write_bytes(b''.join(b'%032x:%d:Daily.Sig-%d\n' % (i, i, i)
+                                                for i in range(2000)))
+    clamavbuilder(privatekey(clamavkeys.MD5)).buildcvd(str(source), str(directory / 'daily.cvd'),
+                                                        version)
+    for cdiffversion in cdiffs:
+        makecdiff(str(directory / 'daily-{}.cdiff'.format(cdiffversion)), cdiffversion,
+                  b'OPEN daily.hdb\nADD x\nCLOSE\n')
+
+
+def record(daily):
+    dns = clamavdns()
+    dns.parsetext('0.103.0:59:{}:1584556141:0:63:0:331'.format(daily))
+    return dns
+
+
+def test_plan_chain(tmp_path):
+    makemirror(tmp_path, 10, [9, 11, 12, 14])
+    sizes = {'daily-13.cdiff': 500, 'daily-15.cdiff': 700, 'daily.cvd': 100000}
+    plans = clamavplanner(str(tmp_path), sizes.get).plan(record(15))
+    assert list(plans) == ['daily']
+    plan = plans['daily']
+    assert not plan.full
+    assert [version for version, _, _ in plan.cdiffs] == [11, 12, 13, 14, 15]
+    assert plan.fetch() == ['daily-13.cdiff', 'daily-15.cdiff']
+    assert plan.bytes() == 1200
+    assert plan.gaps == [10, 13, 15]
+    # Older cdiffs are history for lagging clients, not stale
+    assert plan.stale == []
+    assert 'daily 10 -> 15 5 cdiffs, 2 to fetch (1200 bytes)' in plan.text()
+
+
+def test_plan_full(tmp_path):
+    makemirror(tmp_path, 10, [11])
+    (tmp_path / 'daily-12.cdiff').write_bytes(b'ClamAV-Diff:13:10:junk')
+    planner = clamavplanner(str(tmp_path), {'daily-12.cdiff': 10, 'daily.cvd': 5000}.get)
+    plan = planner.plan(record(13))['daily']
+    # Mirror lacks cdiff 13, the misnamed local cdiff 12 is not used
+    assert plan.full and plan.fetch() == ['daily.cvd'] and plan.bytes() == 5000
+    assert plan.reason == 'cdiff 13 not available'
+    assert 'daily-12.cdiff' in plan.stale
+
+    planner = clamavplanner(str(tmp_path), lambda name: 4000 if name.endswith('.cdiff') else 5000)
+    assert not planner.plan(record(12))['daily'].full
+    plan = planner.plan(record(13))['daily']
+    assert plan.full and plan.reason == 'cdiffs are larger than the full database'
+
+    planner = clamavplanner(str(tmp_path), lambda name: 1 if name.endswith('.cdiff') else 1000,
+                            maxchain=2)
+    assert planner.plan(record(14))['daily'].full
+    assert planner.plan(record(13))['daily'].fetch() == ['daily-12.cdiff', 'daily-13.cdiff']
+
+    plan = planner.plan(record(10))['daily']
+    assert plan.uptodate() and plan.fetch() == [] and 'daily-11.cdiff' in plan.stale
+
+    plan = planner.plan(record(3), ['main'])['main']
+    assert plan.full and plan.reason == 'no local database'
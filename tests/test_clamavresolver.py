@@ -0,0 +1,186 @@
+import sys
+import struct
+import asyncio
+import pytest
+sys.path.append('../')
+from cav.clamavresolver import clamavresolver, dnserror, encodequery, decoderesponse
+from cav.clamavdns import clamavdns
+
+RECORD = '0.102.2:59:25755:1584556141:1:63:49191:331'
+
+
+def answer(query: bytes, records, ttl: int = 300, truncated: bool = False) -> bytes:
+    'Response to query with one TXT answer per record'
+    queryid = struct.unpack_from('>H', query)[0]
+    flags = 0x8180 | (0x0200 if truncated else 0)
+    response = struct.pack('>HHHHHH', queryid, flags, 1, 0 if truncated else len(records), 0, 0)
+    response += query[12:]
+    if truncated:
+        return response
+    for record in records:
+        data = record.encode('ascii')
+        rdata = bytes([len(data)]) + data
+        response += struct.pack('>HHHIH', 0xc00c, 16, 1, ttl, len(rdata)) + rdata
+
+    return response
+
+
+class standin(asyncio.DatagramProtocol):
+    'Local UDP DNS server, ignores the first drop queries'
+    def __init__(self, records, ttl=300, drop=0, truncated=False):
+        self.records = records
+        self.ttl = ttl
+        self.drop = drop
+        self.truncated = truncated
+        self.queries = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.queries += 1
+        if self.queries <= self.drop:
+            return
+        self.transport.sendto(answer(data, self.records, self.ttl, self.truncated), addr)
+
+
+async def startserver(protocol):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: protocol,
+                                                       local_addr=('127.0.0.1', 0))
+    return transport, transport.get_extra_info('sockname')
+
+
+def test_wireformat():
+    query = encodequery(4660, 'current.cvd.clamav.net')
+    assert query[:2] == b'\x12\x34'
+    assert b'\x07current\x03cvd\x06clamav\x03net\x00' in query
+    truncated, records, ttl = decoderesponse(answer(query, [RECORD], 120), 4660,
+                                             'current.cvd.clamav.net.')
+    assert not truncated and records == [RECORD] and ttl == 120
+    with pytest.raises(dnserror):
+        decoderesponse(answer(query, [RECORD]), 4661, 'current.cvd.clamav.net')
+    with pytest.raises(dnserror):
+        decoderesponse(answer(query, [RECORD])[:-5], 4660, 'current.cvd.clamav.net')
+
+
+def test_query_cache_and_race():
+    async def run():
+        good = standin([RECORD])
+        silent = standin([RECORD], drop=100)
+        goodtransport, goodaddress = await startserver(good)
+        silenttransport, silentaddress = await startserver(silent)
+        resolver = clamavresolver([silentaddress, goodaddress], timeout=0.5)
+        try:
+            await asyncio.gather(*[clamavdns().query(resolver=resolver)
+                                 for _ in range(20)])
+            checked = clamavdns()
+            await checked.query(resolver=resolver)
+        finally:
+            goodtransport.close()
+            silenttransport.close()
+        return good, checked, resolver
+
+    good, checked, resolver = asyncio.run(run())
+    assert checked.text() == RECORD
+    assert checked.dailyversion() == 25755 and checked.versionwarning()
+    # One query per nameserver answers 21 lookups
+    assert good.queries == 1
+    assert resolver.upstreamqueries == 2
+    assert resolver.cachehits == 20
+
+
+def test_retry_ttl_and_invalid():
+    async def run():
+        flaky = standin(['v=spf1 -all', RECORD], ttl=0, drop=1)
+        transport, address = await startserver(flaky)
+        resolver = clamavresolver([address], timeout=0.2, backoff=0.01)
+        try:
+            first = clamavdns()
+            await first.query(resolver=resolver)
+            await clamavdns().query(resolver=resolver)
+            bad = standin(['0.102.2:59:x'])
+            badtransport, badaddress = await startserver(bad)
+            with pytest.raises(dnserror):
+                await clamavdns().query(resolver=clamavresolver([badaddress]))
+            badtransport.close()
+        finally:
+            transport.close()
+        return flaky, first
+
+    flaky, first = asyncio.run(run())
+    assert first.text() == RECORD
+    # Dropped first query retried, TTL 0 is not cached
+    assert flaky.queries == 3
+
+
+def test_cancelled_lookup():
+    async def run():
+        server = standin([RECORD], ttl=1, drop=1)
+        transport, address = await startserver(server)
+        resolver = clamavresolver([address], timeout=0.2, backoff=0.01)
+        try:
+            # The first caller gives up while the lookup is still retrying
+            first = asyncio.ensure_future(resolver.txt('current.cvd.clamav.net'))
+            await asyncio.sleep(0.05)
+            waiter = asyncio.ensure_future(resolver.txt('current.cvd.clamav.net'))
+            await asyncio.sleep(0)
+            first.cancel()
+            assert await waiter == [RECORD]
+            assert resolver._inflight == dict()
+            assert await resolver.txt('current.cvd.clamav.net') == [RECORD]
+            server.records = ['changed']
+            await asyncio.sleep(1.1)
+            assert await resolver.txt('current.cvd.clamav.net') == ['changed']
+        finally:
+            transport.close()
+        return server
+
+    assert asyncio.run(run()).queries == 3
+
+
+def test_truncated_falls_back_to_tcp():
+    async def run():
+        async def tcpserver(reader, writer):
+            length = struct.unpack('>H', await reader.readexactly(2))[0]
+            response = answer(await reader.readexactly(length), [RECORD])
+            writer.write(struct.pack('>H', len(response)) + response)
+            await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(tcpserver, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        loop = asyncio.get_running_loop()
+        try:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: standin([RECORD], truncated=True), local_addr=('127.0.0.1', port))
+        except OSError:
+            server.close()
+            return None
+        try:
+            dns = clamavdns()
+            await dns.query(resolver=clamavresolver([('127.0.0.1', port)], timeout=1))
+        finally:
+            transport.close()
+            server.close()
+        return dns
+
+    dns = asyncio.run(run())
+    if dns is None:
+        pytest.skip('UDP port of the TCP server is in use')
+    assert dns.text() == RECORD
+
+
+def test_all_fail():
+    async def run():
+        silent = standin([RECORD], drop=100)
+        transport, address = await startserver(silent)
+        try:
+            with pytest.raises(dnserror):
+                await clamavresolver([address], timeout=0.05, attempts=2,
+                                     backoff=0.01).txt('current.cvd.clamav.net')
+        finally:
+            transport.close()
+        return silent
+
+    assert asyncio.run(run()).queries == 2
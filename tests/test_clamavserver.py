@@ -0,0 +1,131 @@
+import sys
+import asyncio
+sys.path.append('../')
+from cav import clamavkeys
+from cav.clamavdns import clamavdns
+from cav.clamavcache import clamavcache
+from cav.clamavserver import clamavserver
+from test_clamavkeys import privatekey
+from test_clamavmirror import buildfiles
+
+
+async def request(port, path, headers=None, method='GET', reader=None, writer=None):
+    'Send one request and return (status, headers, body)'
+    if reader is None:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    lines = ['{} {} HTTP/1.1'.format(method, path), 'Host: localhost']
+    lines += ['{}: {}'.format(name, value) for name, value in (headers or dict()).items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    status = int((await reader.readline()).split()[1])
+    received = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        received[name.strip().lower()] = value.strip()
+    length = int(received.get('content-length', 0)) if method != 'HEAD' else 0
+    body = await reader.readexactly(length)
+    return status, received, body
+
+
+def test_serve(tmp_path):
+    clamavkeys.registerkey(privatekey(clamavkeys.MD5, 'mirror-test'))
+    clamavkeys.registerkey(privatekey(clamavkeys.PSS, 'mirror-test-pss'))
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    files = buildfiles(tmp_path, [2])
+    for name, (data, _) in files.items():
+        (mirror / name).write_bytes(data)
+    cvd = files['daily.cvd'][0]
+    (mirror / 'main.cvd').write_bytes(cvd[:-10] + b'0123456789')
+    (mirror / 'notes.txt').write_bytes(b'not served')
+    header = b'ClamAV-VDB:18 Oct 2026 10-00 +0000:5:1:90:X:X:tester:1600000000'.ljust(512, b' ')
+    (mirror / 'bytecode.cld').write_bytes(header + b'\x1f\x8b\x08\x00' + b'\x00' * 6 + b'garbage' * 100)
+    record = clamavdns()
+    record.parsetext('0.103.0:59:2:1584556141:0:63:0:331')
+    cache = clamavcache(str(tmp_path / 'clamav.cache'))
+
+    async def run():
+        server = clamavserver(str(mirror), cache=cache, record=record)
+        await server.start()
+        port = server.port
+        try:
+            status, headers, body = await request(port, '/daily.cvd')
+            assert status == 200 and body == cvd
+            assert headers['accept-ranges'] == 'bytes'
+            etag = headers['etag']
+            assert etag.startswith('"2-') and headers['last-modified'].endswith('GMT')
+
+            assert (await request(port, '/daily.cvd', {'If-None-Match': etag}))[0] == 304
+            assert (await request(port, '/daily.cvd',
+                                  {'If-Modified-Since': headers['last-modified']}))[0] == 304
+            status, ranged, body = await request(port, '/daily.cvd', {'Range': 'bytes=10-19'})
+            assert status == 206 and body == cvd[10:20]
+            assert ranged['content-range'] == 'bytes 10-19/{}'.format(len(cvd))
+            status, _, body = await request(port, '/daily.cvd', {'Range': 'bytes=-5'})
+            assert status == 206 and body == cvd[-5:]
+            status, _, body = await request(port, '/daily.cvd', {'Range': 'bytes=100-',
+                                                                 'If-Range': '"other"'})
+            assert status == 200 and body == cvd
+            assert (await request(port, '/daily.cvd', {'Range': 'bytes=999999999-'}))[0] == 416
+            status, headers, body = await request(port, '/daily.cvd', method='HEAD')
+            assert status == 200 and body == b'' and int(headers['content-length']) == len(cvd)
+
+            assert (await request(port, '/main.cvd'))[0] == 403
+            assert (await request(port, '/bytecode.cld'))[0] == 403
+            assert (await request(port, '/bytecode.cld'))[0] == 403
+            assert (await request(port, '/missing.cvd'))[0] == 404
+            assert (await request(port, '/notes.txt'))[0] == 404
+            assert (await request(port, '/../mirror/daily.cvd'))[0] == 404
+            assert (await request(port, '/daily.cvd', method='POST'))[0] == 405
+            status, _, body = await request(port, '/current')
+            assert status == 200 and body == b'0.103.0:59:2:1584556141:0:63:0:331\n'
+
+            # Keep-alive and many clients at once
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            for _ in range(3):
+                status, _, body = await request(port, '/daily-3.cdiff', reader=reader, writer=writer)
+                assert status == 200 and body == files['daily-3.cdiff'][0]
+            writer.close()
+            results = await asyncio.gather(*[request(port, '/daily.cvd') for _ in range(200)])
+            assert all(result[0] == 200 and result[2] == cvd for result in results)
+        finally:
+            await server.close()
+        return server
+
+    try:
+        server = asyncio.run(run())
+        assert server.refused == 3 and server.notmodified == 2
+        assert server.bytessent >= 201 * len(cvd)
+        # Verdicts were stored, a new server only looks them up
+        hits = cache.hits
+        asyncio.run(_fetchonce(mirror, cache))
+        assert cache.hits == hits + 1
+    finally:
+        clamavkeys.unregisterkey('mirror-test')
+        clamavkeys.unregisterkey('mirror-test-pss')
+
+
+async def _fetchonce(mirror, cache):
+    server = clamavserver(str(mirror), cache=cache)
+    await server.start()
+    try:
+        assert (await request(server.port, '/daily.cvd'))[0] == 200
+        assert (await request(server.port, '/current'))[0] == 404
+    finally:
+        await server.close()
+    statefile = mirror / 'clamav.state'
+    statefile.write_text('{"clamversion":')
+    server = clamavserver(str(mirror), cache=cache, statefile=str(statefile))
+    await server.start()
+    try:
+        assert (await request(server.port, '/current'))[0] == 503
+        record = clamavdns()
+        record.parsetext('0.103.0:59:3:1584556141:0:63:0:331')
+        record.savestatefile(str(statefile))
+        status, _, body = await request(server.port, '/current')
+        assert status == 200 and body.startswith(b'0.103.0:59:3:')
+    finally:
+        await server.close()
+
@@ -0,0 +1,99 @@
+import os
+import sys
+import zlib
+import pytest
+sys.path.append('../')
+from cav import clamavkeys
+from cav.clamavbuilder import clamavbuilder
+from cav.clamavstore import clamavstore
+from test_clamavkeys import privatekey
+
+
+def build(tmp_path, version, compresslevel=9):
+    source = tmp_path / 'source-{}'.format(version)
+    source.mkdir()
+    (source / 'COPYING').write_bytes(b'License text\n' * 100)
+    (source / 'daily.hdb').write_bytes(b''.join(b'%032x:%d:Sig-%d\n' % (i, i, i) for i in range(20000)))
+    (source / 'daily.ldb').write_bytes(b''.join(b'Logical.Sig-%d;Engine:51-255\n' % i for i in range(version)))
+    builder = clamavbuilder(privatekey(clamavkeys.MD5, 'store-test'), compresslevel=compresslevel)
+    return builder.buildcvd(str(source), str(tmp_path / 'daily-{}.cvd'.format(version)),
+                            version, 'daily', timestamp=1600000000 + version)
+
+
+def test_store_and_rebuild(tmp_path):
+    store = clamavstore(str(tmp_path / 'store'))
+    originals = dict()
+    for version in range(10, 20):
+        clamobject = build(tmp_path, version)
+        originals[version] = (tmp_path / 'daily-{}.cvd'.format(version)).read_bytes()
+        manifest = store.add(clamobject, 'daily')
+        assert 'body' not in manifest
+    # COPYING and daily.hdb are stored once, daily.ldb and daily.info per version
+    assert store.stored == 2 + 2 * 10 and store.duplicates == 2 * 9
+    assert store.versions() == [('daily', version) for version in range(10, 20)]
+    assert store.disksize() < sum(map(len, originals.values())) / 3
+
+    for version in (10, 15, 19):
+        rebuilt = store.rebuild('daily', version, str(tmp_path / 'rebuilt.cvd'))
+        assert (tmp_path / 'rebuilt.cvd').read_bytes() == originals[version]
+        assert rebuilt.version() == version
+
+    store.remove('daily', 10)
+    assert store.prune() == 2
+    assert store.prune() == 0
+    store.rebuild('daily', 11, str(tmp_path / 'rebuilt.cvd'))
+    assert (tmp_path / 'rebuilt.cvd').read_bytes() == originals[11]
+
+
+def test_fallback_and_cld(tmp_path):
+    store = clamavstore(str(tmp_path / 'store'))
+    # Level 3 leaves no trace in the gzip header and is found by trying
+    clamobject = build(tmp_path, 5, compresslevel=3)
+    manifest = store.add(clamobject)
+    assert manifest['dbname'] == 'daily-5' and 'body' not in manifest
+    assert manifest['level'] == 3
+    store.rebuild('daily-5', 5, str(tmp_path / 'rebuilt.cvd'))
+    assert (tmp_path / 'rebuilt.cvd').read_bytes() == (tmp_path / 'daily-5.cvd').read_bytes()
+
+    # Another deflate setting can not be reproduced, only the body is kept
+    original = (tmp_path / 'daily-5.cvd').read_bytes()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15, 2)
+    tar = zlib.decompress(original[512:], 31)
+    body = original[512:522] + compressor.compress(tar) + compressor.flush() + original[-8:]
+    (tmp_path / 'other.cvd').write_bytes(original[:512] + body)
+    stored = store.stored
+    manifest = store.add(str(tmp_path / 'other.cvd'), 'other')
+    assert 'body' in manifest and 'members' not in manifest
+    assert store.stored == stored + 1 and store.prune() == 0
+    store.rebuild('other', 5, str(tmp_path / 'rebuilt.cvd'))
+    assert (tmp_path / 'rebuilt.cvd').read_bytes() == original[:512] + body
+    assert os.stat(tmp_path / 'rebuilt.cvd').st_mode == os.stat(tmp_path / 'other.cvd').st_mode
+
+    # A body that fails after its members were split leaves no objects behind
+    objects = sorted(os.path.join(root, name) for root, _, names in os.walk(store.objects)
+                     for name in names)
+    build(tmp_path, 7)
+    (tmp_path / 'twice.cvd').write_bytes((tmp_path / 'daily-7.cvd').read_bytes() +
+                                         zlib.compress(b'more', wbits=31))
+    with pytest.raises(ValueError):
+        store.add(str(tmp_path / 'twice.cvd'), 'twice')
+    assert sorted(os.path.join(root, name) for root, _, names in os.walk(store.objects)
+                  for name in names) == objects
+    assert store.stored == stored + 1
+
+    clamobject.tocld(str(tmp_path / 'daily.cld'))
+    manifest = store.add(str(tmp_path / 'daily.cld'))
+    assert not manifest['compressed'] and 'body' not in manifest
+    store.rebuild('daily', 5, str(tmp_path / 'rebuilt.cld'))
+    assert (tmp_path / 'rebuilt.cld').read_bytes() == (tmp_path / 'daily.cld').read_bytes()
+
+    # A damaged object is caught by the MD5 check and nothing is written
+    objectpath = store.objectpath(manifest['members'][1]['object'])
+    with open(objectpath, 'r+b') as objectfile:
+        objectfile.write(b'X')
+    try:
+        store.rebuild('daily', 5, str(tmp_path / 'broken.cld'))
+        assert False
+    except ValueError:
+        pass
+    assert not (tmp_path / 'broken.cld').exists()
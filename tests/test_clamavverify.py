@@ -0,0 +1,35 @@
+import json
+import sys
+sys.path.append('../')
+from cav.clamavverify import verify_many, main
+
+
+def test_verify_many():
+    paths = ['main-59.cdiff', 'daily-25784.cdiff', 'daily-25784-signature-fail.cdiff', 'missing.cvd']
+    results = {result.path: result for result in verify_many(paths, workers=2)}
+    assert sorted(results) == sorted(paths)
+    assert results['daily-25784.cdiff'].ok is True
+    assert results['daily-25784.cdiff'].byteshashed == 58438 - 343
+    assert results['daily-25784.cdiff'].version == 25784
+    assert results['daily-25784-signature-fail.cdiff'].ok is False
+    assert results['missing.cvd'].ok is False
+    assert results['missing.cvd'].error
+
+
+def test_damaged_cld(tmp_path):
+    header = b'ClamAV-VDB:18 Oct 2026 10-00 +0000:5:1:90:X:X:tester:1600000000'.ljust(512, b' ')
+    (tmp_path / 'gzip.cld').write_bytes(header + b'\x1f\x8b\x08\x00' + b'\x00' * 6 + b'garbage' * 100)
+    (tmp_path / 'plain.cld').write_bytes(header + b'garbage' * 100)
+    paths = [str(tmp_path / 'gzip.cld'), str(tmp_path / 'plain.cld'), 'daily-25784.cdiff']
+    results = {result.path: result for result in verify_many(paths, workers=2)}
+    assert results[paths[0]].ok is False and results[paths[0]].error
+    assert results[paths[1]].ok is False and results[paths[1]].error
+    assert results['daily-25784.cdiff'].ok is True
+
+
+def test_main(capsys):
+    assert main(['--json', '-j', '1', 'daily-25784.cdiff']) == 0
+    result = json.loads(capsys.readouterr().out)
+    assert result['ok'] is True
+    assert main(['daily-25784-signature-fail.cdiff']) == 1
+    assert capsys.readouterr().out.startswith('FAIL daily-25784-signature-fail.cdiff')